@@ -0,0 +1,276 @@
+"""
+Sheetiq benchmark suite: times ingest, table registration, queries and exports
+on synthetic data and writes machine-readable results.
+
+Each case runs in a fresh process, so its peak RSS is measured in isolation and
+no cache or allocator state carries over from the previous case. Ingest cases
+read real xlsx files, which are generated once and kept in the work directory;
+they are limited to sizes that fit in one Excel sheet. Query and export cases
+start from an in-memory Arrow table and scale to any size; the export.copy
+cases write the result formats of the app with DuckDB's COPY, next to the
+pandas-based export.csv. The ui.rerun case
+times one full page run of the app, through Streamlit's test harness, with the
+table loaded; compare it with the app's rerun target (RERUN_TARGET_MS).
+
+Examples:
+    python -m benchmarks.run_benchmarks --sizes 10k,100k,1m -o results.json
+    python -m benchmarks.run_benchmarks --sizes 10k --compare results.json
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import duckdb
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+from streamlit.testing.v1 import AppTest
+
+from benchmarks.workbook_generator import (
+    DEFAULT_MIX,
+    generate_dimension,
+    generate_table,
+    parse_size,
+    write_workbook,
+)
+from sheetiq_engine import (
+    EXCEL_MAX_ROWS,
+    RESULT_EXPORT_FORMATS,
+    create_excel_download,
+    execute_sql_query_multi_table,
+    export_query_result,
+    load_excel_data,
+    load_excel_table,
+    load_excel_table_fast,
+    register_table,
+    stream_excel_file_to_duckdb,
+)
+
+BENCHMARK_QUERIES = {
+    'filter': "SELECT * FROM data WHERE amount > 900 AND category <> 'category_0'",
+    'group_by': (
+        "SELECT category, COUNT(*) AS n, SUM(amount) AS total, AVG(amount) AS mean "
+        "FROM data GROUP BY category"
+    ),
+    'join': (
+        "SELECT d.label, COUNT(*) AS n, SUM(f.amount) AS total "
+        "FROM data f JOIN dim d ON f.key = d.key GROUP BY d.label"
+    ),
+    'window': (
+        "SELECT category, id, amount, RANK() OVER (PARTITION BY category ORDER BY amount DESC) AS rnk "
+        "FROM data QUALIFY rnk <= 10"
+    )
+}
+
+INGEST_CASES = ['ingest.load_excel_data', 'ingest.load_excel_table', 'ingest.fast_xlsx', 'ingest.stream_excel']
+TABLE_CASES = (
+    ['register.arrow'] + [f"query.{name}" for name in BENCHMARK_QUERIES] + ['export.excel', 'export.csv']
+    + [f"export.copy.{name}" for name in RESULT_EXPORT_FORMATS] + ['ui.rerun']
+)
+DEFAULT_SIZES = '10k,100k,1m'
+REGRESSION_THRESHOLD = 0.10
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sheetiq.py')
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def get_workbook_path(work_dir, rows, data_options):
+    """Path of the generated workbook for a size and data options, creating it on first use"""
+    key_source = json.dumps({'rows': rows, **data_options}, sort_keys=True)
+    key = hashlib.sha256(key_source.encode()).hexdigest()[:16]
+    path = os.path.join(work_dir, f"bench_{rows}_{key}.xlsx")
+    if not os.path.exists(path):
+        print(f"  generating {rows:,}-row workbook...", file=sys.stderr, flush=True)
+        tmp_path = f"{path}.tmp"
+        write_workbook(generate_table(rows, **data_options), tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+def prepare_case(case, rows, data_options, workbook_path, export_rows):
+    """
+    Build the inputs of a case outside the timed section.
+    Returns a zero-argument function that performs one timed run.
+    """
+    if case == 'ingest.load_excel_data':
+        return lambda: load_excel_data(workbook_path)
+    if case == 'ingest.load_excel_table':
+        return lambda: load_excel_table(workbook_path)
+    if case == 'ingest.fast_xlsx':
+        return lambda: load_excel_table_fast(workbook_path)
+    if case == 'ingest.stream_excel':
+        conn = duckdb.connect(':memory:')
+        return lambda: stream_excel_file_to_duckdb(workbook_path, conn, 'data')
+    
+    table = generate_table(rows, **data_options)
+    if case == 'register.arrow':
+        conn = duckdb.connect(':memory:')
+        return lambda: register_table(conn, 'data', table)
+    
+    if case.startswith('query.'):
+        conn = duckdb.connect(':memory:')
+        tables = {'data': table, 'dim': generate_dimension(data_options['cardinality'])}
+        for table_name, source in tables.items():
+            register_table(conn, table_name, source)
+        query = BENCHMARK_QUERIES[case.split('.', 1)[1]]
+        
+        def run_query():
+            result, error = execute_sql_query_multi_table(tables, query, conn)
+            if error:
+                raise RuntimeError(error)
+            return result
+        return run_query
+    
+    if case == 'ui.rerun':
+        app = AppTest.from_file(APP_PATH, default_timeout=600)
+        app.run()
+        app.session_state.uploaded_tables = {'data': table, 'dim': generate_dimension(data_options['cardinality'])}
+        app.run()
+        return app.run
+    
+    if case.startswith('export.copy.'):
+        conn = duckdb.connect(':memory:')
+        register_table(conn, 'data', table.slice(0, export_rows))
+        export_format = case.split('.', 2)[2]
+        path = os.path.join(tempfile.gettempdir(), f"sheetiq_bench_export{RESULT_EXPORT_FORMATS[export_format]['suffix']}")
+        return lambda: export_query_result(conn, 'SELECT * FROM data', path, export_format)
+    
+    df = table.slice(0, export_rows).to_pandas()
+    if case == 'export.excel':
+        return lambda: create_excel_download(df)
+    if case == 'export.csv':
+        return lambda: df.to_csv(index=False)
+    raise ValueError(f"Unknown benchmark case '{case}'")
+
+def run_case(case, rows, data_options, workbook_path, export_rows, repeat):
+    """Process entry point: time one case and report timings and memory"""
+    run_once = prepare_case(case, rows, data_options, workbook_path, export_rows)
+    setup_rss = peak_rss_mb()
+    seconds = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        run_once()
+        seconds.append(time.perf_counter() - start_time)
+    return {
+        'case': case,
+        'rows': rows,
+        'seconds': seconds,
+        'median_seconds': statistics.median(seconds),
+        'min_seconds': min(seconds),
+        'setup_rss_mb': round(setup_rss, 1),
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+def run_isolated(*args):
+    """Run one case in a freshly spawned process"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(run_case, *args).result()
+
+def get_environment():
+    """Versions and machine details recorded with the results"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'duckdb': duckdb.__version__,
+        'pandas': pd.__version__,
+        'pyarrow': pa.__version__,
+        'openpyxl': openpyxl.__version__
+    }
+
+def compare_results(current, baseline, threshold=REGRESSION_THRESHOLD):
+    """Print each case's median time against a baseline run. Returns the number of regressions."""
+    baseline_times = {(r['case'], r['rows']): r['median_seconds'] for r in baseline['results']}
+    regressions = 0
+    print(f"\n{'case':<26}{'rows':>12}{'baseline':>12}{'current':>12}{'change':>10}")
+    for result in current['results']:
+        key = (result['case'], result['rows'])
+        if key not in baseline_times:
+            continue
+        before, after = baseline_times[key], result['median_seconds']
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  slower"
+            regressions += 1
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{result['case']:<26}{result['rows']:>12,}{before:>11.3f}s{after:>11.3f}s{change:>+10.1%}{flag}")
+    return regressions
+
+def main(argv=None):
+    """Run the benchmark suite from the command line"""
+    parser = argparse.ArgumentParser(description="Benchmark Sheetiq ingest, queries and exports.")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help=f"Comma-separated row counts, e.g. 10k,100k,1m,10m (default: {DEFAULT_SIZES})")
+    parser.add_argument('--cases', help="Comma-separated case names or prefixes, e.g. ingest,query.join (default: all)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Extra column type mix (default: {DEFAULT_MIX})")
+    parser.add_argument('--cardinality', type=int, default=100, help="Distinct values per string column (default: 100)")
+    parser.add_argument('--null-ratio', type=float, default=0.0, help="Share of blank cells in extra columns")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--repeat', type=int, default=3, help="Timed runs per case (default: 3)")
+    parser.add_argument('--max-ingest-rows', default='1m', help="Largest size for the xlsx ingest cases (default: 1m)")
+    parser.add_argument('--max-export-rows', default='1m', help="Rows exported by the export cases at most (default: 1m)")
+    parser.add_argument('--work-dir', default=os.path.join(tempfile.gettempdir(), 'sheetiq_bench'),
+                        help="Where generated workbooks are kept between runs")
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help="Results file to write")
+    parser.add_argument('--compare', help="Earlier results file to compare against")
+    args = parser.parse_args(argv)
+    
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    max_ingest_rows = min(parse_size(args.max_ingest_rows), EXCEL_MAX_ROWS - 1)
+    export_rows = parse_size(args.max_export_rows)
+    data_options = {'mix': args.mix, 'cardinality': args.cardinality, 'null_ratio': args.null_ratio, 'seed': args.seed}
+    selected = args.cases.split(',') if args.cases else None
+    os.makedirs(args.work_dir, exist_ok=True)
+    
+    results = []
+    for rows in sizes:
+        cases = (INGEST_CASES if rows <= max_ingest_rows else []) + TABLE_CASES
+        if selected:
+            cases = [case for case in cases if any(case.startswith(prefix) for prefix in selected)]
+        workbook_path = None
+        if any(case.startswith('ingest.') for case in cases):
+            workbook_path = get_workbook_path(args.work_dir, rows, data_options)
+        
+        for case in cases:
+            result = run_isolated(case, rows, data_options, workbook_path, export_rows, args.repeat)
+            results.append(result)
+            print(f"{case:<26}{rows:>12,} rows {result['median_seconds']:>9.3f}s  peak {result['peak_rss_mb']:>8.1f} MB",
+                  flush=True)
+    
+    options = {**data_options, 'repeat': args.repeat, 'max_export_rows': export_rows}
+    report = {'environment': get_environment(), 'options': options, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_results(report, baseline):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
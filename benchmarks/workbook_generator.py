@@ -0,0 +1,118 @@
+"""
+Synthetic data for the Sheetiq benchmarks.
+
+Every generated table has four fixed columns used by the benchmark queries:
+id (row number), key (join key into the dimension table), amount (float in
+[0, 1000)) and category (string with the configured cardinality). Extra
+columns are added from a type mix such as "int=2,float=1,str=2,date=1,bool=1".
+The same arguments and seed always produce the same data.
+
+Example:
+    python -m benchmarks.workbook_generator --rows 100k --mix int=2,str=3 -o bench.xlsx
+"""
+import argparse
+import time
+
+import numpy as np
+import openpyxl
+import pyarrow as pa
+import pyarrow.compute as pc
+
+DEFAULT_MIX = 'int=1,float=1,str=1,date=1,bool=1'
+COLUMN_TYPES = ['int', 'float', 'str', 'date', 'bool']
+DIMENSION_LABELS = 10
+WRITE_BATCH_ROWS = 50_000
+
+def parse_size(text):
+    """Parse a row count such as 10000, 10k or 1.5m"""
+    text = text.strip().lower().replace('_', '')
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+def parse_mix(text):
+    """Parse a type mix such as "int=2,str=1" into {'int': 2, 'str': 1}"""
+    mix = {}
+    for part in filter(None, (part.strip() for part in text.split(','))):
+        name, _, count = part.partition('=')
+        if name not in COLUMN_TYPES:
+            raise ValueError(f"Unknown column type '{name}'; choose from {', '.join(COLUMN_TYPES)}")
+        mix[name] = int(count or 1)
+    return mix
+
+def _with_nulls(array, rng, null_ratio):
+    """Blank out a random share of an array's values"""
+    if not null_ratio:
+        return array
+    mask = pa.array(rng.random(len(array)) < null_ratio)
+    return pc.if_else(mask, pa.scalar(None, array.type), array)
+
+def _random_column(kind, index, rows, rng, cardinality):
+    """One extra column of the given kind"""
+    if kind == 'int':
+        return pa.array(rng.integers(-1_000_000, 1_000_000, rows))
+    if kind == 'float':
+        return pa.array(rng.normal(0, 100, rows).round(4))
+    if kind == 'str':
+        labels = pa.array([f"s{index}_{i}" for i in range(cardinality)])
+        return labels.take(pa.array(rng.integers(0, cardinality, rows)))
+    if kind == 'date':
+        days = rng.integers(0, 3650, rows).astype('timedelta64[D]')
+        return pa.array(np.datetime64('2015-01-01') + days)
+    return pa.array(rng.random(rows) < 0.5)
+
+def generate_table(rows, mix=DEFAULT_MIX, cardinality=100, null_ratio=0.0, seed=42):
+    """Generate the benchmark fact table as an Arrow table"""
+    rng = np.random.default_rng(seed)
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    categories = pa.array([f"category_{i}" for i in range(cardinality)])
+    columns = {
+        'id': pa.array(np.arange(rows, dtype=np.int64)),
+        'key': pa.array(rng.integers(0, cardinality, rows)),
+        'amount': pa.array(rng.random(rows) * 1000),
+        'category': categories.take(pa.array(rng.integers(0, cardinality, rows)))
+    }
+    for kind in COLUMN_TYPES:
+        for i in range(1, mix.get(kind, 0) + 1):
+            column = _random_column(kind, i, rows, rng, cardinality)
+            columns[f"{kind}_{i}"] = _with_nulls(column, rng, null_ratio)
+    return pa.table(columns)
+
+def generate_dimension(cardinality=100):
+    """Dimension table joined to the fact table on key"""
+    keys = np.arange(cardinality, dtype=np.int64)
+    return pa.table({
+        'key': pa.array(keys),
+        'label': pa.array([f"label_{k % DIMENSION_LABELS}" for k in keys])
+    })
+
+def write_workbook(table, path):
+    """Write an Arrow table to an xlsx file with openpyxl's write-only mode"""
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet('Data')
+    sheet.append(table.column_names)
+    for batch in table.to_batches(WRITE_BATCH_ROWS):
+        for row in zip(*(column.to_pylist() for column in batch.columns)):
+            sheet.append(row)
+    workbook.save(path)
+
+def main(argv=None):
+    """Generate one workbook from the command line"""
+    parser = argparse.ArgumentParser(description="Generate a synthetic Excel workbook for benchmarking.")
+    parser.add_argument('--rows', default='10k', help="Row count, e.g. 10000, 10k or 1m (default: 10k)")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Extra column type mix (default: {DEFAULT_MIX})")
+    parser.add_argument('--cardinality', type=int, default=100, help="Distinct values per string column (default: 100)")
+    parser.add_argument('--null-ratio', type=float, default=0.0, help="Share of blank cells in extra columns")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('-o', '--output', required=True, help="Path of the xlsx file to write")
+    args = parser.parse_args(argv)
+    
+    start_time = time.perf_counter()
+    table = generate_table(parse_size(args.rows), args.mix, args.cardinality, args.null_ratio, args.seed)
+    write_workbook(table, args.output)
+    elapsed = time.perf_counter() - start_time
+    print(f"Wrote {table.num_rows:,} rows x {table.num_columns} columns to {args.output} in {elapsed:.1f}s")
+
+if __name__ == "__main__":
+    main()
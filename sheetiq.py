@@ -1,10 +1,94 @@
 import streamlit as st
 import pandas as pd
 import duckdb
-import io
+import pyarrow as pa
+import pyarrow.parquet as pq
+import os
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter
 from datetime import datetime
-import re
+import math
 import time
+import uuid
+import weakref
+
+from sheetiq_engine import (
+    APPROX_MAX_SAMPLE_SHARE,
+    APPROX_SAMPLE_ROWS,
+    AUTO_LAYOUT,
+    EXCEL_ENGINES,
+    INGEST_BATCH_ROWS,
+    INGEST_MAX_WORKERS,
+    LAYOUT_HISTORY_QUERIES,
+    LAYOUT_MIN_ROWS,
+    MEMORY_BUDGET_MB,
+    PhaseTimer,
+    QUERY_HEAVY_ROWS,
+    QUERY_MEMORY_LIMIT_MB,
+    QUERY_THREADS,
+    QUERY_TIMEOUT_SECONDS,
+    QueryCancelledError,
+    QueryPool,
+    QueryTimeoutError,
+    RESULT_EXPORT_FORMATS,
+    ResultCache,
+    SAMPLE_CACHE_MAX_BYTES,
+    SESSION_MEMORY_BUDGET_MB,
+    STORAGE_MODE,
+    SharedTableStore,
+    analyze_query,
+    apply_query_limits,
+    build_sorted_copy,
+    choose_table_layout,
+    create_file_view,
+    create_key_index,
+    describe_table,
+    discard_file,
+    discard_session_storage,
+    enable_query_progress,
+    export_query_result,
+    file_digest,
+    find_key_columns,
+    find_scalable_aggregates,
+    flatten_query_profile,
+    get_ingest_cache_path,
+    get_session_storage,
+    get_source_format,
+    get_source_suffix,
+    get_storage_stats,
+    get_table_name_from_filename,
+    is_valid_table_name,
+    is_numeric_type,
+    iter_cursor_rows,
+    is_catalog_table,
+    is_file_view,
+    make_result_cache_key,
+    open_database,
+    parse_workbook_to_cache,
+    persist_table,
+    read_excel_table,
+    profile_query,
+    profile_table,
+    quote_identifier,
+    run_interruptible,
+    sample_table,
+    sampling_margin,
+    read_ingest_cache,
+    register_table,
+    restrict_file_access,
+    spill_table_to_parquet,
+    spool_upload_to_disk,
+    stream_excel_to_duckdb,
+    swap_in_table,
+    time_query,
+    unregister_table,
+    validate_query,
+    write_excel_export,
+    write_ingest_cache,
+)
 
 # Configure the page with enhanced styling
 st.set_page_config(
@@ -14,6 +98,35 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Upper bound on concurrently cached per-session DuckDB connections
+SESSION_CATALOG_MAX_ENTRIES = 256
+
+# Column profiles kept in the cache, one per table version
+PROFILE_CACHE_MAX_ENTRIES = 128
+
+# Query results are materialized inside DuckDB and paged into the UI
+RESULT_SCHEMA = 'sheetiq_results'
+RESULT_TABLE = f'{RESULT_SCHEMA}.last_result'
+RESULT_PAGE_SIZES = [50, 100, 500, 1000]
+
+# How often the panel of a queued or running query refreshes, in seconds
+QUERY_POLL_SECONDS = 0.5
+
+# Full page runs taking longer than this are flagged in the sidebar
+RERUN_TARGET_MS = 200
+
+# Seconds between memory budget checks, which also run while a session sits idle
+MEMORY_CHECK_SECONDS = 10
+
+# Rows shown in a table preview, kept in sheet order for tables a layout has sorted
+TABLE_PREVIEW_ROWS = 10
+
+# Rows of an approximate result shown while the query is refined
+APPROX_PREVIEW_ROWS = 1000
+
+# Sidebar labels of the Excel readers
+EXCEL_ENGINE_LABELS = {'openpyxl': "🐼 pandas", 'fast': "⚡ Fast", 'streaming': "🌊 Streaming"}
+
 # Custom CSS for enhanced UI styling
 def load_custom_css():
     """
@@ -246,122 +359,1370 @@ def init_session_state():
         st.session_state.current_query = ""
     if 'selected_preview_table' not in st.session_state:
         st.session_state.selected_preview_table = None
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    if 'session_lease' not in st.session_state:
+        # Garbage collected with the session's state, releasing its shared tables
+        st.session_state.session_lease = get_table_store().lease(st.session_state.session_id)
+        # The session's database file and spill directory go away with it too
+        weakref.finalize(
+            st.session_state.session_lease, discard_session_storage, *get_session_storage(st.session_state.session_id)
+        )
+    if 'ingest_engine' not in st.session_state:
+        st.session_state.ingest_engine = 'openpyxl'  # One of EXCEL_ENGINES
+    if 'upload_digests' not in st.session_state:
+        st.session_state.upload_digests = {}  # Dict: {file_id: sha256}
+    if 'table_digests' not in st.session_state:
+        st.session_state.table_digests = {}  # Dict: {table_name: sha256 of source file}
+    if 'table_sources' not in st.session_state:
+        st.session_state.table_sources = {}  # Dict: {table_name: {'path', 'format', 'size'}} for CSV/Parquet views
+    if 'spilled_tables' not in st.session_state:
+        st.session_state.spilled_tables = {}  # Dict: {table_name: {'bytes', 'time'}} for tables spilled to Parquet; the file is in table_sources
+    if 'table_last_used' not in st.session_state:
+        st.session_state.table_last_used = {}  # Dict: {table_name: time of its last upload, query or preview}
+    if 'table_meta' not in st.session_state:
+        st.session_state.table_meta = {}  # Dict: {table_name: {'version', 'rows', 'columns', 'dtypes', 'bytes'}}
+    if 'derived_tables' not in st.session_state:
+        st.session_state.derived_tables = {}  # Dict: {table_name: {'query', 'sources': {source table: version}}} for saved results
+    if 'table_layouts' not in st.session_state:
+        st.session_state.table_layouts = {}  # Dict: {table_name: {'sort', 'indexes', 'status', 'job', 'probe', 'head', 'before', 'after', ...}} from plan_table_layouts
+    if 'table_versions' not in st.session_state:
+        st.session_state.table_versions = {}  # Dict: {table_name: content version used by the result cache}
+    if 'last_result' not in st.session_state:
+        st.session_state.last_result = None  # Dict describing the result table of the last query
+    if 'result_page' not in st.session_state:
+        st.session_state.result_page = 1
+    if 'query_run' not in st.session_state:
+        st.session_state.query_run = None  # Dict: {'query', 'info', 'timer', 'start_time', 'job', 'approximate', 'versions'} while a query is queued or running
+    if 'approximate_mode' not in st.session_state:
+        st.session_state.approximate_mode = False
+    if 'approx_result' not in st.session_state:
+        st.session_state.approx_result = None  # Latest estimate of an approximate run stopped early
+    if 'query_profile' not in st.session_state:
+        st.session_state.query_profile = None  # EXPLAIN ANALYZE profile of the last result's query
+    if 'query_timeout' not in st.session_state:
+        st.session_state.query_timeout = QUERY_TIMEOUT_SECONDS
+    if 'query_memory_limit_mb' not in st.session_state:
+        st.session_state.query_memory_limit_mb = QUERY_MEMORY_LIMIT_MB
+    if 'query_threads' not in st.session_state:
+        st.session_state.query_threads = QUERY_THREADS
+
+def get_upload_digest(uploaded_file):
+    """Return the SHA-256 of an uploaded file's bytes, memoized per upload in session state"""
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if file_id in st.session_state.upload_digests:
+        return st.session_state.upload_digests[file_id]
+    
+    digest = file_digest(uploaded_file)
+    if file_id is not None:
+        st.session_state.upload_digests[file_id] = digest
+    return digest
+
+@st.cache_resource(show_spinner=False)
+def get_ingest_pool():
+    """Process pool shared by all sessions for parsing workbooks in parallel"""
+    # Spawn rather than fork: forking a threaded Streamlit/DuckDB process is unsafe
+    return ProcessPoolExecutor(
+        max_workers=INGEST_MAX_WORKERS,
+        mp_context=multiprocessing.get_context('spawn')
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_table_store():
+    """Table store shared by all sessions, so identical uploads are held only once"""
+    return SharedTableStore()
 
-def is_select_query(query):
+def get_table_version(digest, engine=None):
+    """Content version of a table loaded from a file with the given digest, by default under the current ingest engine"""
+    engine = engine or st.session_state.ingest_engine
+    return f"{digest}:{engine}"
+
+def store_uploaded_table(table_name, table, digest, source=None):
     """
-    Check if the query is a SELECT statement only.
-    This function blocks potentially harmful SQL operations.
+    Add a freshly loaded table to the session, register it and report success.
+    With disk storage, Arrow tables are written into the session's database
+    file; otherwise they go through the shared table store, which hands back
+    the copy other sessions already hold when the content is the same.
     """
-    # Remove comments and normalize whitespace
-    cleaned_query = re.sub(r'--.*$', '', query, flags=re.MULTILINE)
-    cleaned_query = re.sub(r'/\*.*?\*/', '', cleaned_query, flags=re.DOTALL)
-    cleaned_query = cleaned_query.strip().upper()
+    version = get_table_version(digest)
+    if isinstance(table, pa.Table) and STORAGE_MODE == 'disk':
+        table = persist_table(get_catalog(), table_name, table)
+    elif isinstance(table, pa.Table):
+        table = get_table_store().add(version, table, st.session_state.session_id)
+    st.session_state.uploaded_tables[table_name] = table
+    st.session_state.table_digests[table_name] = digest
+    st.session_state.table_versions[table_name] = version
+    st.session_state.table_last_used[table_name] = time.time()
+    if not is_catalog_table(table):
+        register_table(get_catalog(), table_name, table)
+    meta = get_table_meta(table_name)
     
-    # Check if query starts with SELECT
-    if not cleaned_query.startswith('SELECT'):
-        return False
+    source_note = {'cache': " from cache", 'shared': " (shared with other sessions)"}.get(source, "")
+    st.success(f"✅ Loaded **{table_name}**{source_note} ({meta['rows']:,} rows × {len(meta['columns'])} columns)")
+
+def attach_file_source(uploaded_file, table_name, digest, source_format):
+    """
+    Spool a CSV or Parquet upload to disk and expose it as a view that DuckDB
+    scans in place, so the file costs almost no memory until it is queried.
+    """
+    with st.spinner(f"🔄 Linking {uploaded_file.name}..."):
+        uploads_dir = os.path.join(get_session_storage(st.session_state.session_id)[1], 'uploads')
+        path = spool_upload_to_disk(uploaded_file, get_source_suffix(uploaded_file.name), uploads_dir)
+        table, error = create_file_view(get_catalog(), table_name, path, source_format)
+    if error:
+        discard_file(path)
+        st.error(f"❌ **Failed to load {uploaded_file.name}**: {error}")
+        return
     
-    # Block dangerous keywords
-    dangerous_keywords = [
-        'INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER', 
-        'TRUNCATE', 'REPLACE', 'MERGE', 'EXEC', 'EXECUTE', 'CALL'
-    ]
+    st.session_state.uploaded_tables[table_name] = table
+    st.session_state.table_digests[table_name] = digest
+    st.session_state.table_versions[table_name] = get_table_version(digest, source_format)
+    st.session_state.table_sources[table_name] = {'path': path, 'format': source_format, 'size': os.path.getsize(path)}
+    # The spooled file goes away with the session at the latest
+    weakref.finalize(st.session_state.session_lease, discard_file, path)
+    meta = get_table_meta(table_name)
+    st.success(f"✅ Linked **{table_name}** ({source_format.upper()} scanned in place, {len(meta['columns'])} columns)")
+
+def release_table_source(table_name):
+    """Forget a table's CSV/Parquet source, or the Parquet file it was spilled to, and delete the file"""
+    st.session_state.spilled_tables.pop(table_name, None)
+    source = st.session_state.table_sources.pop(table_name, None)
+    if source is not None:
+        discard_file(source['path'])
+
+def get_resident_bytes(table_name):
+    """
+    Bytes of RAM a session table holds as an Arrow table; 0 for others. A
+    sorted layout of an upload counts twice: the upload is kept behind it and
+    its sorted copy lives in the in-memory catalog at about the same size.
+    """
+    table = st.session_state.uploaded_tables[table_name]
+    layout = st.session_state.table_layouts.get(table_name)
+    if layout is not None and layout['source'] is not None:
+        return 2 * get_table_meta(table_name)['bytes']
+    if isinstance(table, pa.Table):
+        return get_table_meta(table_name)['bytes']
+    return 0
+
+def spill_table(table_name):
+    """
+    Move an in-memory table to a Parquet file in the session's spill directory.
+    Its view is replaced by one scanning the file in place, so queries keep
+    working unchanged, and this session's reference to the Arrow table is
+    released. Returns an error message, or None on success.
+    """
+    conn = get_catalog()
+    table = st.session_state.uploaded_tables[table_name]
+    version = st.session_state.table_versions.get(table_name)
+    directory = os.path.join(get_session_storage(st.session_state.session_id)[1], 'tables')
+    try:
+        path = spill_table_to_parquet(conn, table_name, directory)
+    except (duckdb.Error, OSError) as e:
+        return f"Could not spill {table_name}: {str(e)}"
+    
+    resident_bytes = get_resident_bytes(table_name)
+    discard_table_layout(table_name, drop_copy=True)
+    if is_catalog_table(table):
+        # A sorted layout made it a native table, which a view cannot replace in place
+        unregister_table(conn, table_name, table)
+    view, error = create_file_view(conn, table_name, path, 'parquet')
+    if error:
+        discard_file(path)
+        source = table if isinstance(table, pa.Table) else get_table_store().get(version)
+        register_table(conn, table_name, source)
+        st.session_state.uploaded_tables[table_name] = source
+        return error
+    st.session_state.uploaded_tables[table_name] = view
+    st.session_state.table_sources[table_name] = {'path': path, 'format': 'parquet', 'size': os.path.getsize(path)}
+    st.session_state.spilled_tables[table_name] = {'bytes': resident_bytes, 'time': time.time()}
+    get_table_store().release(version, st.session_state.session_id)
+    # The file goes away with the session at the latest
+    weakref.finalize(st.session_state.session_lease, discard_file, path)
+    return None
+
+def rehydrate_table(table_name):
+    """
+    Load a spilled table back into memory, taking the copy another session
+    already holds in the shared table store when there is one.
+    """
+    version = st.session_state.table_versions.get(table_name)
+    table = get_table_store().get(version)
+    if table is None:
+        table = pq.read_table(st.session_state.table_sources[table_name]['path'])
+    table = get_table_store().add(version, table, st.session_state.session_id)
+    register_table(get_catalog(), table_name, table)
+    st.session_state.uploaded_tables[table_name] = table
+    release_table_source(table_name)
+
+def enforce_memory_budget():
+    """
+    Keep this session's in-memory tables within SESSION_MEMORY_BUDGET_MB and
+    the tables of all sessions within MEMORY_BUDGET_MB, spilling the least
+    recently used ones to Parquet first. Tables read by a running query stay
+    put. Spilled tables used since they were spilled are loaded back, most
+    recently used first, while they fit. Returns True when anything moved.
+    """
+    session_budget = SESSION_MEMORY_BUDGET_MB * 1024 * 1024
+    global_budget = MEMORY_BUDGET_MB * 1024 * 1024
+    last_used = st.session_state.table_last_used
+    run = st.session_state.query_run
+    in_use = set(run['info']['tables']) if run is not None else set()
     
-    for keyword in dangerous_keywords:
-        if keyword in cleaned_query:
-            return False
+    resident = {name: get_resident_bytes(name) for name in st.session_state.uploaded_tables}
+    resident = {name: nbytes for name, nbytes in resident.items() if nbytes}
+    session_bytes = sum(resident.values())
+    global_bytes = get_table_store().stats()['bytes']
+    changed = False
+    for table_name in sorted(resident, key=lambda name: last_used.get(name, 0)):
+        if session_bytes <= session_budget and global_bytes <= global_budget:
+            break
+        if table_name in in_use:
+            continue
+        version = st.session_state.table_versions.get(table_name)
+        # Memory is only freed server-wide when no other session holds the same table
+        freed = resident[table_name] if get_table_store().session_count(version) <= 1 else 0
+        if spill_table(table_name) is None:
+            session_bytes -= resident[table_name]
+            global_bytes -= freed
+            changed = True
+    if changed:
+        return True
     
-    return True
+    spilled = st.session_state.spilled_tables
+    for table_name in sorted(spilled, key=lambda name: last_used.get(name, 0), reverse=True):
+        nbytes = spilled[table_name]['bytes']
+        if table_name in in_use or last_used.get(table_name, 0) <= spilled[table_name]['time']:
+            # Loading a table back deletes its Parquet file, which a running query may still be scanning
+            continue
+        if session_bytes + nbytes > session_budget or global_bytes + nbytes > global_budget:
+            continue
+        rehydrate_table(table_name)
+        session_bytes += nbytes
+        global_bytes += nbytes
+        changed = True
+    return changed
 
-def load_excel_data(uploaded_file):
-    """Load Excel file and return the first sheet as a pandas DataFrame"""
-    try:
-        # Read only the first sheet
-        df = pd.read_excel(uploaded_file, sheet_name=0, engine='openpyxl')
-        return df, None
-    except Exception as e:
-        return None, f"Error reading Excel file: {str(e)}"
-
-def get_table_name_from_filename(filename):
-    """Extract a clean table name from filename (remove extension and special chars)"""
-    import re
-    # Remove file extension
-    table_name = filename.rsplit('.', 1)[0]
-    # Replace spaces and special characters with underscores
-    table_name = re.sub(r'[^a-zA-Z0-9_]', '_', table_name)
-    # Ensure it starts with a letter or underscore
-    if table_name and not table_name[0].isalpha() and table_name[0] != '_':
-        table_name = 'table_' + table_name
-    return table_name or 'unnamed_table'
+def describe_table_residency(table_name):
+    """Where a session table's rows are kept now, as a short label for the table list"""
+    table = st.session_state.uploaded_tables[table_name]
+    spilled = st.session_state.spilled_tables.get(table_name)
+    if spilled is not None:
+        size = st.session_state.table_sources[table_name]['size']
+        return f"💾 Spilled to disk ({size / 1024 / 1024:.1f} MB Parquet), scanned in place"
+    if is_file_view(table):
+        return f"📄 Scanned in place from its {st.session_state.table_sources[table_name]['format'].upper()} file"
+    resident_bytes = get_resident_bytes(table_name)
+    layout = st.session_state.table_layouts.get(table_name)
+    if resident_bytes and layout is not None and layout['source'] is not None:
+        return f"🧠 In memory ({resident_bytes / 1024 / 1024:.1f} MB with its sorted copy)"
+    if resident_bytes:
+        return f"🧠 In memory ({resident_bytes / 1024 / 1024:.1f} MB)"
+    return "🗄️ In the session database file" if STORAGE_MODE == 'disk' else "🦆 In DuckDB memory"
+
+@st.fragment(run_every=MEMORY_CHECK_SECONDS)
+def display_memory_budget():
+    """
+    Check the memory budget every MEMORY_CHECK_SECONDS, so idle sessions
+    spill their tables too, swap in sorted layouts finished since the last
+    page run, and show this session's and the server's table memory.
+    """
+    swapped = collect_table_layouts()
+    if enforce_memory_budget() or swapped:
+        st.rerun()
+    session_bytes = sum(get_resident_bytes(name) for name in st.session_state.uploaded_tables)
+    global_bytes = get_table_store().stats()['bytes']
+    st.caption(
+        f"🧠 Tables in memory: {session_bytes / 1024 / 1024:,.0f} of {SESSION_MEMORY_BUDGET_MB:,} MB for this session, "
+        f"{global_bytes / 1024 / 1024:,.0f} of {MEMORY_BUDGET_MB:,} MB on the server"
+    )
+
+def get_table_meta(table_name):
+    """
+    Rows, columns, dtypes and bytes of a session table, computed once per table
+    version so that page runs never rescan tables. CSV/Parquet views are left
+    uncounted (rows is None), since counting one scans the whole file; the count
+    an approximate query takes of them is kept (see remember_row_counts).
+    """
+    version = st.session_state.table_versions.get(table_name)
+    meta = st.session_state.table_meta.get(table_name)
+    if meta is None or meta['version'] != version:
+        table = st.session_state.uploaded_tables[table_name]
+        meta = {'version': version, **describe_table(table, count_rows=not is_file_view(table))}
+        st.session_state.table_meta[table_name] = meta
+    return meta
+
+def describe_row_count(table_name):
+    """Row count of a session table for display; CSV/Parquet views show as not counted until a count is known"""
+    rows = get_table_meta(table_name)['rows']
+    return "not counted" if rows is None else f"{rows:,}"
+
+def remember_row_counts(run):
+    """Keep the row counts an approximate run took of CSV/Parquet views it sampled, if the tables are unchanged"""
+    job = run['job']
+    if job is None or not job.partial_results:
+        return
+    for table_name, (_, rows) in job.partial_results[-1]['sampled'].items():
+        if st.session_state.table_versions.get(table_name) != run['versions'].get(table_name):
+            continue
+        meta = get_table_meta(table_name)
+        if meta['rows'] is None:
+            meta['rows'] = rows
+
+def ingest_uploads(pending):
+    """
+    Load new uploads given as (uploaded_file, table_name, digest) tuples.
+    CSV and Parquet files are linked as views. For workbooks, tables another
+    session already holds are shared and cache hits are loaded directly;
+    the rest are parsed in the process pool when there are several,
+    reporting each file as it finishes.
+    """
+    conn = get_catalog()
+    engine = st.session_state.ingest_engine
+    streaming = engine == 'streaming'
+    # Cache hits go straight into DuckDB when tables are stored there anyway
+    into_catalog = streaming or STORAGE_MODE == 'disk'
+    options = {'engine': engine, 'sheet': 0}
+    
+    to_parse = []
+    for uploaded_file, table_name, digest in pending:
+        source_format = get_source_format(uploaded_file.name)
+        if source_format is None:
+            st.error(f"❌ **Failed to load {uploaded_file.name}**: Unsupported file type. Upload .xlsx, .csv, .csv.gz or .parquet files.")
+            continue
+        if source_format != 'xlsx':
+            attach_file_source(uploaded_file, table_name, digest, source_format)
+            continue
+        
+        shared = None if into_catalog else get_table_store().get(get_table_version(digest))
+        if shared is not None:
+            store_uploaded_table(table_name, shared, digest, source='shared')
+            continue
+        
+        cache_path = get_ingest_cache_path(digest, options)
+        table = read_ingest_cache(cache_path, conn, table_name, into_catalog)
+        if table is not None:
+            store_uploaded_table(table_name, table, digest, source='cache')
+        else:
+            to_parse.append((uploaded_file, table_name, digest, cache_path))
+    
+    if not to_parse:
+        return
+    
+    if len(to_parse) == 1 or INGEST_MAX_WORKERS == 1:
+        for uploaded_file, table_name, digest, cache_path in to_parse:
+            # Show loading animation
+            with st.spinner(f"🔄 Loading {uploaded_file.name}..."):
+                if streaming:
+                    table, error = stream_excel_to_duckdb(uploaded_file, conn, table_name)
+                else:
+                    table, error = read_excel_table(uploaded_file, engine)
+            
+            if error:
+                st.error(f"❌ **Failed to load {uploaded_file.name}**: {error}")
+                continue
+            
+            write_ingest_cache(cache_path, conn, table)
+            store_uploaded_table(table_name, table, digest)
+        return
+    
+    pool = get_ingest_pool()
+    progress = st.progress(0.0, text=f"🔄 Loading {len(to_parse)} files in parallel...")
+    futures = {}
+    for item in to_parse:
+        uploaded_file, _, _, cache_path = item
+        path = spool_upload_to_disk(uploaded_file, '.xlsx')
+        futures[pool.submit(parse_workbook_to_cache, path, cache_path, engine)] = item
+    
+    pool_broken = False
+    for done, future in enumerate(as_completed(futures), start=1):
+        uploaded_file, table_name, digest, cache_path = futures[future]
+        try:
+            error = future.result()
+        except BrokenProcessPool:
+            pool_broken = True
+            error = "The parsing worker crashed (the file may be too large for available memory)"
+        except Exception as e:
+            error = f"Error reading Excel file: {str(e)}"
+        
+        if error is None:
+            table = read_ingest_cache(cache_path, conn, table_name, into_catalog)
+            if table is None:
+                error = "Error loading parsed table from the ingest cache"
+        
+        if error:
+            st.error(f"❌ **Failed to load {uploaded_file.name}**: {error}")
+        else:
+            store_uploaded_table(table_name, table, digest)
+        progress.progress(done / len(futures), text=f"🔄 Loaded {done} of {len(futures)} files")
+    progress.empty()
+    
+    if pool_broken:
+        # A dead worker breaks the whole pool; start a fresh one next time
+        get_ingest_pool.clear()
+
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    """Query result cache shared by all sessions"""
+    return ResultCache()
+
+@st.cache_resource(show_spinner=False)
+def get_sample_cache():
+    """Table samples for approximate queries, shared by all sessions and keyed by table version"""
+    return ResultCache(max_bytes=SAMPLE_CACHE_MAX_BYTES, spill_dir=None)
+
+def forget_table_version(table_name):
+    """Drop a table's version, metadata and layout, every cached result computed from it and this session's shared reference"""
+    st.session_state.table_meta.pop(table_name, None)
+    discard_table_layout(table_name, drop_copy=True)
+    version = st.session_state.table_versions.pop(table_name, None)
+    if version is not None:
+        get_result_cache().invalidate(version)
+        get_sample_cache().invalidate(version)
+        get_table_store().release(version, st.session_state.session_id)
+
+@st.cache_resource(max_entries=SESSION_CATALOG_MAX_ENTRIES, show_spinner=False)
+def get_session_catalog(session_id):
+    """
+    Create the long-lived DuckDB connection that backs one user session: an
+    in-memory database, or the session's database file with disk storage.
+    Either way, large queries spill to the session's spill directory, which is
+    also the only place its queries may read or write files: uploads scanned in
+    place, spilled tables and exports all live there.
+    """
+    database_path, spill_dir = get_session_storage(session_id)
+    conn = open_database(database_path, QUERY_MEMORY_LIMIT_MB, spill_dir)
+    restrict_file_access(conn, [spill_dir])
+    return conn
+
+def close_connection(conn_ref):
+    """Close a DuckDB connection given by a weak reference, if it still exists"""
+    conn = conn_ref()
+    if conn is not None:
+        conn.close()
+
+def get_catalog():
+    """
+    Return this session's DuckDB connection.
+    If the cached connection was evicted and recreated, all session tables are registered again.
+    """
+    conn = get_session_catalog(st.session_state.session_id)
+    catalog_ref = st.session_state.get('catalog_ref')
+    if catalog_ref is None or catalog_ref() is not conn:
+        if catalog_ref is not None:
+            # The evicted connection may still be alive through stale relations; close it so its views stop pinning shared tables
+            close_connection(catalog_ref)
+        for table_name, table in list(st.session_state.uploaded_tables.items()):
+            layout = st.session_state.table_layouts.get(table_name)
+            if layout is not None and (layout['job'] is not None or layout['source'] is not None):
+                # Layout work in flight is abandoned; sorted uploads lived in the evicted connection and go back to their Arrow table
+                discard_table_layout(table_name)
+                if layout['source'] is not None:
+                    table = st.session_state.uploaded_tables[table_name] = layout['source']
+            source = st.session_state.table_sources.get(table_name)
+            if source is not None:
+                # File-backed views are recreated over the spooled file
+                view, error = create_file_view(conn, table_name, source['path'], source['format'])
+                if error is None:
+                    st.session_state.uploaded_tables[table_name] = view
+                    continue
+                release_table_source(table_name)
+            if is_catalog_table(table):
+                # Tables in a database file are still there; in-memory ones lived only in the evicted connection
+                try:
+                    st.session_state.uploaded_tables[table_name] = conn.table(table_name)
+                    continue
+                except duckdb.CatalogException:
+                    pass
+                del st.session_state.uploaded_tables[table_name]
+                st.session_state.table_digests.pop(table_name, None)
+                st.session_state.table_versions.pop(table_name, None)
+                st.session_state.table_meta.pop(table_name, None)
+                st.session_state.derived_tables.pop(table_name, None)
+                discard_table_layout(table_name)
+                st.warning(f"⚠️ Table **{table_name}** expired from the server cache. Please upload it again.")
+            else:
+                register_table(conn, table_name, table)
+        # The last query result lived in the evicted connection too
+        st.session_state.last_result = None
+        st.session_state.catalog_ref = weakref.ref(conn)
+        # Close the connection when the session expires; the weak reference lets an evicted one go sooner
+        weakref.finalize(st.session_state.session_lease, close_connection, weakref.ref(conn))
+    return conn
+
+def get_table_head(table, n=10):
+    """Return the first n rows of a table as a DataFrame"""
+    if is_catalog_table(table):
+        return table.limit(n).df()
+    if isinstance(table, pa.Table):
+        return table.slice(0, n).to_pandas()
+    return table.head(n)
+
+@st.cache_data(max_entries=PROFILE_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_cached_table_profile(_conn, table_name, version):
+    """Profile a table once per content version (the connection is not part of the cache key)"""
+    return profile_table(_conn, table_name)
+
+def load_table_profile(table_name):
+    """Return (total_rows, column_profile, histograms) for a session table"""
+    conn = get_catalog()
+    version = st.session_state.table_versions.get(table_name)
+    if version is None:
+        return profile_table(conn, table_name)
+    return get_cached_table_profile(conn, table_name, version)
 
 def delete_table(table_name):
     """Remove a table from uploaded_tables and update session state"""
     if table_name in st.session_state.uploaded_tables:
+        unregister_table(get_catalog(), table_name, st.session_state.uploaded_tables[table_name])
         del st.session_state.uploaded_tables[table_name]
+        st.session_state.table_digests.pop(table_name, None)
+        forget_table_version(table_name)
+        release_table_source(table_name)
+        st.session_state.derived_tables.pop(table_name, None)
         # Clear preview selection if it was the deleted table
         if st.session_state.selected_preview_table == table_name:
             st.session_state.selected_preview_table = None
         st.rerun()
 
-def execute_sql_query_multi_table(uploaded_tables, query):
-    """Execute SQL query on multiple tables using DuckDB"""
+def get_query_limits():
+    """Collect this session's query limits from the sidebar settings"""
+    return {
+        'timeout': st.session_state.query_timeout,
+        'memory_limit_mb': st.session_state.query_memory_limit_mb,
+        'threads': st.session_state.query_threads
+    }
+
+def execute_sql_query_to_result_table(uploaded_tables, query, conn, limits=None, on_tick=None, target=RESULT_TABLE):
+    """
+    Execute SQL query into the session's result table (or another quoted table
+    name given as target) instead of a DataFrame.
+    Rows stay inside DuckDB, so only the page being viewed is converted to pandas.
+    The query runs under the given time, memory and thread limits and can be
+    interrupted; on_tick(elapsed_seconds, progress) is called while it runs.
+    Returns (row_count, error).
+    """
+    limits = limits or {}
+    
+    def work(cursor):
+        cursor.execute(f'CREATE OR REPLACE TABLE {target} AS {query.strip().rstrip(";")}')
+        return cursor.execute(f'SELECT count(*) FROM {target}').fetchone()[0]
+    
+    # This runs on a pool worker, so it must not share the session connection with the script thread
+    cursor = conn.cursor()
     try:
-        # Check if query is a SELECT statement
-        if not is_select_query(query):
-            return None, "Only SELECT statements are allowed for security reasons."
-        
-        if not uploaded_tables:
-            return None, "No tables available. Please upload at least one Excel file."
-        
-        # Create DuckDB connection
-        conn = duckdb.connect(':memory:')
-        
-        # Register all tables with their respective names
-        for table_name, df in uploaded_tables.items():
-            conn.register(table_name, df)
-        
-        # Execute the query
-        result = conn.execute(query).fetchdf()
-        conn.close()
-        
-        return result, None
+        error = validate_query(uploaded_tables, query, cursor)
+        if error:
+            return None, error
+        apply_query_limits(cursor, limits.get('memory_limit_mb'), limits.get('threads'))
+        if on_tick is not None:
+            enable_query_progress(cursor)
+        cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {RESULT_SCHEMA}')
+        row_count = run_interruptible(cursor, work, timeout=limits.get('timeout'), on_tick=on_tick)
+        return row_count, None
+    except QueryTimeoutError as e:
+        return None, f"Query stopped after exceeding the {e.timeout:g} second time limit. Try filtering or aggregating the data further."
+    except duckdb.OutOfMemoryException:
+        return None, f"Query stopped after exceeding the {limits.get('memory_limit_mb'):,} MB memory limit. Try filtering or aggregating the data further."
+    except (duckdb.InterruptException, QueryCancelledError):
+        return None, "Query was cancelled."
     except Exception as e:
         return None, f"SQL execution error: {str(e)}"
+    finally:
+        cursor.close()
+
+def fetch_result_arrow(conn, max_bytes):
+    """Fetch the result table as an Arrow table, or None if it is larger than max_bytes"""
+    cursor = conn.cursor()
+    try:
+        reader = cursor.execute(f'SELECT * FROM {RESULT_TABLE}').fetch_record_batch()
+        batches, total_bytes = [], 0
+        for batch in reader:
+            total_bytes += batch.nbytes
+            if total_bytes > max_bytes:
+                return None
+            batches.append(batch)
+        return pa.Table.from_batches(batches, schema=reader.schema)
+    finally:
+        cursor.close()
+
+def load_cached_result(conn, table):
+    """Copy a cached Arrow result into the session's result table"""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {RESULT_SCHEMA}')
+        cursor.register('cached_result', table)
+        cursor.execute(f'CREATE OR REPLACE TABLE {RESULT_TABLE} AS SELECT * FROM cached_result')
+    finally:
+        cursor.close()
+
+def get_query_versions(info):
+    """
+    Return (versions of the tables a query reads, result cache key) for a query
+    analysis. Only deterministic queries over versioned tables get a key.
+    """
+    versions = {name: st.session_state.table_versions.get(name) for name in info['tables']}
+    cache_key = None
+    if info['deterministic'] and all(versions.values()):
+        cache_key = make_result_cache_key(info['ast'], versions)
+    return versions, cache_key
+
+def get_derived_version(cache_key):
+    """
+    Content version of a saved result. Results of cacheable queries are
+    versioned by their cache key, so saving the same result again keeps it.
+    """
+    return f"derived:{cache_key or uuid.uuid4().hex}"
+
+def save_result_as_table(table_name):
+    """
+    Materialize the last query result as a session table that later queries can use.
+    The query and the versions of the tables it read are kept, so the table
+    can be flagged stale and refreshed when a source changes.
+    Returns an error message, or None on success.
+    """
+    result = st.session_state.last_result
+    if not is_valid_table_name(table_name):
+        return "Use letters, digits and underscores only, starting with a letter or underscore."
+    # DuckDB table names are case-insensitive, so SALES would replace sales
+    existing = next((name for name in st.session_state.uploaded_tables if name.lower() == table_name.lower()), None)
+    if existing is not None and existing not in st.session_state.derived_tables:
+        return f"**{existing}** is already an uploaded table. Choose another name."
+    if existing is not None and existing != table_name:
+        return f"A saved result is already named **{existing}**. Use that name to replace it."
+    source = next((name for name in result['sources'] if name.lower() == table_name.lower()), None)
+    if source is not None:
+        return f"The query reads **{source}**, so its result cannot replace it."
+    
+    conn = get_catalog()
+    try:
+        conn.execute(f'CREATE OR REPLACE TABLE {quote_identifier(table_name)} AS SELECT * FROM {RESULT_TABLE}')
+    except duckdb.Error as e:
+        return f"Could not save the result: {str(e)}"
+    forget_table_version(table_name)
+    st.session_state.uploaded_tables[table_name] = conn.table(table_name)
+    st.session_state.table_versions[table_name] = get_derived_version(result['cache_key'])
+    st.session_state.derived_tables[table_name] = {'query': result['query'], 'sources': dict(result['sources'])}
+    return None
+
+def get_stale_sources(table_name):
+    """Source tables of a saved result that were replaced or deleted since it was computed"""
+    sources = st.session_state.derived_tables[table_name]['sources']
+    return [
+        name for name, version in sources.items()
+        if name not in st.session_state.uploaded_tables or st.session_state.table_versions.get(name) != version
+    ]
+
+def refresh_derived_table(table_name):
+    """
+    Recompute a saved result from its query over the current source tables.
+    Tables saved from it become stale in turn. Returns an error message, or None on success.
+    """
+    derived = st.session_state.derived_tables[table_name]
+    conn = get_catalog()
+    sources = {name: table for name, table in st.session_state.uploaded_tables.items() if name != table_name}
+    cursor = conn.cursor()
+    try:
+        info, error = analyze_query(sources, derived['query'], cursor)
+    finally:
+        cursor.close()
+    if error:
+        return error
+    
+    versions, cache_key = get_query_versions(info)
+    _, error = execute_sql_query_to_result_table(
+        sources, derived['query'], conn, limits=get_query_limits(), target=quote_identifier(table_name)
+    )
+    if error:
+        return error
+    forget_table_version(table_name)
+    st.session_state.uploaded_tables[table_name] = conn.table(table_name)
+    st.session_state.table_versions[table_name] = get_derived_version(cache_key)
+    derived['sources'] = versions
+    return None
 
-# Keep the old function for backward compatibility
-def execute_sql_query(df, query):
-    """Execute SQL query on a single DataFrame using DuckDB (legacy function)"""
+@st.cache_resource(show_spinner=False)
+def get_query_pool():
+    """Query workers shared by all sessions, bounding how many queries run at once"""
+    return QueryPool()
+
+def is_heavy_query(info):
+    """Tell whether a query reads enough rows to count against the query pool's heavy-query cap"""
+    total_rows = 0
+    for table_name in info['tables']:
+        rows = get_table_meta(table_name)['rows']
+        if rows is None:
+            # A CSV/Parquet file that was never counted; counting it here would cost a full scan
+            return True
+        total_rows += rows
+    return total_rows >= QUERY_HEAVY_ROWS
+
+def run_query_job(job, uploaded_tables, query, conn, limits, cache, cache_key, versions, timer):
+    """
+    Query pool task: run a query into the result table and store the result in the cache.
+    It runs on a pool worker without access to session state, so everything comes in as arguments.
+    Returns (row_count, error).
+    """
+    timer.phases["Waiting for a query worker"] = job.started - job.submitted
+    with timer.phase("DuckDB execution"):
+        row_count, error = execute_sql_query_to_result_table(
+            uploaded_tables, query, conn, limits=limits, on_tick=job.tick
+        )
+    if error is None and cache_key is not None:
+        with timer.phase("Result cache store"):
+            result = fetch_result_arrow(conn, cache.max_entry_bytes)
+            if result is not None:
+                cache.put(cache_key, result, versions.values())
+    return row_count, error
+
+def run_approximate_stages(job, uploaded_tables, query, conn, limits, table_rows, versions, aggregates):
+    """
+    First part of an approximate-mode pool task: run the query over growing
+    random samples of the tables it reads, publishing each estimate in
+    job.partial_results. Samples come from the shared sample cache when the
+    table version was sampled before. table_rows maps each table read to its
+    row count, or None for CSV/Parquet views not counted yet. Each stage runs
+    on a session cursor under the query limits, with the samples registered
+    in place of the tables. The output columns at the positions in aggregates
+    (see find_scalable_aggregates) are scaled up by the sampling fraction.
+    If estimating fails, job.warning says why and the exact run goes ahead.
+    """
+    sample_cache = get_sample_cache()
+    cursor = conn.cursor()
     try:
-        if not is_select_query(query):
-            return None, "Only SELECT statements are allowed for security reasons."
+        apply_query_limits(cursor, limits['memory_limit_mb'], limits['threads'])
+        table_rows = dict(table_rows)
+        for table_name, rows in table_rows.items():
+            if rows is None:
+                count_query = f'SELECT count(*) FROM {quote_identifier(table_name)}'
+                table_rows[table_name] = run_interruptible(
+                    cursor, lambda cur: cur.execute(count_query).fetchone()[0], timeout=limits['timeout'], on_tick=job.tick
+                )
         
-        conn = duckdb.connect(':memory:')
-        conn.register('df', df)
-        result = conn.execute(query).fetchdf()
-        conn.close()
+        largest = max(table_rows.values(), default=0)
+        stages = [rows for rows in APPROX_SAMPLE_ROWS if rows <= largest * APPROX_MAX_SAMPLE_SHARE]
+        for stage, sample_rows in enumerate(stages, start=1):
+            start_time = time.perf_counter()
+            samples, sampled = {}, {}
+            for table_name, rows in table_rows.items():
+                table = uploaded_tables[table_name]
+                if isinstance(table, pa.Table) and rows <= sample_rows:
+                    samples[table_name] = table
+                    continue
+                key = f"{versions[table_name]}:sample:{sample_rows}" if versions.get(table_name) else None
+                sample = sample_cache.get(key) if key else None
+                if sample is None:
+                    sample = run_interruptible(
+                        cursor, lambda cur: sample_table(cur, table_name, sample_rows, rows),
+                        timeout=limits['timeout'], on_tick=job.tick
+                    )
+                    if key:
+                        sample_cache.put(key, sample, [versions[table_name]])
+                samples[table_name] = sample
+                if sample.num_rows < rows:
+                    sampled[table_name] = (sample.num_rows, rows)
+            
+            def run_stage(cur):
+                # The samples shadow the session's views on this cursor only, so the query runs on them unchanged
+                for table_name, sample in samples.items():
+                    cur.register(table_name, sample)
+                try:
+                    return cur.execute(query).fetch_df()
+                finally:
+                    for table_name in samples:
+                        cur.unregister(table_name)
+            
+            result = run_interruptible(cursor, run_stage, timeout=limits['timeout'], on_tick=job.tick)
+            scale = math.prod(rows / sample_rows for sample_rows, rows in sampled.values())
+            scaled = []
+            if aggregates and scale > 1:
+                for position in aggregates:
+                    values = pd.to_numeric(result.iloc[:, position]) * scale
+                    if pd.api.types.is_integer_dtype(result.iloc[:, position]):
+                        values = values.round().astype('int64')
+                    result.isetitem(position, values)
+                    scaled.append(result.columns[position])
+            job.partial_results.append({
+                'stage': stage,
+                'stages': len(stages),
+                'sampled': sampled,
+                'scaled': scaled if aggregates is not None else None,
+                'result': result,
+                'seconds': time.perf_counter() - start_time
+            })
+            job.tick(job.elapsed(), None)
+    except QueryTimeoutError as e:
+        job.warning = f"Estimates stopped after exceeding the {e.timeout:g} second time limit; computing the exact answer."
+    except duckdb.Error as e:
+        job.warning = f"Estimates stopped: {str(e)}. Computing the exact answer."
+    finally:
+        cursor.close()
+
+def run_query_cached(query, timer=None, approximate=False):
+    """
+    Start a query run into the result table, serving it from the shared result cache when possible.
+    The cache key is the parsed query plus the version of every table it reads.
+    On a cache miss the query is queued on the shared query pool instead of running here;
+    with approximate, it first runs over growing samples (see run_approximate_stages).
+    Each phase of the run is recorded in timer, a PhaseTimer, when one is given.
+    Returns (job, row_count, error, info): job is the queued QueryJob, or None when
+    the result came from the cache (row_count is set) or validation failed (error is set).
+    info is the query analysis from analyze_query (tables and columns read).
+    """
+    timer = timer or PhaseTimer()
+    with timer.phase("Session catalog"):
+        conn = get_catalog()
+    uploaded_tables = st.session_state.uploaded_tables
+    
+    with timer.phase("Validation & parsing"):
+        cursor = conn.cursor()
+        try:
+            info, error = analyze_query(uploaded_tables, query, cursor)
+        finally:
+            cursor.close()
+        if error:
+            return None, None, error, None
+        
+        versions, cache_key = get_query_versions(info)
+        for table_name in info['tables']:
+            st.session_state.table_last_used[table_name] = time.time()
+    
+    cache = get_result_cache()
+    if cache_key is not None:
+        with timer.phase("Result cache lookup"):
+            cached = cache.get(cache_key)
+        if cached is not None:
+            with timer.phase("Load cached result"):
+                load_cached_result(conn, cached)
+            return None, cached.num_rows, None, info
+    
+    # The worker gets a snapshot of the table list, which the sidebar may change meanwhile
+    tables, limits = dict(uploaded_tables), get_query_limits()
+    
+    def run_exact(job):
+        return run_query_job(job, tables, query, conn, limits, cache, cache_key, versions, timer)
+    
+    task = run_exact
+    if approximate:
+        table_rows = {name: get_table_meta(name)['rows'] for name in info['tables']}
+        aggregates = find_scalable_aggregates(info['ast'])
         
-        return result, None
+        def task(job):
+            timer.phases["Waiting for a query worker"] = job.started - job.submitted
+            with timer.phase("Approximate estimates"):
+                run_approximate_stages(job, tables, query, conn, limits, table_rows, versions, aggregates)
+            return run_exact(job)
+    job = get_query_pool().submit(task, heavy=is_heavy_query(info))
+    return job, None, None, info
+
+def finish_query_run(run, row_count, error):
+    """
+    Record the outcome of a query run: the last result and history on success,
+    or the error to show once on the next page run.
+    """
+    st.session_state.query_run = None
+    remember_row_counts(run)
+    job = run['job']
+    if job is not None and (job.status == 'cancelled' or job.cancel_requested):
+        st.session_state.query_notice = ('cancelled', None)
+        st.session_state.last_result = None
+        if job.partial_results:
+            # Stopping an approximate run keeps its latest estimate on screen
+            st.session_state.approx_result = {'query': run['query'], **job.partial_results[-1]}
+        return
+    
+    query = run['query']
+    if error:
+        st.session_state.last_result = None
+        st.session_state.query_notice = ('error', error)
+        add_to_query_history(query, error=error)
+        return
+    
+    if job is not None and job.warning:
+        st.session_state.query_notice = ('warning', job.warning)
+    add_to_query_history(query, result_count=row_count, key_columns=resolve_key_columns(run['info']))
+    plan_table_layouts()
+    sources, cache_key = get_query_versions(run['info'])
+    st.session_state.last_result = {
+        'query': query,
+        'row_count': row_count,
+        'column_count': len(get_catalog().table(RESULT_TABLE).columns),
+        'execution_time': time.time() - run['start_time'],
+        'cache_hit': job is None,
+        'timings': run['timer'].phases,
+        'reads': describe_query_reads(run['info']),
+        'sources': sources,
+        'cache_key': cache_key
+    }
+    st.session_state.result_page = 1
+    st.session_state.query_profile = None
+
+def resolve_key_columns(info):
+    """
+    The session table columns a query filters or joins on, as sorted
+    (table, column, kind) tuples with kinds as in find_key_columns.
+    Unqualified columns are matched to each table read that has them.
+    """
+    usages, aliases = find_key_columns(info['ast'])
+    tables = {name.lower(): name for name in info['tables']}
+    columns = {name: {column.lower(): column for column in get_table_meta(name)['columns']} for name in info['tables']}
+    key_columns = set()
+    for qualifier, column, kind in usages:
+        if qualifier is None:
+            candidates = info['tables']
+        else:
+            table_name = tables.get(aliases.get(qualifier.lower(), qualifier).lower())
+            candidates = [table_name] if table_name else []
+        for table_name in candidates:
+            if column.lower() in columns[table_name]:
+                key_columns.add((table_name, columns[table_name][column.lower()], kind))
+    return sorted(key_columns)
+
+def get_workload_usage():
+    """
+    Count how the last LAYOUT_HISTORY_QUERIES successful queries used key columns.
+    Returns (usage, probes): usage maps tables to {column: Counter of kinds},
+    probes maps (table, column) to the latest query that filtered or joined on it.
+    """
+    usage, probes = {}, {}
+    history = [item for item in st.session_state.query_history if item['success']]
+    for item in history[-LAYOUT_HISTORY_QUERIES:]:
+        for table_name, column, kind in item.get('key_columns', []):
+            usage.setdefault(table_name, {}).setdefault(column, Counter())[kind] += 1
+            probes[(table_name, column)] = item['query']
+    return usage, probes
+
+def run_layout_build(job, conn, table_name, sort_columns, probe, limits):
+    """
+    Layout pool task: time the probe query on the table as it is and keep its
+    first rows for the preview, which must stay in sheet order, then write a
+    sorted copy of it. Like run_query_job it runs without session state.
+    Returns (copy_name, seconds_before, head).
+    """
+    head_query = f'SELECT * FROM {quote_identifier(table_name)} LIMIT {TABLE_PREVIEW_ROWS}'
+    cursor = conn.cursor()
+    try:
+        apply_query_limits(cursor, limits['memory_limit_mb'], limits['threads'])
+        before = run_interruptible(cursor, lambda cur: time_query(cur, probe), timeout=limits['timeout'], on_tick=job.tick)
+        head = run_interruptible(cursor, lambda cur: cur.execute(head_query).fetch_df(), timeout=limits['timeout'], on_tick=job.tick)
+        copy_name = run_interruptible(
+            cursor, lambda cur: build_sorted_copy(cur, table_name, sort_columns), timeout=limits['timeout'], on_tick=job.tick
+        )
+    finally:
+        cursor.close()
+    return copy_name, before, head
+
+def run_layout_indexes(job, conn, table_name, index_columns, probe, limits, time_before):
+    """
+    Layout pool task: index columns of a native table, then time the probe
+    query on the new layout (and first on the old one with time_before).
+    Columns DuckDB cannot index are skipped.
+    Returns (indexed_columns, seconds_before, seconds_after).
+    """
+    cursor = conn.cursor()
+    try:
+        apply_query_limits(cursor, limits['memory_limit_mb'], limits['threads'])
+        before = None
+        if time_before:
+            before = run_interruptible(cursor, lambda cur: time_query(cur, probe), timeout=limits['timeout'], on_tick=job.tick)
+        indexed = []
+        for column in index_columns:
+            try:
+                run_interruptible(
+                    cursor, lambda cur: create_key_index(cur, table_name, column), timeout=limits['timeout'], on_tick=job.tick
+                )
+                indexed.append(column)
+            except duckdb.Error:
+                continue
+        after = run_interruptible(cursor, lambda cur: time_query(cur, probe), timeout=limits['timeout'], on_tick=job.tick)
+    finally:
+        cursor.close()
+    return indexed, before, after
+
+def start_layout_indexes(table_name, layout, index_columns, probe, time_before):
+    """Queue the index and timing step of a table's layout on the query pool"""
+    conn, limits = get_catalog(), get_query_limits()
+    layout['planned_indexes'] = index_columns
+    layout['status'] = 'indexing'
+    layout['job'] = get_query_pool().submit(
+        lambda job: run_layout_indexes(job, conn, table_name, index_columns, probe, limits, time_before), heavy=True
+    )
+
+def plan_table_layouts():
+    """
+    Reorganize a session table for the filters and joins its recent queries
+    use, in the background: choose_table_layout picks a sort order and
+    indexes from the query history for each table of at least
+    LAYOUT_MIN_ROWS rows, and the work is queued on the query pool.
+    A table is sorted once per version; indexes that become hot later are
+    added to it. One layout job runs per session at a time, and CSV/Parquet
+    views, which are scanned in place, are left alone. An upload is only sorted
+    while its sorted copy fits in the session's memory budget.
+    """
+    layouts = st.session_state.table_layouts
+    if not AUTO_LAYOUT or any(layout['job'] is not None for layout in layouts.values()):
+        return
+    usage, probes = get_workload_usage()
+    for table_name, column_counts in usage.items():
+        table = st.session_state.uploaded_tables.get(table_name)
+        if table is None or is_file_view(table) or get_table_meta(table_name)['rows'] < LAYOUT_MIN_ROWS:
+            continue
+        sort_columns, index_columns = choose_table_layout(column_counts)
+        layout = layouts.get(table_name)
+        if layout is None and sort_columns and isinstance(table, pa.Table):
+            session_bytes = sum(get_resident_bytes(name) for name in st.session_state.uploaded_tables)
+            if session_bytes + get_table_meta(table_name)['bytes'] > SESSION_MEMORY_BUDGET_MB * 1024 * 1024:
+                continue
+        if layout is None and sort_columns:
+            conn, limits = get_catalog(), get_query_limits()
+            probe = probes[(table_name, sort_columns[0])]
+            layouts[table_name] = {
+                'sort': sort_columns, 'indexes': [], 'skipped': [], 'planned_indexes': index_columns,
+                'status': 'building', 'source': None, 'head': None, 'before': None, 'after': None,
+                'error': None, 'probe': probe,
+                'job': get_query_pool().submit(
+                    lambda job: run_layout_build(job, conn, table_name, sort_columns, probe, limits), heavy=True
+                )
+            }
+            return
+        if layout is not None and layout['status'] == 'active':
+            new_indexes = [column for column in index_columns if column not in layout['indexes'] + layout['skipped']]
+            if new_indexes:
+                probe = probes[(table_name, new_indexes[0])]
+                layout['probe'] = probe
+                start_layout_indexes(table_name, layout, new_indexes, probe, time_before=True)
+                return
+
+def collect_table_layouts():
+    """
+    Move finished layout jobs along on the script thread, where no other change
+    to the session's tables can interleave: a sorted copy is swapped in for its
+    table, which then gets its indexes; a finished index step activates the layout.
+    Tables read by a running query are swapped on a later call.
+    Returns True when any layout moved on.
+    """
+    run = st.session_state.query_run
+    in_use = set(run['info']['tables']) if run is not None else set()
+    changed = False
+    for table_name, layout in list(st.session_state.table_layouts.items()):
+        job = layout['job']
+        if job is None or job.status != 'done':
+            continue
+        if layout['status'] == 'building' and table_name in in_use:
+            continue
+        layout['job'] = None
+        changed = True
+        if layout['status'] == 'building':
+            if job.error is not None:
+                layout['status'], layout['error'] = 'failed', str(job.error)
+                continue
+            copy_name, layout['before'], head = job.result
+            conn = get_catalog()
+            table = st.session_state.uploaded_tables[table_name]
+            try:
+                swap_in_table(conn, table_name, copy_name, 'TABLE' if is_catalog_table(table) else 'VIEW')
+            except duckdb.Error as e:
+                conn.execute(f'DROP TABLE IF EXISTS {copy_name}')
+                layout['status'], layout['error'] = 'failed', str(e)
+                continue
+            if isinstance(table, pa.Table):
+                # Kept so the table can be registered again if the connection is evicted
+                layout['source'] = table
+            layout['head'] = head
+            st.session_state.uploaded_tables[table_name] = conn.table(table_name)
+            start_layout_indexes(table_name, layout, layout['planned_indexes'], layout['probe'], time_before=False)
+        else:
+            indexed, before, after = job.result if job.error is None else ([], None, None)
+            layout['indexes'] = sorted(layout['indexes'] + indexed)
+            layout['skipped'] += [column for column in layout['planned_indexes'] if column not in indexed]
+            if after is not None:
+                layout['before'] = before if before is not None else layout['before']
+                layout['after'] = after
+            layout['error'] = str(job.error) if job.error is not None else None
+            layout['status'] = 'active'
+    return changed
+
+def discard_table_layout(table_name, drop_copy=False):
+    """
+    Forget a table's layout and cancel its pending job. With drop_copy, a sorted
+    copy that was built but not swapped in yet is dropped from the catalog.
+    """
+    layout = st.session_state.table_layouts.pop(table_name, None)
+    if layout is None or layout['job'] is None:
+        return
+    job = layout['job']
+    get_query_pool().cancel(job)
+    if drop_copy and layout['status'] == 'building' and job.status == 'done' and job.error is None:
+        get_catalog().execute(f'DROP TABLE IF EXISTS {job.result[0]}')
+
+def describe_table_layout(layout):
+    """One-line summary of a table's workload-driven layout and the time it saved"""
+    if layout['status'] == 'building':
+        return f"🛠️ Sorting by {', '.join(layout['sort'])} for frequent filters..."
+    if layout['status'] == 'indexing' and layout['planned_indexes']:
+        return f"🛠️ Indexing {', '.join(layout['planned_indexes'])} for frequent lookups..."
+    if layout['status'] == 'indexing':
+        return "🛠️ Timing the sorted table..."
+    if layout['status'] == 'failed':
+        return f"⚠️ Could not reorganize this table: {layout['error']}"
+    summary = f"⚡ Sorted by {', '.join(layout['sort'])}"
+    if layout['indexes']:
+        summary += f", indexed on {', '.join(layout['indexes'])}"
+    if layout['before'] is not None and layout['after'] is not None:
+        summary += (
+            f": latest matching query {layout['before'] * 1000:,.1f} ms → {layout['after'] * 1000:,.1f} ms"
+            f" ({layout['before'] / max(layout['after'], 1e-6):,.1f}× faster)"
+        )
+    return summary
+
+@st.fragment(run_every=QUERY_POLL_SECONDS)
+def display_running_query():
+    """
+    Progress of the session's queued or running query. Only this panel reruns
+    on every poll, so the sidebar and the rest of the page stay usable; once
+    the query is done its outcome is recorded and the whole page reruns.
+    """
+    run = st.session_state.query_run
+    if run is None:
+        return
+    job = run['job']
+    pool = get_query_pool()
+    if job.status in ('done', 'cancelled'):
+        if job.error is not None:
+            row_count, error = None, f"SQL execution error: {str(job.error)}"
+        else:
+            row_count, error = job.result if job.status == 'done' else (None, None)
+        finish_query_run(run, row_count, error)
+        st.rerun()
+    
+    estimate = job.partial_results[-1] if job.partial_results else None
+    col1, col2 = st.columns([5, 1])
+    with col1:
+        if job.status == 'queued':
+            ahead = pool.position(job) or 0
+            stats = pool.stats()
+            st.info(
+                f"⏳ **Queued** behind {ahead} other quer{'y' if ahead == 1 else 'ies'} "
+                f"({stats['running']} of {pool.max_workers} query workers busy)"
+            )
+        elif job.cancel_requested:
+            st.warning("⏹️ Stopping the query...")
+        elif run['approximate'] and estimate is not None:
+            # Each sample stage and the final exact run count as one step
+            if estimate['stage'] < estimate['stages']:
+                text = f"🎯 Estimate {estimate['stage']} of {estimate['stages']}, refining over a larger sample..."
+            else:
+                text = f"🎯 Estimate {estimate['stage']} of {estimate['stages']}, computing the exact answer..."
+            st.progress(estimate['stage'] / (estimate['stages'] + 1), text=text)
+        elif run['approximate']:
+            st.progress(0.0, text="🎯 Preparing a first estimate...")
+        else:
+            elapsed = f"{int(job.elapsed())}s (time limit {st.session_state.query_timeout}s)"
+            if job.progress is None:
+                st.progress(0.0, text=f"🔄 Running for {elapsed}")
+            else:
+                st.progress(job.progress, text=f"🔄 {job.progress:.0%} done · running for {elapsed}")
+    with col2:
+        label = "⏹️ Stop Here" if estimate is not None else "⏹️ Cancel Query"
+        if st.button(label, key="cancel_query", use_container_width=True,
+                     disabled=job.cancel_requested, help="Stop the running query"):
+            pool.cancel(job)
+    
+    if job.warning:
+        st.warning(f"⚠️ {job.warning}")
+    if estimate is not None:
+        display_approximate_result(estimate)
+
+def display_approximate_result(estimate):
+    """
+    Show an estimate from sampled tables with its sample sizes. The rough
+    margin of error applies to shares and averages; COUNT and SUM columns
+    scaled up to the full tables are marked with ≈, and other counts and
+    sums are labelled as covering only the sampled rows.
+    """
+    sampled = ", ".join(
+        f"{sample_rows:,} of {rows:,} rows of {name} ({sample_rows / rows:.2%})"
+        for name, (sample_rows, rows) in estimate['sampled'].items()
+    )
+    # Stages only run when the largest table is big enough to be sampled
+    margin = sampling_margin(min(sample_rows for sample_rows, _ in estimate['sampled'].values()))
+    scaled = estimate['scaled']
+    if scaled:
+        totals = (
+            f"Columns marked ≈ ({', '.join(scaled)}) are COUNT/SUM totals scaled up from the sample; "
+            "other counts and sums cover only the sampled rows."
+        )
+    else:
+        totals = "Counts and sums cover only the sampled rows."
+    st.caption(
+        f"🎯 **Approximate result** from {sampled}, computed in {estimate['seconds']:.2f}s. "
+        f"Shares and averages are within about ±{margin:.1%} (95%). {totals}"
+    )
+    result = estimate['result'].head(APPROX_PREVIEW_ROWS)
+    if scaled:
+        result = result.rename(columns={column: f"≈ {column}" for column in scaled})
+    st.dataframe(result, use_container_width=True, hide_index=True)
+
+def display_query_notice():
+    """Show the error or cancellation left by the last finished query run, once"""
+    notice = st.session_state.pop('query_notice', None)
+    if notice is None:
+        return
+    kind, error = notice
+    if kind == 'warning':
+        st.warning(f"⚠️ {error}")
+        return
+    if kind == 'cancelled':
+        if st.session_state.approx_result is not None:
+            st.warning("⏹️ **Stopped early.** The exact run was cancelled; the latest estimate is shown below.")
+        else:
+            st.warning("⏹️ **Query cancelled.** The running query was stopped.")
+        return
+    
+    st.error(f"❌ **Query Failed**: {error}")
+    
+    # Enhanced error guidance
+    with st.expander("🔧 **Troubleshooting Help**", expanded=True):
+        st.write("**Common Solutions:**")
+        st.write("• **Table not found**: Use correct table names (check sidebar)")
+        st.write("• **Column not found**: Check column names with `SELECT * FROM table_name LIMIT 5`")
+        st.write("• **JOIN issues**: Verify that join columns exist in both tables")
+        st.write("• **Syntax error**: Ensure proper SQL syntax (commas, quotes, etc.)")
+        
+        st.info("💡 **Pro Tip**: Start with simple queries like `SELECT * FROM table_name LIMIT 5` to explore your data structure first.")
+
+def describe_query_reads(info):
+    """Summarize the tables and columns a query reads, e.g. 'sales (id, amount) · customers (all columns)'"""
+    parts = []
+    for table_name in info['tables']:
+        table = st.session_state.uploaded_tables[table_name]
+        if info['columns'] is None:
+            parts.append(f"{table_name} (all columns)")
+            continue
+        column_names = table.column_names if isinstance(table, pa.Table) else [str(column) for column in table.columns]
+        read_columns = [name for name in column_names if name.lower() in info['columns']]
+        parts.append(f"{table_name} ({', '.join(read_columns)})" if read_columns else table_name)
+    return " · ".join(parts)
+
+def run_query_profile(query):
+    """
+    Run a query again under EXPLAIN ANALYZE, with this session's limits.
+    Returns (operators, total_seconds, error); operators come from flatten_query_profile.
+    """
+    conn = get_catalog()
+    limits = get_query_limits()
+    cursor = conn.cursor()
+    try:
+        apply_query_limits(cursor, limits['memory_limit_mb'], limits['threads'])
+        profile = run_interruptible(cursor, lambda cur: profile_query(cur, query), timeout=limits['timeout'])
+        return flatten_query_profile(profile), profile.get('latency', profile.get('timing')), None
+    except QueryTimeoutError as e:
+        return None, None, f"Profiling stopped after exceeding the {e.timeout:g} second time limit."
     except Exception as e:
-        return None, f"SQL execution error: {str(e)}"
+        return None, None, f"Profiling error: {str(e)}"
+    finally:
+        cursor.close()
 
-def add_to_query_history(query, result_count=None, error=None):
-    """Add executed query to session history"""
+def fetch_result_page(conn, offset, limit):
+    """Fetch one window of rows from the result table as a DataFrame"""
+    cursor = conn.cursor()
+    try:
+        return cursor.execute(f'SELECT * FROM {RESULT_TABLE} LIMIT ? OFFSET ?', [limit, offset]).fetch_df()
+    finally:
+        cursor.close()
+
+def add_to_query_history(query, result_count=None, error=None, key_columns=None):
+    """Add executed query to session history, with the (table, column, kind) keys it filtered or joined on"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     history_item = {
         'timestamp': timestamp,
         'query': query,
         'result_count': result_count,
         'error': error,
-        'success': error is None
+        'success': error is None,
+        'key_columns': key_columns or []
     }
     st.session_state.query_history.append(history_item)
 
-def create_excel_download(df, filename="query_result.xlsx"):
-    """Create Excel file from DataFrame for download"""
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='Query Result', index=False)
-    return output.getvalue()
+def create_result_excel_download(conn):
+    """
+    Create an Excel file from the result table for download.
+    Rows are streamed from DuckDB in batches into a write-only workbook on
+    disk, splitting across sheets past Excel's row limit.
+    Returns (bytes, sheet_count).
+    """
+    with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as tmp:
+        path = tmp.name
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'SELECT * FROM {RESULT_TABLE}')
+        columns = [column[0] for column in cursor.description]
+        sheet_count = write_excel_export(iter_cursor_rows(cursor), columns, path)
+        with open(path, 'rb') as f:
+            return f.read(), sheet_count
+    finally:
+        cursor.close()
+        os.remove(path)
+
+def create_result_download(conn, export_format, timings=None):
+    """
+    Write the result table to a temporary file in one of RESULT_EXPORT_FORMATS
+    with DuckDB and return the file's bytes. Rows go straight from DuckDB into
+    the file, so no DataFrame or Python string of the whole result is built.
+    The time taken is recorded in timings when given.
+    """
+    start_time = time.perf_counter()
+    # The session's catalog may only write inside its own storage
+    exports_dir = os.path.join(get_session_storage(st.session_state.session_id)[1], 'exports')
+    os.makedirs(exports_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(suffix=RESULT_EXPORT_FORMATS[export_format]['suffix'], delete=False, dir=exports_dir) as tmp:
+        path = tmp.name
+    cursor = conn.cursor()
+    try:
+        export_query_result(cursor, f'SELECT * FROM {RESULT_TABLE}', path, export_format)
+        with open(path, 'rb') as f:
+            data = f.read()
+    finally:
+        cursor.close()
+        discard_file(path)
+    if timings is not None:
+        timings[f"{RESULT_EXPORT_FORMATS[export_format]['label']} export"] = time.perf_counter() - start_time
+    return data
+
+@st.fragment
+def display_query_limits():
+    """Per-session query limits, capped at the server-wide defaults; changing one reruns only this panel"""
+    with st.expander("⚙️ Query Limits", expanded=False):
+        st.number_input(
+            "Time limit (seconds)", min_value=1, max_value=QUERY_TIMEOUT_SECONDS, step=10,
+            key="query_timeout", help="Queries running longer than this are stopped"
+        )
+        st.number_input(
+            "Memory limit (MB)", min_value=64, max_value=QUERY_MEMORY_LIMIT_MB, step=256,
+            key="query_memory_limit_mb", help="Queries needing more memory than this are stopped"
+        )
+        st.number_input(
+            "Threads", min_value=1, max_value=QUERY_THREADS, step=1,
+            key="query_threads", help="Maximum CPU threads a query may use"
+        )
+
+def display_page_timing(start_time):
+    """Show how long this full page run took, against the rerun latency target"""
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    icon = "⚡" if elapsed_ms <= RERUN_TARGET_MS else "🐢"
+    st.sidebar.caption(f"{icon} Page run took {elapsed_ms:.0f} ms (target {RERUN_TARGET_MS} ms)")
+
+def display_storage_mode():
+    """Show where session tables are stored and how DuckDB spills when memory runs out"""
+    stats = get_storage_stats(get_catalog())
+    if STORAGE_MODE == 'disk':
+        mode = f"🗄️ **Disk storage**: tables are written to this session's DuckDB file ({stats['database_size']}, plus {stats['wal_size']} of write-ahead log)"
+    else:
+        mode = "🧠 **Memory storage**: tables are held in RAM"
+    st.caption(
+        f"{mode}. DuckDB memory limit {stats['memory_limit']} ({stats['memory_usage']} in use); "
+        f"larger joins and sorts spill to `{stats['temp_directory']}` "
+        f"({stats['spilled_bytes'] / 1024 / 1024:.1f} MB spilled now)."
+    )
 
 def display_table_management():
     """Display table management interface in sidebar"""
@@ -373,11 +1734,28 @@ def display_table_management():
             return
         
         st.caption(f"{len(st.session_state.uploaded_tables)} table(s) available")
+        display_memory_budget()
+        active_layouts = [layout for layout in st.session_state.table_layouts.values() if layout['status'] == 'active']
+        if active_layouts:
+            st.caption(f"⚡ {len(active_layouts)} table(s) reorganized for your frequent filters and joins")
         
         # Display each table with delete option and preview
-        for table_name, df in st.session_state.uploaded_tables.items():
-            with st.expander(f"📋 {table_name}", expanded=False):
-                st.caption(f"📊 {len(df):,} rows × {len(df.columns)} columns")
+        for table_name in st.session_state.uploaded_tables:
+            derived = st.session_state.derived_tables.get(table_name)
+            stale_sources = get_stale_sources(table_name) if derived else []
+            label = f"{'🧮' if derived else '📋'} {table_name}{' ⚠️ stale' if stale_sources else ''}"
+            with st.expander(label, expanded=False):
+                rows = get_table_meta(table_name)['rows']
+                rows_text = "rows not counted" if rows is None else f"{rows:,} rows"
+                st.caption(f"📊 {rows_text} × {len(get_table_meta(table_name)['columns'])} columns")
+                st.caption(describe_table_residency(table_name))
+                layout = st.session_state.table_layouts.get(table_name)
+                if layout is not None:
+                    st.caption(describe_table_layout(layout))
+                if derived:
+                    st.caption(f"🧮 Saved query result over {', '.join(derived['sources']) or 'no tables'}")
+                    if stale_sources:
+                        st.warning(f"⚠️ {', '.join(stale_sources)} changed or was deleted since this table was saved.")
                 
                 # Table actions
                 col1, col2 = st.columns(2)
@@ -388,6 +1766,13 @@ def display_table_management():
                 with col2:
                     if st.button("🗑️ Delete", key=f"delete_{table_name}"):
                         delete_table(table_name)
+                if derived and st.button("🔄 Refresh", key=f"refresh_{table_name}", help="Run the saved query again on the current tables"):
+                    with st.spinner(f"🔄 Refreshing {table_name}..."):
+                        error = refresh_derived_table(table_name)
+                    if error:
+                        st.error(f"❌ **Refresh failed**: {error}")
+                    else:
+                        st.rerun()
 
 def display_example_queries():
     """Display example SQL queries for multiple tables"""
@@ -397,7 +1782,7 @@ def display_example_queries():
     table_names = list(st.session_state.uploaded_tables.keys())
     
     if not table_names:
-        st.info("Upload Excel files to see query examples")
+        st.info("Upload data files to see query examples")
         return
     
     # Dynamic examples based on available tables
@@ -450,6 +1835,53 @@ def display_example_queries():
                 st.rerun()
             st.caption(example['description'])
 
+@st.fragment
+def display_table_preview(table_name):
+    """Preview a table with its column profile; choosing a histogram reruns only this panel"""
+    create_section_divider(f"📊 Preview: {table_name}")
+    st.session_state.table_last_used[table_name] = time.time()
+    
+    st.subheader("👀 Data Preview")
+    st.caption(f"Showing the first {TABLE_PREVIEW_ROWS} rows of table '{table_name}'")
+    
+    layout = st.session_state.table_layouts.get(table_name)
+    st.dataframe(
+        layout['head'] if layout is not None and layout['head'] is not None
+        else get_table_head(st.session_state.uploaded_tables[table_name], TABLE_PREVIEW_ROWS), 
+        use_container_width=True,
+        height=400
+    )
+    
+    # Column information
+    with st.expander("📋 **Column Details & Statistics**", expanded=False):
+        total_rows, col_info, histograms = load_table_profile(table_name)
+        st.dataframe(col_info, use_container_width=True)
+        
+        # Quick insights for selected table
+        st.subheader("📈 Quick Insights")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Total Rows", f"{total_rows:,}")
+            st.metric("Missing Values", f"{int(col_info['Missing Values'].sum()):,}")
+        with col2:
+            st.metric("Columns", len(col_info))
+            st.metric("Numeric Columns", sum(is_numeric_type(dtype) for dtype in col_info['Data Type']))
+        
+        # Value distributions of numeric columns
+        if histograms:
+            st.subheader("📊 Distributions")
+            histogram_column = st.selectbox(
+                "Numeric column",
+                list(histograms),
+                key=f"histogram_column_{table_name}"
+            )
+            st.bar_chart(histograms[histogram_column], x='Upper Bound', y='Rows')
+    
+    # Button to clear preview
+    if st.button("❌ Close Preview"):
+        st.session_state.selected_preview_table = None
+        st.rerun()
+
 def display_query_history():
     """Display enhanced query history in sidebar"""
     if st.session_state.query_history:
@@ -486,6 +1918,160 @@ def display_query_history():
                     error_msg = item['error'][:50] + '...' if len(item['error']) > 50 else item['error']
                     st.error(f"❌ Error: {error_msg}")
 
+@st.fragment
+def display_query_results():
+    """
+    Display the last query result one page at a time, with on-demand exports.
+    Paging, exports and profiling rerun only this panel.
+    """
+    result = st.session_state.last_result
+    conn = get_catalog()
+    
+    # Enhanced success message with execution stats
+    cache_note = " ⚡ (from result cache)" if result['cache_hit'] else ""
+    st.success(f"🎉 **Query Executed Successfully!** Returned {result['row_count']:,} rows in {result['execution_time']:.2f} seconds{cache_note}")
+    if result['reads']:
+        st.caption(f"📚 Reads {result['reads']}")
+    
+    # Enhanced results display
+    create_section_divider("📊 Query Results")
+    
+    if result['row_count'] == 0:
+        st.info("🔍 Query executed successfully but returned no results. Try adjusting your query conditions.")
+        return
+    
+    # Results summary
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("📊 Rows Returned", f"{result['row_count']:,}")
+    with col2:
+        st.metric("📋 Columns", result['column_count'])
+    with col3:
+        st.metric("⏱️ Execution Time", f"{result['execution_time']:.2f}s")
+    
+    # Page controls: only the visible window is fetched and sent to the browser
+    st.subheader("📋 Results Table")
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        page_size = st.selectbox("Rows per page", RESULT_PAGE_SIZES, index=1, key="result_page_size")
+    page_count = max(1, -(-result['row_count'] // page_size))
+    st.session_state.result_page = min(st.session_state.result_page, page_count)
+    with col2:
+        page = st.number_input(f"Page (of {page_count:,})", min_value=1, max_value=page_count, step=1, key="result_page")
+    
+    offset = (page - 1) * page_size
+    start_time = time.perf_counter()
+    page_df = fetch_result_page(conn, offset, page_size)
+    result['timings']["Fetch page"] = time.perf_counter() - start_time
+    st.caption(f"Showing rows {offset + 1:,}–{offset + len(page_df):,} of {result['row_count']:,} (page {page:,} of {page_count:,})")
+    st.dataframe(
+        page_df, 
+        use_container_width=True,
+        height=min(600, len(page_df) * 40 + 100)
+    )
+    
+    # Enhanced download section, each file built only when requested
+    st.subheader("💾 Export Results")
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        if st.button("📊 Prepare Excel", help="Build an Excel file from the full result"):
+            with st.spinner("🔄 Building Excel file..."):
+                start_time = time.perf_counter()
+                excel_data, sheet_count = create_result_excel_download(conn)
+                result['timings']["Excel export"] = time.perf_counter() - start_time
+            if sheet_count > 1:
+                st.caption(f"Result exceeds Excel's row limit and was split across {sheet_count} sheets")
+            st.download_button(
+                label="📊 Download as Excel",
+                data=excel_data,
+                file_name=f"sheetiq_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                help="Download your query results as an Excel file"
+            )
+    
+    with col2:
+        # The file is written by DuckDB only when the button is clicked
+        export_format = st.selectbox(
+            "Format", list(RESULT_EXPORT_FORMATS), key="export_format",
+            format_func=lambda name: RESULT_EXPORT_FORMATS[name]['label'], label_visibility="collapsed"
+        )
+        export = RESULT_EXPORT_FORMATS[export_format]
+        st.download_button(
+            label=f"📄 Download as {export['label']}",
+            data=lambda: create_result_download(conn, export_format, result['timings']),
+            file_name=f"sheetiq_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}{export['suffix']}",
+            mime=export['mime'],
+            on_click="ignore",
+            help="Download your query results, written straight from DuckDB without building them in Python"
+        )
+    
+    # Saved results are queried like uploaded tables, without re-running this query
+    st.subheader("🧮 Save as Table")
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        table_name = st.text_input(
+            "Table name", value=f"result_{len(st.session_state.derived_tables) + 1}",
+            key="save_result_name", label_visibility="collapsed"
+        )
+    with col2:
+        if st.button("💾 Save result as table", use_container_width=True):
+            error = save_result_as_table(table_name.strip())
+            if error:
+                st.error(f"❌ {error}")
+            else:
+                st.rerun()
+    
+    display_query_timings(result)
+    display_query_profile(result)
+
+def display_query_timings(result):
+    """Show the time spent in each phase of the last query run"""
+    with st.expander("⏱️ Timing Breakdown", expanded=False):
+        timings = result['timings']
+        total = sum(timings.values())
+        st.dataframe(
+            pd.DataFrame({
+                'Phase': list(timings),
+                'Time (ms)': [round(seconds * 1000, 1) for seconds in timings.values()],
+                'Share': [f"{seconds / total:.0%}" if total else "–" for seconds in timings.values()]
+            }),
+            use_container_width=True,
+            hide_index=True
+        )
+        st.caption("Fetch page and export times are updated each time you page through or export the result.")
+
+def display_query_profile(result):
+    """Offer an EXPLAIN ANALYZE run of the last query and show its operator tree"""
+    with st.expander("🔬 Query Profile", expanded=st.session_state.query_profile is not None):
+        if st.button("🔬 Profile Query", help="Run the query again under EXPLAIN ANALYZE to see where the time goes"):
+            with st.spinner("🔄 Profiling query..."):
+                operators, total_seconds, error = run_query_profile(result['query'])
+            if error:
+                st.error(f"❌ {error}")
+            else:
+                st.session_state.query_profile = {'operators': operators, 'total_seconds': total_seconds}
+        
+        profile = st.session_state.query_profile
+        if profile is None:
+            st.caption("Profiling runs the query once more and records time and row counts for every operator.")
+            return
+        
+        if profile['total_seconds'] is not None:
+            st.metric("⏱️ Profiled Query Time", f"{profile['total_seconds'] * 1000:.1f} ms")
+        operator_total = sum(op['seconds'] for op in profile['operators'])
+        st.dataframe(
+            pd.DataFrame({
+                'Operator': ["\u2003" * op['depth'] + op['operator'] for op in profile['operators']],
+                'Time (ms)': [round(op['seconds'] * 1000, 2) for op in profile['operators']],
+                'Share': [f"{op['seconds'] / operator_total:.0%}" if operator_total else "–" for op in profile['operators']],
+                'Rows': [op['rows'] for op in profile['operators']],
+                'Details': [op['details'] for op in profile['operators']]
+            }),
+            use_container_width=True,
+            hide_index=True
+        )
+
 def create_enhanced_header():
     """
     Create an enhanced header with modern styling and helpful information.
@@ -533,6 +2119,8 @@ def main():
     Main application function with enhanced UI and user experience.
     Organized into clear sections with proper styling and animations.
     """
+    page_start = time.perf_counter()
+    
     # Load custom CSS first for proper styling
     load_custom_css()
     
@@ -548,39 +2136,66 @@ def main():
         st.caption("Manage your data and queries")
         
         # Multiple file upload section
-        st.subheader("📁 Upload Excel Files")
-        st.caption("Upload multiple .xlsx files (up to 100GB each)")
+        st.subheader("📁 Upload Data Files")
+        st.caption("Upload multiple .xlsx, .csv, .csv.gz or .parquet files (up to 100GB each)")
         
         uploaded_files = st.file_uploader(
-            "Choose Excel files",
-            type=['xlsx'],
+            "Choose Excel, CSV or Parquet files",
+            type=['xlsx', 'csv', 'gz', 'parquet'],
             accept_multiple_files=True,
-            help="🔍 Tips: Each file's first sheet will be loaded as a separate table. Use filename (without extension) as table name in SQL queries.",
+            help="🔍 Tips: Each file becomes a separate table (for Excel, its first sheet). CSV (.csv, .csv.gz) and Parquet files are queried in place without loading them into memory. Use filename (without extension) as table name in SQL queries.",
             label_visibility="collapsed"
         )
+        
+        st.radio(
+            "📖 Excel reader",
+            EXCEL_ENGINES,
+            key="ingest_engine",
+            format_func=EXCEL_ENGINE_LABELS.get,
+            horizontal=True,
+            help=(
+                "**pandas** reads workbooks with openpyxl. "
+                "**Fast** decodes the sheet XML straight into typed columns, several times quicker on large sheets. "
+                f"**Streaming** reads rows straight into DuckDB, {INGEST_BATCH_ROWS:,} at a time, for workbooks too large for memory."
+            )
+        )
+        
+        display_query_limits()
     
     # Process uploaded files
     if uploaded_files:
+        seen_table_names = set()
+        pending_uploads = []
         for uploaded_file in uploaded_files:
             table_name = get_table_name_from_filename(uploaded_file.name)
             
-            # Skip if already loaded
-            if table_name in st.session_state.uploaded_tables:
+            # Only the first file mapping to a table name is used
+            if table_name in seen_table_names:
                 continue
+            seen_table_names.add(table_name)
             
-            # Show loading animation
-            with st.spinner(f"🔄 Loading {uploaded_file.name}..."):
-                df, error = load_excel_data(uploaded_file)
-            
-            if error:
-                st.error(f"❌ **Failed to load {uploaded_file.name}**: {error}")
+            # Skip if this exact content is already loaded
+            digest = get_upload_digest(uploaded_file)
+            if st.session_state.table_digests.get(table_name) == digest:
                 continue
             
-            # Store the table
-            st.session_state.uploaded_tables[table_name] = df
+            # A changed file with the same name replaces the old table
+            if table_name in st.session_state.uploaded_tables:
+                unregister_table(get_catalog(), table_name, st.session_state.uploaded_tables.pop(table_name))
+                forget_table_version(table_name)
+                release_table_source(table_name)
+                st.session_state.derived_tables.pop(table_name, None)
             
-            # Show success message
-            st.success(f"✅ Loaded **{table_name}** ({len(df):,} rows × {len(df.columns)} columns)")
+            pending_uploads.append((uploaded_file, table_name, digest))
+        
+        # Load all new files, in parallel where possible
+        ingest_uploads(pending_uploads)
+    
+    # Spill the coldest tables past the memory budget, and load back used ones that fit again
+    enforce_memory_budget()
+    
+    # Swap in tables reorganized in the background since the last page run
+    collect_table_layouts()
     
     # Display table management interface
     display_table_management()
@@ -594,44 +2209,7 @@ def main():
         if st.session_state.selected_preview_table:
             selected_table = st.session_state.selected_preview_table
             if selected_table in st.session_state.uploaded_tables:
-                df = st.session_state.uploaded_tables[selected_table]
-                
-                create_section_divider(f"📊 Preview: {selected_table}")
-                
-                st.subheader("👀 Data Preview")
-                st.caption(f"Showing the first 10 rows of table '{selected_table}'")
-                
-                st.dataframe(
-                    df.head(10), 
-                    use_container_width=True,
-                    height=400
-                )
-                
-                # Column information
-                with st.expander("📋 **Column Details & Statistics**", expanded=False):
-                    col_info = pd.DataFrame({
-                        'Column Name': df.columns,
-                        'Data Type': df.dtypes.astype(str),
-                        'Non-Null Values': df.count(),
-                        'Missing Values': df.isnull().sum(),
-                        'Sample Values': [str(df[col].dropna().iloc[0]) if not df[col].dropna().empty else 'N/A' for col in df.columns]
-                    })
-                    st.dataframe(col_info, use_container_width=True)
-                    
-                    # Quick insights for selected table
-                    st.subheader("📈 Quick Insights")
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.metric("Total Rows", f"{len(df):,}")
-                        st.metric("Missing Values", f"{df.isnull().sum().sum():,}")
-                    with col2:
-                        st.metric("Columns", len(df.columns))
-                        st.metric("Numeric Columns", len(df.select_dtypes(include=['number']).columns))
-                
-                # Button to clear preview
-                if st.button("❌ Close Preview"):
-                    st.session_state.selected_preview_table = None
-                    st.rerun()
+                display_table_preview(selected_table)
         
         else:
             # Overview of all tables
@@ -642,17 +2220,44 @@ def main():
             
             # Display summary of all tables
             table_summary = []
+            owned_bytes = shared_bytes = 0
             for table_name, df in st.session_state.uploaded_tables.items():
+                meta = get_table_meta(table_name)
+                if table_name in st.session_state.spilled_tables:
+                    source = st.session_state.table_sources[table_name]
+                    memory_usage = f"Spilled to disk (Parquet, {source['size'] / 1024 / 1024:.1f} MB)"
+                elif is_file_view(df):
+                    source = st.session_state.table_sources[table_name]
+                    memory_usage = f"On disk ({source['format'].upper()}, {source['size'] / 1024 / 1024:.1f} MB)"
+                elif is_catalog_table(df):
+                    memory_usage = "In database file" if STORAGE_MODE == 'disk' else "DuckDB table"
+                    if table_name in st.session_state.derived_tables:
+                        memory_usage += " (saved result)"
+                else:
+                    nbytes = meta['bytes']
+                    version = st.session_state.table_versions.get(table_name)
+                    sessions = get_table_store().session_count(version) if version else 0
+                    if sessions > 1:
+                        shared_bytes += nbytes
+                        memory_usage = f"{nbytes / 1024 / 1024:.1f} MB shared ({sessions} sessions)"
+                    else:
+                        owned_bytes += nbytes
+                        memory_usage = f"{nbytes / 1024 / 1024:.1f} MB owned"
                 table_summary.append({
                     'Table Name': table_name,
-                    'Rows': f"{len(df):,}",
-                    'Columns': len(df.columns),
-                    'Memory Usage': f"{df.memory_usage(deep=True).sum() / 1024 / 1024:.1f} MB"
+                    'Rows': describe_row_count(table_name),
+                    'Columns': len(meta['columns']),
+                    'Memory Usage': memory_usage
                 })
             
             if table_summary:
                 summary_df = pd.DataFrame(table_summary)
                 st.dataframe(summary_df, use_container_width=True)
+                st.caption(
+                    f"💾 {owned_bytes / 1024 / 1024:.1f} MB held only by this session, "
+                    f"{shared_bytes / 1024 / 1024:.1f} MB shared with other sessions"
+                )
+                display_storage_mode()
         
         # Enhanced example queries section
         create_section_divider("💡 Get Started with Examples")
@@ -668,7 +2273,7 @@ def main():
         if table_names:
             st.caption(f"Available tables: {', '.join(f'`{name}`' for name in table_names)}")
         else:
-            st.warning("No tables available. Upload Excel files first.")
+            st.warning("No tables available. Upload data files first.")
         
         col1, col2, col3, col4 = st.columns(4)
         with col1:
@@ -696,7 +2301,7 @@ def main():
 -- SELECT COUNT(*) FROM {first_table};
 -- SELECT column_name, COUNT(*) FROM {first_table} GROUP BY column_name;"""
         else:
-            placeholder_text = "-- Upload Excel files first to start querying"
+            placeholder_text = "-- Upload data files first to start querying"
         
         query = st.text_area(
             "✏️ **Write your SQL query here:**",
@@ -718,6 +2323,7 @@ def main():
                 "🚀 **Run Query**", 
                 type="primary",
                 use_container_width=True,
+                disabled=st.session_state.query_run is not None,
                 help="Execute your SQL query on the uploaded data"
             )
         with col2:
@@ -732,12 +2338,22 @@ def main():
                 use_container_width=True,
                 help="Auto-format your SQL query"
             )
+        with col4:
+            st.toggle(
+                "🎯 Approximate",
+                key="approximate_mode",
+                help=(
+                    "Show quick estimates from random samples of large tables "
+                    f"({', '.join(f'{rows:,}' for rows in APPROX_SAMPLE_ROWS)} rows), "
+                    "refined until the exact answer is ready or you stop"
+                )
+            )
         
         # Handle button actions
         if clear_button:
             st.session_state.current_query = ""
             st.rerun()
-            
+        
         if format_button and query.strip():
             # Simple SQL formatting
             formatted_query = query.strip()
@@ -752,88 +2368,44 @@ def main():
         # Enhanced query execution with multi-table support
         if execute_button and query.strip():
             if not st.session_state.uploaded_tables:
-                st.warning("⚠️ **No tables available!** Please upload Excel files first.")
+                st.warning("⚠️ **No tables available!** Please upload data files first.")
             else:
-                # Show loading with query preview
-                with st.spinner(f"🔄 Executing query on {len(st.session_state.uploaded_tables)} table(s)..."):
-                    start_time = time.time()
-                    result_df, error = execute_sql_query_multi_table(st.session_state.uploaded_tables, query)
-                    execution_time = time.time() - start_time
-                
-                if error:
-                    st.error(f"❌ **Query Failed**: {error}")
-                    
-                    # Enhanced error guidance
-                    with st.expander("🔧 **Troubleshooting Help**", expanded=True):
-                        st.write("**Common Solutions:**")
-                        st.write("• **Table not found**: Use correct table names (check sidebar)")
-                        st.write("• **Column not found**: Check column names with `SELECT * FROM table_name LIMIT 5`")
-                        st.write("• **JOIN issues**: Verify that join columns exist in both tables")
-                        st.write("• **Syntax error**: Ensure proper SQL syntax (commas, quotes, etc.)")
-                        
-                        st.info("💡 **Pro Tip**: Start with simple queries like `SELECT * FROM table_name LIMIT 5` to explore your data structure first.")
-                    
-                    add_to_query_history(query, error=error)
+                timer = PhaseTimer()
+                start_time = time.time()
+                approximate = st.session_state.approximate_mode
+                st.session_state.approx_result = None
+                # The run overwrites the result table from a pool worker, so the previous
+                # result must not be paged, exported or saved while it is replaced
+                st.session_state.last_result = None
+                job, row_count, error, info = run_query_cached(query, timer=timer, approximate=approximate)
+                run = {
+                    'query': query, 'info': info, 'timer': timer, 'start_time': start_time, 'job': job,
+                    'approximate': approximate,
+                    'versions': {name: st.session_state.table_versions.get(name) for name in info['tables']} if info else {}
+                }
+                if job is None:
+                    finish_query_run(run, row_count, error)
                 else:
-                    # Enhanced success message with execution stats
-                    st.success(f"🎉 **Query Executed Successfully!** Returned {len(result_df):,} rows in {execution_time:.2f} seconds")
-                    
-                    add_to_query_history(query, result_count=len(result_df))
-                    
-                    # Enhanced results display
-                    create_section_divider("📊 Query Results")
-                    
-                    if len(result_df) > 0:
-                        # Results summary
-                        col1, col2, col3 = st.columns(3)
-                        with col1:
-                            st.metric("📊 Rows Returned", f"{len(result_df):,}")
-                        with col2:
-                            st.metric("📋 Columns", len(result_df.columns))
-                        with col3:
-                            st.metric("⏱️ Execution Time", f"{execution_time:.2f}s")
-                        
-                        # Display results with enhanced styling
-                        st.subheader("📋 Results Table")
-                        st.dataframe(
-                            result_df, 
-                            use_container_width=True,
-                            height=min(600, len(result_df) * 40 + 100)
-                        )
-                        
-                        # Enhanced download section
-                        st.subheader("💾 Export Results")
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            excel_data = create_excel_download(result_df)
-                            st.download_button(
-                                label="📊 Download as Excel",
-                                data=excel_data,
-                                file_name=f"sheetiq_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                                help="Download your query results as an Excel file"
-                            )
-                        
-                        with col2:
-                            csv_data = result_df.to_csv(index=False)
-                            st.download_button(
-                                label="📄 Download as CSV",
-                                data=csv_data,
-                                file_name=f"sheetiq_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                                mime="text/csv",
-                                help="Download your query results as a CSV file"
-                            )
-                    else:
-                        st.info("🔍 Query executed successfully but returned no results. Try adjusting your query conditions.")
+                    # The query runs on the shared pool; the panel below polls it
+                    st.session_state.query_run = run
         
         elif execute_button and not query.strip():
             st.warning("⚠️ **Please write a SQL query first!** Use the examples above to get started.")
+        
+        if st.session_state.query_run is not None:
+            display_running_query()
+        display_query_notice()
+        if st.session_state.approx_result is not None and st.session_state.query_run is None:
+            display_approximate_result(st.session_state.approx_result)
+        
+        # Results of the last successful query persist across reruns for paging
+        if st.session_state.last_result:
+            display_query_results()
     
     else:
         # Enhanced welcome section when no files are uploaded
         st.markdown("### 📊 Ready to Analyze Your Excel Data?")
-        st.write("Upload multiple Excel files using the sidebar to get started with powerful multi-table SQL analysis")
+        st.write("Upload multiple .xlsx, .csv, .csv.gz or .parquet files using the sidebar to get started with powerful multi-table SQL analysis")
         
         st.markdown("---")
         
@@ -841,7 +2413,7 @@ def main():
         col1, col2, col3 = st.columns(3)
         
         with col1:
-            st.info("🚀 **Multi-File Upload**\n\nUpload multiple Excel files at once (up to 100GB each)")
+            st.info("🚀 **Multi-File Upload**\n\nUpload multiple .xlsx, .csv, .csv.gz or .parquet files at once (up to 100GB each)")
         
         with col2:
             st.info("🔍 **Multi-Table SQL**\n\nJoin, union, and query across multiple tables with advanced SQL")
@@ -850,6 +2422,8 @@ def main():
             st.info("📥 **Easy Management**\n\nPreview, delete, and export data with intuitive controls")
         
         st.success("💡 **Pro Tip:** Each Excel file becomes a table named after its filename. You can join multiple tables in a single SQL query!")
+    
+    display_page_timing(page_start)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,211 @@
+"""
+Sheetiq command line: load Excel workbooks, CSV and Parquet files and run SQL
+queries without the web UI.
+
+Example:
+    python sheetiq_cli.py sales.xlsx customers.xlsx \\
+        -q "SELECT region, SUM(amount) FROM sales GROUP BY region" \\
+        --format parquet -o totals.parquet
+
+Results are streamed in batches to the output files, or to stdout when no
+output is given. Timings are reported on stderr.
+"""
+import argparse
+import os
+import sys
+import time
+
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from sheetiq_engine import (
+    EXCEL_ENGINES,
+    EXPORT_BATCH_ROWS,
+    QUERY_MEMORY_LIMIT_MB,
+    QUERY_THREADS,
+    QUERY_TIMEOUT_SECONDS,
+    QueryTimeoutError,
+    SPILL_DIR,
+    apply_query_limits,
+    create_file_view,
+    get_source_format,
+    get_table_name_from_filename,
+    load_workbook_file,
+    open_database,
+    persist_table,
+    register_table,
+    run_interruptible,
+    validate_query,
+)
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+def log(message):
+    """Write a progress or timing line to stderr, keeping stdout for results"""
+    print(message, file=sys.stderr, flush=True)
+
+def load_tables(conn, paths, engine='openpyxl', use_cache=True, persist=False):
+    """
+    Load each file into the catalog under a table name derived from its filename.
+    CSV and Parquet files become views scanned in place; workbooks are parsed,
+    and with persist their rows are copied into the connection's database.
+    Returns (tables, error) where tables maps table names to the loaded tables.
+    """
+    tables = {}
+    for path in paths:
+        table_name = get_table_name_from_filename(os.path.basename(path))
+        if table_name in tables:
+            log(f"skip  {path}: table name '{table_name}' is already used by another file")
+            continue
+        
+        source_format = get_source_format(path)
+        if source_format is None:
+            return None, f"{path}: unsupported file type (use .xlsx, .csv, .csv.gz or .parquet)"
+        
+        start_time = time.perf_counter()
+        if source_format == 'xlsx':
+            table, error, from_cache = load_workbook_file(path, conn, table_name, engine, use_cache)
+        else:
+            table, error = create_file_view(conn, table_name, os.path.abspath(path), source_format)
+            from_cache = False
+        if error:
+            return None, f"{path}: {error}"
+        if isinstance(table, pa.Table) and persist:
+            table = persist_table(conn, table_name, table)
+        elif isinstance(table, pa.Table):
+            register_table(conn, table_name, table)
+        tables[table_name] = table
+        
+        if source_format == 'xlsx':
+            source_note = " (cache)" if from_cache else ""
+            log(f"load  {table_name}: {len(table):,} rows x {len(table.columns)} columns "
+                f"in {time.perf_counter() - start_time:.2f}s{source_note}")
+        else:
+            log(f"link  {table_name}: {source_format} view with {len(table.columns)} columns "
+                f"in {time.perf_counter() - start_time:.2f}s")
+    return tables, None
+
+def open_result_writer(target, schema, output_format):
+    """Create a streaming Arrow writer for the chosen output format"""
+    if output_format == 'parquet':
+        return pq.ParquetWriter(target, schema)
+    return pa_csv.CSVWriter(target, schema)
+
+def write_query_result(cursor, query, target, output_format):
+    """Run a query and stream its result to target in batches. Returns the row count."""
+    reader = cursor.execute(query).to_arrow_reader(EXPORT_BATCH_ROWS)
+    row_count = 0
+    writer = open_result_writer(target, reader.schema, output_format)
+    try:
+        for batch in reader:
+            writer.write_batch(batch)
+            row_count += batch.num_rows
+    finally:
+        writer.close()
+    return row_count
+
+def get_output_targets(args):
+    """Pair each query with an output path, or None for stdout"""
+    if args.output:
+        if len(args.output) != len(args.query):
+            return None, "Give one --output per --query"
+        return args.output, None
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        return [
+            os.path.join(args.output_dir, f"query_{i}.{args.format}")
+            for i in range(1, len(args.query) + 1)
+        ], None
+    if len(args.query) > 1:
+        return None, "Several queries need --output or --output-dir"
+    return [None], None
+
+def run_queries(conn, tables, queries, targets, output_format, timeout=None):
+    """Run each query into its target, logging timings. Returns an error message or None."""
+    for i, (query, target) in enumerate(zip(queries, targets), start=1):
+        error = validate_query(tables, query, conn)
+        if error:
+            return f"Query {i}: {error}"
+        
+        destination = target or "stdout"
+        start_time = time.perf_counter()
+        cursor = conn.cursor()
+        try:
+            output = target if target is not None else sys.stdout.buffer
+            row_count = run_interruptible(
+                cursor, lambda cur: write_query_result(cur, query, output, output_format), timeout=timeout
+            )
+            if target is None:
+                sys.stdout.buffer.flush()
+        except QueryTimeoutError as e:
+            return f"Query {i}: stopped after exceeding the {e.timeout:g} second time limit"
+        except duckdb.OutOfMemoryException:
+            return f"Query {i}: stopped after exceeding the memory limit"
+        except Exception as e:
+            return f"Query {i}: SQL execution error: {str(e)}"
+        finally:
+            cursor.close()
+        
+        log(f"query {i}: {row_count:,} rows in {time.perf_counter() - start_time:.2f}s -> {destination}")
+    return None
+
+def build_parser():
+    """Command-line arguments"""
+    parser = argparse.ArgumentParser(
+        description="Load Excel workbooks as tables and run SQL queries on them with DuckDB."
+    )
+    parser.add_argument('files', nargs='+',
+                        help="Excel, CSV (.csv, .csv.gz) or Parquet files; each becomes a table named after the file")
+    parser.add_argument('-q', '--query', action='append', required=True,
+                        help="SELECT query to run (repeat for several queries)")
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='csv', help="Output format (default: csv)")
+    parser.add_argument('-o', '--output', action='append',
+                        help="Output file for the matching --query (default: stdout)")
+    parser.add_argument('--output-dir', help="Write results to query_<n>.<format> in this directory")
+    parser.add_argument('--engine', choices=EXCEL_ENGINES, default='openpyxl',
+                        help="Excel reader: pandas with openpyxl, the fast columnar decoder, "
+                             "or streaming row by row into DuckDB (default: openpyxl)")
+    parser.add_argument('--streaming', dest='engine', action='store_const', const='streaming',
+                        help="Same as --engine streaming")
+    parser.add_argument('--no-cache', action='store_true', help="Bypass the on-disk ingest cache")
+    parser.add_argument('--database',
+                        help="Store loaded tables in this DuckDB database file instead of memory (it is kept afterwards; "
+                             "tables loaded again under the same name are replaced)")
+    parser.add_argument('--spill-dir', default=SPILL_DIR,
+                        help=f"Where large joins and sorts spill past the memory limit (default: {SPILL_DIR})")
+    parser.add_argument('--timeout', type=float, default=QUERY_TIMEOUT_SECONDS,
+                        help=f"Per-query time limit in seconds (default: {QUERY_TIMEOUT_SECONDS})")
+    parser.add_argument('--memory-limit', type=int, default=QUERY_MEMORY_LIMIT_MB,
+                        help=f"DuckDB memory limit in MB (default: {QUERY_MEMORY_LIMIT_MB})")
+    parser.add_argument('--threads', type=int, default=QUERY_THREADS,
+                        help=f"DuckDB worker threads (default: {QUERY_THREADS})")
+    return parser
+
+def main(argv=None):
+    """Entry point; returns the process exit code"""
+    args = build_parser().parse_args(argv)
+    targets, error = get_output_targets(args)
+    if error:
+        log(f"error: {error}")
+        return 2
+    
+    total_start = time.perf_counter()
+    conn = open_database(args.database, args.memory_limit, args.spill_dir)
+    try:
+        apply_query_limits(conn, args.memory_limit, args.threads)
+        tables, error = load_tables(conn, args.files, args.engine, not args.no_cache, persist=bool(args.database))
+        if not error:
+            error = run_queries(conn, tables, args.query, targets, args.format, args.timeout)
+    finally:
+        conn.close()
+    
+    if error:
+        log(f"error: {error}")
+        return 1
+    log(f"total {time.perf_counter() - total_start:.2f}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
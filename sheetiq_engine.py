@@ -0,0 +1,2009 @@
+"""
+Sheetiq engine: Excel ingestion, CSV/Parquet file views, the on-disk ingest cache,
+query validation and execution, the shared query pool, workload-driven table
+layouts, query timing and profiling, the shared table store, query limits,
+database storage and spilling, the query result cache, column profiling and exports.
+Nothing in this module imports Streamlit, so it can run in worker processes,
+the command-line interface and benchmarks.
+"""
+import datetime
+import decimal
+import hashlib
+import io
+import json
+import math
+import numbers
+import os
+import posixpath
+import re
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+import xml.etree.ElementTree as ET
+import zipfile
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from xml.parsers import expat
+
+import duckdb
+import numpy as np
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils.cell import column_index_from_string
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Streaming ingest: rows buffered per DuckDB append and chunk size used when spooling uploads
+INGEST_BATCH_ROWS = 50_000
+SPOOL_CHUNK_BYTES = 16 * 1024 * 1024
+
+# Excel readers: pandas with openpyxl, the fast columnar decoder, or row-by-row streaming into DuckDB
+EXCEL_ENGINES = ['openpyxl', 'fast', 'streaming']
+
+# Fast xlsx decoder: cells buffered per columnar batch, cell type codes and Excel date epochs
+FAST_XLSX_BATCH_CELLS = 50_000
+XLSX_CELL_TYPES = ['n', 's', 'str', 'inlineStr', 'b', 'e', 'd']
+XLSX_TEXT_TYPES = {1, 2, 3}  # s, str and inlineStr
+XLSX_ESCAPE_RE = re.compile(r'_x([0-9A-Fa-f]{4})_')
+EXCEL_EPOCHS = {False: np.datetime64('1899-12-30', 'us'), True: np.datetime64('1904-01-01', 'us')}
+
+# Worker processes used to parse several uploaded workbooks at once
+INGEST_MAX_WORKERS = int(os.environ.get('SHEETIQ_INGEST_WORKERS', os.cpu_count() or 1))
+
+# On-disk Parquet cache of parsed uploads, keyed by content hash and parser options
+INGEST_CACHE_DIR = os.environ.get('SHEETIQ_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'sheetiq_ingest_cache'))
+INGEST_CACHE_MAX_BYTES = int(os.environ.get('SHEETIQ_INGEST_CACHE_MB', 10240)) * 1024 * 1024
+INGEST_CACHE_VERSION = 3  # Bump whenever parsing changes so stale entries are not reused
+
+# Names users may give tables they create, such as saved query results
+TABLE_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Upload formats by file extension; CSV and Parquet are scanned in place by DuckDB
+SOURCE_FORMATS = {'.xlsx': 'xlsx', '.csv': 'csv', '.csv.gz': 'csv', '.parquet': 'parquet'}
+FILE_VIEW_FORMATS = {'csv': 'read_csv', 'parquet': 'read_parquet'}
+
+# Process-wide query result cache: memory budget and optional Parquet spill directory
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('SHEETIQ_RESULT_CACHE_MB', 512)) * 1024 * 1024
+RESULT_CACHE_SPILL_DIR = os.environ.get('SHEETIQ_RESULT_SPILL_DIR') or None
+RESULT_CACHE_SPILL_MAX_BYTES = int(os.environ.get('SHEETIQ_RESULT_SPILL_MB', 4096)) * 1024 * 1024
+
+# Approximate queries: rows sampled from each larger table at each refinement stage
+# before the exact run, skipping samples above a share of the table (the exact run
+# costs little more); reservoir sampling up to a size, row-level Bernoulli beyond;
+# the sampling seed, the aggregates scaled up from samples and the memory budget of the sample cache
+APPROX_SAMPLE_ROWS = [10_000, 100_000, 1_000_000]
+APPROX_MAX_SAMPLE_SHARE = 0.1
+APPROX_RESERVOIR_MAX_ROWS = 100_000
+APPROX_SAMPLE_SEED = 42
+APPROX_SCALABLE_AGGREGATES = {'count', 'count_star', 'sum'}
+SAMPLE_CACHE_MAX_BYTES = int(os.environ.get('SHEETIQ_SAMPLE_CACHE_MB', 256)) * 1024 * 1024
+
+# Excel exports: sheet row limit (including the header) and rows fetched per batch
+EXCEL_MAX_ROWS = 1_048_576
+EXPORT_BATCH_ROWS = 50_000
+
+# Result exports written straight from DuckDB: label, file suffix, MIME type and COPY options
+# per format; Arrow IPC has no COPY writer in DuckDB and is streamed through pyarrow instead
+RESULT_EXPORT_FORMATS = {
+    'parquet': {'label': "Parquet", 'suffix': '.parquet', 'mime': 'application/vnd.apache.parquet',
+                'copy': "FORMAT parquet, COMPRESSION zstd"},
+    'arrow': {'label': "Arrow IPC", 'suffix': '.arrow', 'mime': 'application/vnd.apache.arrow.file', 'copy': None},
+    'csv': {'label': "CSV", 'suffix': '.csv', 'mime': 'text/csv', 'copy': "FORMAT csv, HEADER"},
+    'csv.gz': {'label': "CSV (gzip)", 'suffix': '.csv.gz', 'mime': 'application/gzip',
+               'copy': "FORMAT csv, HEADER, COMPRESSION gzip"},
+    'csv.zst': {'label': "CSV (zstd)", 'suffix': '.csv.zst', 'mime': 'application/zstd',
+                'copy': "FORMAT csv, HEADER, COMPRESSION zstd"},
+    'jsonl': {'label': "JSON lines", 'suffix': '.jsonl', 'mime': 'application/x-ndjson', 'copy': "FORMAT json"}
+}
+
+# Type inference: strings are dictionary-encoded when distinct values are at most this share of rows
+DICTIONARY_MAX_RATIO = 0.5
+TEXT_DATE_FORMATS = ['ISO8601', '%d.%m.%Y']
+AMBIGUOUS_TEXT_DATE_FORMATS = ['%d/%m/%Y', '%m/%d/%Y']
+
+# Column profiling: equal-width bins per numeric histogram
+PROFILE_HISTOGRAM_BINS = 20
+NUMERIC_TYPE_PREFIXES = (
+    'TINYINT', 'SMALLINT', 'INTEGER', 'BIGINT', 'HUGEINT', 'UTINYINT', 'USMALLINT',
+    'UINTEGER', 'UBIGINT', 'UHUGEINT', 'FLOAT', 'DOUBLE', 'DECIMAL'
+)
+
+# Query limits: server-wide defaults and upper bounds for per-session settings
+QUERY_TIMEOUT_SECONDS = int(os.environ.get('SHEETIQ_QUERY_TIMEOUT', 300))
+QUERY_MEMORY_LIMIT_MB = int(os.environ.get('SHEETIQ_QUERY_MEMORY_MB', 2048))
+QUERY_THREADS = int(os.environ.get('SHEETIQ_QUERY_THREADS', min(4, os.cpu_count() or 1)))
+
+# Query pool: queries from every session share these workers; heavy queries (reading at
+# least QUERY_HEAVY_ROWS rows, or files not yet counted) have a lower cap of their own
+QUERY_WORKERS = int(os.environ.get('SHEETIQ_QUERY_WORKERS', 4))
+QUERY_MAX_HEAVY = int(os.environ.get('SHEETIQ_QUERY_MAX_HEAVY', 2))
+QUERY_HEAVY_ROWS = int(os.environ.get('SHEETIQ_QUERY_HEAVY_ROWS', 1_000_000))
+
+# Workload-driven layout: tables of at least LAYOUT_MIN_ROWS rows are sorted by, or indexed on,
+# columns that at least LAYOUT_MIN_QUERIES of the last LAYOUT_HISTORY_QUERIES queries filtered or joined on
+AUTO_LAYOUT = os.environ.get('SHEETIQ_AUTO_LAYOUT', '1') != '0'
+LAYOUT_HISTORY_QUERIES = 50
+LAYOUT_MIN_QUERIES = int(os.environ.get('SHEETIQ_LAYOUT_MIN_QUERIES', 3))
+LAYOUT_MIN_ROWS = int(os.environ.get('SHEETIQ_LAYOUT_MIN_ROWS', 100_000))
+LAYOUT_KEY_COMPARISONS = {
+    'COMPARE_EQUAL', 'COMPARE_LESSTHAN', 'COMPARE_GREATERTHAN', 'COMPARE_LESSTHANOREQUALTO', 'COMPARE_GREATERTHANOREQUALTO'
+}
+
+# Table storage: 'memory' keeps uploaded tables in RAM, 'disk' writes them into a DuckDB database file per session
+STORAGE_MODES = ['memory', 'disk']
+STORAGE_MODE = os.environ.get('SHEETIQ_STORAGE', 'memory')
+STORAGE_DIR = os.environ.get('SHEETIQ_STORAGE_DIR', os.path.join(tempfile.gettempdir(), 'sheetiq_storage'))
+
+# Where DuckDB spills large joins, sorts and aggregations once the memory limit is reached
+SPILL_DIR = os.environ.get('SHEETIQ_SPILL_DIR', os.path.join(tempfile.gettempdir(), 'sheetiq_spill'))
+
+# Memory budgets for uploaded tables held in RAM, per session and for all sessions together;
+# past them the least recently used tables are spilled to Parquet in the session's spill directory
+SESSION_MEMORY_BUDGET_MB = int(os.environ.get('SHEETIQ_SESSION_MEMORY_MB', 1024))
+MEMORY_BUDGET_MB = int(os.environ.get('SHEETIQ_MEMORY_BUDGET_MB', 8192))
+
+# Table functions queries may call: they generate rows and read no files, unlike read_csv, glob and the like
+ALLOWED_TABLE_FUNCTIONS = {'range', 'generate_series', 'unnest'}
+
+# Functions whose output changes between runs; queries calling them are never cached
+VOLATILE_FUNCTIONS = {
+    'random', 'setseed', 'uuid', 'gen_random_uuid', 'uuidv4', 'uuidv7', 'nextval', 'currval',
+    'now', 'today', 'current_date', 'current_time', 'current_timestamp', 'get_current_time',
+    'get_current_timestamp', 'transaction_timestamp', 'current_localtime', 'current_localtimestamp'
+}
+
+# Private connection for parsing queries when the caller has no connection at hand
+_PARSER_CONN = None
+_PARSER_LOCK = threading.Lock()
+
+class QueryTimeoutError(Exception):
+    """Raised when a query is interrupted for running longer than its time limit"""
+    def __init__(self, timeout):
+        super().__init__(f"Query exceeded the {timeout:g} second time limit")
+        self.timeout = timeout
+
+class QueryCancelledError(Exception):
+    """Raised from a progress callback to stop a query whose job was cancelled"""
+    def __init__(self):
+        super().__init__("Query was cancelled")
+
+def quote_identifier(name):
+    """Quote a table or column name for use in SQL"""
+    return '"' + name.replace('"', '""') + '"'
+
+def is_numeric_type(type_name):
+    """Tell whether a DuckDB type name is numeric"""
+    return str(type_name).startswith(NUMERIC_TYPE_PREFIXES)
+
+def is_catalog_table(table):
+    """Tell whether a table is stored inside DuckDB rather than in Python memory"""
+    return isinstance(table, duckdb.DuckDBPyRelation)
+
+def is_file_view(table):
+    """Tell whether a catalog table is a view over a file scanned in place"""
+    return is_catalog_table(table) and table.type == 'VIEW_RELATION'
+
+def table_nbytes(table):
+    """Return the in-memory size of an Arrow table or DataFrame"""
+    if isinstance(table, pa.Table):
+        return table.nbytes
+    return int(table.memory_usage(deep=True).sum())
+
+def describe_table(table, count_rows=True):
+    """
+    Metadata of an Arrow table, DataFrame or catalog table as a dict of rows,
+    columns, dtypes (type names) and bytes held in Python memory (None for
+    catalog tables). With count_rows False, catalog tables are not counted and
+    rows is None, as counting a view scans its whole file.
+    """
+    if isinstance(table, pa.Table):
+        return {
+            'rows': table.num_rows,
+            'columns': table.column_names,
+            'dtypes': [str(dtype) for dtype in table.schema.types],
+            'bytes': table.nbytes
+        }
+    if is_catalog_table(table):
+        return {
+            'rows': len(table) if count_rows else None,
+            'columns': list(table.columns),
+            'dtypes': [str(dtype) for dtype in table.dtypes],
+            'bytes': None
+        }
+    return {
+        'rows': len(table),
+        'columns': [str(column) for column in table.columns],
+        'dtypes': [str(dtype) for dtype in table.dtypes],
+        'bytes': table_nbytes(table)
+    }
+
+def _parse_text_dates(values):
+    """Parse text values as dates if every value matches one known format, else return None"""
+    for date_format in TEXT_DATE_FORMATS:
+        parsed = pd.to_datetime(values, errors='coerce', format=date_format)
+        if parsed.notna().all():
+            return parsed
+    # Day/month order must be unambiguous across the whole column
+    candidates = [pd.to_datetime(values, errors='coerce', format=date_format) for date_format in AMBIGUOUS_TEXT_DATE_FORMATS]
+    matches = [parsed for parsed in candidates if parsed.notna().all()]
+    return matches[0] if len(matches) == 1 else None
+
+def _to_number_array(numbers):
+    """Build an int64 Arrow array when all numbers are whole and exactly representable, else float64"""
+    array = pa.array(numbers.astype('float64'), from_pandas=True)
+    finite = numbers.dropna()
+    if (finite % 1 == 0).all() and finite.abs().max() < 2 ** 53:
+        return array.cast(pa.int64())
+    return array
+
+def infer_arrow_column(series):
+    """
+    Convert a column to the narrowest fitting Arrow type.
+    Text and mixed object columns become numbers, booleans or timestamps when
+    every value qualifies; remaining strings are dictionary-encoded when they
+    repeat enough. Float columns holding only whole numbers become int64.
+    """
+    if pd.api.types.is_float_dtype(series):
+        # Blanks turn integer columns into float64; narrow them back like the fast reader does
+        if series.isna().all():
+            return pa.nulls(len(series), pa.string())
+        return _to_number_array(series)
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return pa.array(series, from_pandas=True)
+    
+    values = series.dropna()
+    if values.empty:
+        return pa.nulls(len(series), pa.string())
+    
+    kind = pd.api.types.infer_dtype(values, skipna=True)
+    if kind == 'boolean':
+        return pa.array(series, type=pa.bool_(), from_pandas=True)
+    if kind in ('integer', 'floating', 'mixed-integer-float', 'decimal'):
+        return _to_number_array(pd.to_numeric(series))
+    if kind in ('datetime', 'datetime64', 'date'):
+        return pa.array(pd.to_datetime(series), from_pandas=True)
+    
+    # All remaining checks run once per distinct value, then map back through the codes
+    codes, uniques = pd.factorize(series)
+    if kind == 'string':
+        return infer_text_column(codes, uniques)
+    if kind == 'mixed-integer':
+        # Numbers mixed with numeric text
+        numbers = pd.to_numeric(pd.Series(uniques).map(lambda v: v.strip() if isinstance(v, str) else v), errors='coerce')
+        if numbers.notna().all():
+            return _to_number_array(_expand_uniques(codes, numbers))
+    return _string_array(codes, uniques)
+
+def _expand_uniques(codes, unique_results):
+    """Map per-distinct-value results back to every row through factorized codes (-1 is missing)"""
+    return pd.Series(np.asarray(unique_results)[codes]).where(codes != -1)
+
+def _string_array(codes, uniques):
+    """Strings from factorized codes, dictionary-encoded when low-cardinality"""
+    missing = codes == -1
+    dictionary = pa.array([v if isinstance(v, str) else str(v) for v in uniques], type=pa.string())
+    if len(uniques) <= (~missing).sum() * DICTIONARY_MAX_RATIO:
+        return pa.DictionaryArray.from_arrays(pa.array(codes, type=pa.int32(), mask=missing), dictionary)
+    return dictionary.take(pa.array(codes, mask=missing))
+
+def infer_text_column(codes, uniques):
+    """
+    Type a text column given as factorized codes (-1 for missing) and its
+    distinct values: booleans, numbers or dates stored as text become typed
+    when every value qualifies, anything else stays (dictionary-encoded) text.
+    """
+    stripped = pd.Series(uniques, dtype=object).str.strip()
+    if stripped.str.lower().isin(['true', 'false']).all():
+        return pa.array((stripped.str.lower() == 'true').to_numpy()[codes], mask=codes == -1)
+    
+    # Numbers stored as text; codes with leading zeros or 16+ digits stay text
+    numbers = pd.to_numeric(stripped, errors='coerce')
+    if numbers.notna().all():
+        looks_like_code = stripped.str.match(r'^[+-]?0\d') | (stripped.str.count(r'\d') > 15)
+        if not looks_like_code.any():
+            return _to_number_array(_expand_uniques(codes, numbers))
+    
+    # Dates stored as text in one consistent format
+    dates = _parse_text_dates(stripped)
+    if dates is not None:
+        return pa.array(_expand_uniques(codes, dates), from_pandas=True)
+    return _string_array(codes, uniques)
+
+def to_typed_arrow(df):
+    """Convert a DataFrame into an Arrow table with inferred column types"""
+    return pa.Table.from_arrays(
+        [infer_arrow_column(df[col]) for col in df.columns],
+        names=[str(col) for col in df.columns]
+    )
+
+def load_excel_data(uploaded_file):
+    """Load Excel file and return the first sheet as a pandas DataFrame"""
+    try:
+        # Read only the first sheet; object dtype keeps cell types intact, so
+        # blanks do not turn integer and boolean columns into floats
+        df = pd.read_excel(uploaded_file, sheet_name=0, engine='openpyxl', dtype=object)
+        return df, None
+    except Exception as e:
+        return None, f"Error reading Excel file: {str(e)}"
+
+def load_excel_table(uploaded_file):
+    """Load the first sheet of an Excel file as a typed Arrow table"""
+    df, error = load_excel_data(uploaded_file)
+    if error:
+        return None, error
+    try:
+        return to_typed_arrow(df), None
+    except (pa.ArrowException, ValueError, TypeError) as e:
+        return None, f"Error converting Excel data: {str(e)}"
+
+def _xml_namespace(tag):
+    """Namespace URI of an ElementTree tag such as '{uri}name'"""
+    return tag[1:tag.index('}')] if tag.startswith('{') else ''
+
+def _resolve_xlsx_part(source_part, target):
+    """Zip member name of a relationship target, relative to the part that declares it"""
+    if target.startswith('/'):
+        return target[1:]
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source_part), target))
+
+def _read_xlsx_relationships(archive, part):
+    """Relationships declared by a package part, as {id: (type, target part)}"""
+    rels_part = posixpath.join(posixpath.dirname(part), '_rels', f"{posixpath.basename(part)}.rels")
+    if rels_part not in archive.namelist():
+        return {}
+    root = ET.fromstring(archive.read(rels_part))
+    return {
+        rel.get('Id'): (rel.get('Type', ''), _resolve_xlsx_part(part, rel.get('Target', '')))
+        for rel in root if rel.get('TargetMode') != 'External'
+    }
+
+def read_xlsx_workbook(archive):
+    """
+    Locate the parts needed to read the first worksheet of an xlsx package.
+    Returns a dict with the sheet, shared strings and styles parts, the
+    SpreadsheetML namespace and whether the workbook uses the 1904 date system.
+    """
+    package_rels = _read_xlsx_relationships(archive, '')
+    workbook_part = next(
+        (target for rel_type, target in package_rels.values() if rel_type.endswith('/officeDocument')),
+        'xl/workbook.xml'
+    )
+    root = ET.fromstring(archive.read(workbook_part))
+    ns = _xml_namespace(root.tag)
+    properties = root.find(f'{{{ns}}}workbookPr')
+    date1904 = properties is not None and properties.get('date1904', 'false').lower() in ('1', 'true')
+    
+    rels = _read_xlsx_relationships(archive, workbook_part)
+    parts_by_type = {rel_type.rsplit('/', 1)[-1]: target for rel_type, target in rels.values()}
+    sheet_part = None
+    for sheet in root.iter(f'{{{ns}}}sheet'):
+        # Chart sheets are listed too; pandas reads the first real worksheet
+        rel_id = next((value for key, value in sheet.attrib.items() if key.endswith('}id')), None)
+        rel_type, target = rels.get(rel_id, ('', None))
+        if rel_type.endswith('/worksheet'):
+            sheet_part = target
+            break
+    if sheet_part is None:
+        raise ValueError("the workbook has no worksheets")
+    return {
+        'sheet': sheet_part,
+        'shared_strings': parts_by_type.get('sharedStrings'),
+        'styles': parts_by_type.get('styles'),
+        'namespace': ns,
+        'date1904': date1904
+    }
+
+def _unescape_xlsx_text(text):
+    """Decode the _xHHHH_ escapes Excel writes for control characters"""
+    if '_x' not in text:
+        return text
+    return XLSX_ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), text)
+
+def read_xlsx_shared_strings(archive, part, ns):
+    """
+    Decode the shared-strings table once, incrementally, into an Arrow string
+    array that string cells index into. Rich-text runs are concatenated and
+    phonetic hints dropped, as openpyxl does.
+    """
+    if part is None:
+        return pa.array([], type=pa.string())
+    si_tag, t_tag, r_tag = f'{{{ns}}}si', f'{{{ns}}}t', f'{{{ns}}}r'
+    strings = []
+    with archive.open(part) as f:
+        for _, element in ET.iterparse(f):
+            if element.tag != si_tag:
+                continue
+            text = element.findtext(t_tag)
+            if text is None:
+                text = ''.join(run.findtext(t_tag) or '' for run in element.iter(r_tag))
+            strings.append(_unescape_xlsx_text(text))
+            element.clear()
+    return pa.array(strings, type=pa.string())
+
+def read_xlsx_date_styles(archive, part, ns):
+    """Flag each cell style index whose number format displays a date or time"""
+    if part is None:
+        return np.zeros(0, dtype=bool)
+    root = ET.fromstring(archive.read(part))
+    formats = dict(BUILTIN_FORMATS)
+    for number_format in root.iter(f'{{{ns}}}numFmt'):
+        formats[int(number_format.get('numFmtId'))] = number_format.get('formatCode', '')
+    cell_formats = root.find(f'{{{ns}}}cellXfs')
+    return np.array([
+        is_date_format(formats.get(int(xf.get('numFmtId', 0)), ''))
+        for xf in ([] if cell_formats is None else cell_formats)
+    ], dtype=bool)
+
+def _xlsx_cell_batch(refs, kinds, styles, values, row_numbers, row_lengths):
+    """
+    Convert one batch of scanned cells from Python lists into a columnar record
+    batch of column index, row number, cell type code, style index and raw text.
+    Cells without a value are dropped.
+    """
+    rows = np.repeat(np.array(row_numbers, dtype=np.int64), row_lengths)
+    ref_array = pa.array(refs, type=pa.string())
+    if ref_array.null_count:
+        # Cells may omit their reference; they then follow the previous cell in the row
+        row_starts = np.repeat(np.cumsum(row_lengths) - np.array(row_lengths), row_lengths)
+        columns = np.arange(len(refs)) - row_starts
+    else:
+        letters = pc.utf8_rtrim(ref_array, characters='0123456789').dictionary_encode()
+        indexes = np.array([column_index_from_string(name) - 1 for name in letters.dictionary.to_pylist()], dtype=np.int32)
+        columns = indexes[letters.indices.to_numpy()]
+    
+    kind_codes = pc.index_in(pc.fill_null(pa.array(kinds, type=pa.string()), 'n'), value_set=pa.array(XLSX_CELL_TYPES))
+    style_indexes = pc.cast(pa.array(styles, type=pa.string()), pa.int32())
+    batch = pa.record_batch({
+        'column': pa.array(columns, type=pa.int32()),
+        'row': pa.array(rows),
+        'kind': pc.fill_null(kind_codes, 0),
+        'style': pc.fill_null(style_indexes, 0),
+        'value': pa.array(values, type=pa.string())
+    })
+    # Filtering drops nulls as well as empty values
+    return batch.filter(pc.not_equal(batch['value'], ''))
+
+def scan_xlsx_sheet(stream, ns, batch_cells=FAST_XLSX_BATCH_CELLS):
+    """
+    Scan a worksheet's XML with expat, an incremental parser, and return its
+    non-empty cells as an Arrow table (see _xlsx_cell_batch). Cells are buffered
+    as Python objects only until `batch_cells` accumulate, then converted to
+    columnar batches, so memory stays close to the size of the decoded values.
+    """
+    c_tag, v_tag, t_tag, row_tag = (f'{ns}}}{name}' for name in ('c', 'v', 't', 'row'))
+    refs, kinds, styles, values, row_numbers, row_lengths = [], [], [], [], [], []
+    batches = []
+    text, parts = [], []
+    row_state = {'number': 0, 'start': 0}
+    
+    def start_element(name, attrs):
+        if name == c_tag:
+            refs.append(attrs.get('r'))
+            kinds.append(attrs.get('t'))
+            styles.append(attrs.get('s'))
+            parts.clear()
+        elif name == v_tag or name == t_tag:
+            text.clear()
+        elif name == row_tag:
+            number = attrs.get('r')
+            row_state['number'] = int(number) if number else row_state['number'] + 1
+            row_state['start'] = len(values)
+    
+    def end_element(name):
+        if name == v_tag or name == t_tag:
+            parts.append(''.join(text))
+        elif name == c_tag:
+            values.append(''.join(parts) if parts else None)
+        elif name == row_tag:
+            row_numbers.append(row_state['number'])
+            row_lengths.append(len(values) - row_state['start'])
+            if len(values) >= batch_cells:
+                batches.append(_xlsx_cell_batch(refs, kinds, styles, values, row_numbers, row_lengths))
+                for buffer in (refs, kinds, styles, values, row_numbers, row_lengths):
+                    buffer.clear()
+    
+    parser = expat.ParserCreate(namespace_separator='}')
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = text.append
+    parser.ParseFile(stream)
+    batches.append(_xlsx_cell_batch(refs, kinds, styles, values, row_numbers, row_lengths))
+    return pa.Table.from_batches(batches)
+
+def _excel_serial_to_timestamps(serials, date1904):
+    """Convert Excel date serial numbers to microsecond timestamps"""
+    serials = np.asarray(serials, dtype='float64')
+    if not date1904:
+        # Excel counts a nonexistent 29 Feb 1900, so serials before it are one day early
+        serials = np.where(serials < 60, serials + 1, serials)
+    offsets = np.round(serials * 86_400_000_000)
+    return EXCEL_EPOCHS[date1904] + np.nan_to_num(offsets).astype('int64').astype('timedelta64[us]')
+
+def _xlsx_cell_value(kind, raw, style, shared_strings, date_styles, date1904):
+    """Python value of a single cell, converted the way openpyxl does"""
+    cell_type = XLSX_CELL_TYPES[kind]
+    if cell_type == 'n':
+        number = float(raw)
+        if style < len(date_styles) and date_styles[style]:
+            return pd.Timestamp(_excel_serial_to_timestamps([number], date1904)[0])
+        return int(number) if number.is_integer() and not any(c in raw for c in '.eE') else number
+    if cell_type == 's':
+        return shared_strings[int(raw)].as_py()
+    if cell_type == 'b':
+        return raw == '1'
+    if cell_type == 'd':
+        return pd.Timestamp(raw)
+    if cell_type == 'e':
+        return None
+    return raw
+
+def _xlsx_column_cells(cells, shared_strings, date_styles, date1904):
+    """
+    Decode one column's cells into one value per cell, plus a label telling
+    how to finish typing them: 'number', 'shared' (shared-string indexes),
+    'text', 'mixed' (a list of Python values) or 'typed' when the array
+    already has its final type.
+    """
+    kinds = set(pc.unique(cells['kind']).to_pylist())
+    values = cells['value']
+    styles = cells['style'].to_numpy()
+    if kinds == {0}:
+        is_date = np.zeros(len(styles), dtype=bool)
+        known = styles < len(date_styles)
+        is_date[known] = date_styles[styles[known]]
+        numbers = pc.cast(values, pa.float64())
+        if is_date.all():
+            return pa.array(_excel_serial_to_timestamps(numbers.to_numpy(zero_copy_only=False), date1904)), 'typed'
+        if not is_date.any():
+            return numbers, 'number'
+    elif kinds == {1}:
+        # Indexes into the shared-strings table, which is decoded only once
+        return pc.cast(values, pa.int32()), 'shared'
+    elif kinds <= XLSX_TEXT_TYPES:
+        is_shared = pc.equal(cells['kind'], 1)
+        indexes = pc.cast(pc.if_else(is_shared, values, pa.scalar(None, pa.string())), pa.int32())
+        return pc.if_else(is_shared, shared_strings.take(indexes), values), 'text'
+    elif kinds == {XLSX_CELL_TYPES.index('b')}:
+        return pc.equal(values, '1'), 'typed'
+    elif kinds == {XLSX_CELL_TYPES.index('d')}:
+        return pa.array(pd.to_datetime(values.to_numpy(zero_copy_only=False), format='ISO8601')), 'typed'
+    
+    # Mixed cell types: convert cell by cell and let the generic inference decide
+    return [
+        _xlsx_cell_value(kind, raw, style, shared_strings, date_styles, date1904)
+        for kind, raw, style in zip(cells['kind'].to_pylist(), values.to_pylist(), styles.tolist())
+    ], 'mixed'
+
+def _decode_xlsx_column(cells, row_count, shared_strings, date_styles, date1904):
+    """Build one typed column from its cells, leaving rows without a cell empty"""
+    if cells.num_rows == 0:
+        return pa.nulls(row_count, pa.string())
+    scatter = np.full(row_count, -1, dtype=np.int64)
+    scatter[cells['row'].to_numpy() - 2] = np.arange(cells.num_rows)
+    values, form = _xlsx_column_cells(cells, shared_strings, date_styles, date1904)
+    if form == 'mixed':
+        return infer_arrow_column(pd.Series([values[i] if i >= 0 else None for i in scatter], dtype=object))
+    
+    column = values.take(pa.array(scatter, mask=scatter == -1))
+    if form == 'number':
+        return _to_number_array(pd.Series(column.to_numpy(zero_copy_only=False)))
+    if form == 'shared':
+        # Dictionary-encode the small integer indexes, then look up only the distinct strings
+        encoded = column.dictionary_encode()
+        uniques = shared_strings.take(encoded.dictionary).to_pylist()
+        return infer_text_column(encoded.indices.fill_null(-1).to_numpy(), uniques)
+    if form == 'text':
+        encoded = column.dictionary_encode()
+        return infer_text_column(encoded.indices.fill_null(-1).to_numpy(), encoded.dictionary.to_pylist())
+    return column
+
+def decode_xlsx_first_sheet(source):
+    """
+    Decode the first worksheet of an xlsx file (path or binary file object)
+    straight from the zip into a typed Arrow table, with the same header and
+    row layout pandas produces.
+    """
+    with zipfile.ZipFile(source) as archive:
+        workbook = read_xlsx_workbook(archive)
+        ns = workbook['namespace']
+        shared_strings = read_xlsx_shared_strings(archive, workbook['shared_strings'], ns)
+        date_styles = read_xlsx_date_styles(archive, workbook['styles'], ns)
+        with archive.open(workbook['sheet']) as stream:
+            cells = scan_xlsx_sheet(stream, ns)
+    if cells.num_rows == 0:
+        raise ValueError("the first sheet is empty")
+    date1904 = workbook['date1904']
+    
+    # Like pandas, the sheet's first row is the header and blank rows below it are kept
+    is_header = pc.equal(cells['row'], 1)
+    header_cells = cells.filter(is_header)
+    column_count = int(pc.max(cells['column']).as_py()) + 1
+    header = [None] * column_count
+    for column, kind, raw, style in zip(*(header_cells[name].to_pylist() for name in ('column', 'kind', 'value', 'style'))):
+        header[column] = _xlsx_cell_value(kind, raw, style, shared_strings, date_styles, date1904)
+    row_count = int(pc.max(cells['row']).as_py()) - 1
+    
+    # A single sorted copy of the data cells groups each column's cells together
+    order = pc.sort_indices(cells['column'])
+    order = order.filter(pc.invert(is_header).take(order))
+    body = cells.take(order)
+    del cells
+    body = pa.record_batch([body[name].combine_chunks() for name in body.column_names], names=body.column_names)
+    bounds = np.searchsorted(body['column'].to_numpy(), np.arange(column_count + 1))
+    columns = [
+        _decode_xlsx_column(body.slice(bounds[i], bounds[i + 1] - bounds[i]), row_count,
+                            shared_strings, date_styles, date1904)
+        for i in range(column_count)
+    ]
+    return pa.Table.from_arrays(columns, names=make_column_names(header))
+
+def load_excel_table_fast(uploaded_file):
+    """
+    Load the first sheet of an Excel file as a typed Arrow table with the fast
+    columnar decoder instead of pandas and openpyxl. Cells with formula
+    errors are read as missing values.
+    """
+    try:
+        if hasattr(uploaded_file, 'seek'):
+            uploaded_file.seek(0)
+        return decode_xlsx_first_sheet(uploaded_file), None
+    except Exception as e:
+        return None, f"Error reading Excel file: {str(e)}"
+
+def read_excel_table(uploaded_file, engine='openpyxl'):
+    """Load the first sheet of an Excel file as a typed Arrow table with the 'openpyxl' or 'fast' reader"""
+    if engine == 'fast':
+        return load_excel_table_fast(uploaded_file)
+    return load_excel_table(uploaded_file)
+
+def spool_upload_to_disk(uploaded_file, suffix, directory=None):
+    """
+    Copy an uploaded file to a temporary file in fixed-size chunks and return
+    its path. The file goes to directory when given, else the system temp dir.
+    """
+    uploaded_file.seek(0)
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False, dir=directory) as tmp:
+        shutil.copyfileobj(uploaded_file, tmp, SPOOL_CHUNK_BYTES)
+    return tmp.name
+
+def get_source_format(filename):
+    """Return the upload format of a file ('xlsx', 'csv' or 'parquet') from its name, or None"""
+    name = filename.lower()
+    for extension in sorted(SOURCE_FORMATS, key=len, reverse=True):
+        if name.endswith(extension):
+            return SOURCE_FORMATS[extension]
+    return None
+
+def get_source_suffix(filename):
+    """File extension to keep when spooling an upload, so DuckDB can detect compression"""
+    name = filename.lower()
+    return next((extension for extension in sorted(SOURCE_FORMATS, key=len, reverse=True) if name.endswith(extension)), '')
+
+def create_file_view(conn, table_name, path, source_format):
+    """
+    Expose a CSV or Parquet file as a view that DuckDB scans in place, with
+    parallel reads and projection pushdown. Nothing is loaded until queried.
+    Returns (view relation, error).
+    """
+    reader = FILE_VIEW_FORMATS[source_format]
+    literal = "'" + path.replace("'", "''") + "'"
+    try:
+        conn.execute(f'CREATE OR REPLACE VIEW {quote_identifier(table_name)} AS SELECT * FROM {reader}({literal})')
+        return conn.view(table_name), None
+    except duckdb.Error as e:
+        conn.execute(f'DROP VIEW IF EXISTS {quote_identifier(table_name)}')
+        return None, f"Error reading {source_format.upper()} file: {str(e)}"
+
+def discard_file(path):
+    """Delete a file if it still exists"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def make_column_names(header):
+    """Build unique column names from a header row the same way pandas does"""
+    columns = []
+    seen = {}
+    for i, value in enumerate(header):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+    return columns
+
+def _stringify_object_columns(batch):
+    """Convert mixed-type object columns to strings so DuckDB can always ingest them"""
+    for col in batch.columns[batch.dtypes == object]:
+        batch[col] = batch[col].map(lambda v: v if v is None else str(v))
+    return batch
+
+def _widen_table_columns(conn, table_name, batch, batch_rel):
+    """Alter table columns to a common supertype when a batch brings a wider type"""
+    table_rel = conn.table(table_name)
+    for col, table_type, batch_type in zip(batch.columns, table_rel.dtypes, batch_rel.dtypes):
+        table_type, batch_type = str(table_type), str(batch_type)
+        if table_type == batch_type or batch[col].isna().all():
+            continue
+        common_type = conn.execute(
+            f"SELECT typeof(x) FROM (SELECT NULL::{table_type} AS x UNION ALL SELECT NULL::{batch_type}) LIMIT 1"
+        ).fetchone()[0]
+        if common_type != table_type:
+            conn.execute(
+                f'ALTER TABLE {quote_identifier(table_name)} ALTER COLUMN {quote_identifier(col)} TYPE {common_type}'
+            )
+
+def _write_batch(conn, table_name, batch, create):
+    """Create the target DuckDB table from a batch, or insert the batch into it"""
+    batch_rel = conn.from_df(batch)
+    if create:
+        batch_rel.create(table_name)
+        return
+    _widen_table_columns(conn, table_name, batch, batch_rel)
+    batch_rel.insert_into(table_name)
+
+def _append_batch(conn, table_name, columns, rows, create):
+    """Write one batch of sheet rows into the target DuckDB table"""
+    batch = pd.DataFrame.from_records(rows, columns=columns)
+    try:
+        _write_batch(conn, table_name, batch, create)
+    except duckdb.Error:
+        # Type errors from mixed columns (e.g. numbers and booleans) surface on create/insert, not from_df
+        _write_batch(conn, table_name, _stringify_object_columns(batch), create)
+
+def _replace_table(conn, table_name, staging_name):
+    """Swap a fully written staging table in under table_name, in one transaction"""
+    conn.begin()
+    try:
+        conn.execute(f'DROP TABLE IF EXISTS {quote_identifier(table_name)}')
+        conn.execute(f'ALTER TABLE {quote_identifier(staging_name)} RENAME TO {quote_identifier(table_name)}')
+        conn.commit()
+    except duckdb.Error:
+        conn.rollback()
+        raise
+
+def stream_excel_to_duckdb(uploaded_file, conn, table_name, batch_rows=INGEST_BATCH_ROWS):
+    """
+    Stream the first sheet of an Excel file into a DuckDB table.
+    The upload is spooled to disk and read row by row, so at most `batch_rows`
+    rows are held in memory regardless of the sheet size.
+    Returns a relation over the new table, or an error message.
+    """
+    path = spool_upload_to_disk(uploaded_file, '.xlsx')
+    try:
+        return stream_excel_file_to_duckdb(path, conn, table_name, batch_rows)
+    finally:
+        os.remove(path)
+
+def stream_excel_file_to_duckdb(path, conn, table_name, batch_rows=INGEST_BATCH_ROWS):
+    """
+    Stream the first sheet of an Excel file on disk into a DuckDB table,
+    replacing any table of that name once the whole sheet is read. Rows go
+    to a staging table first, so a failed read leaves an existing table as it was.
+    """
+    staging_name = f"__sheetiq_ingest_{uuid.uuid4().hex}"
+    workbook = None
+    try:
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return None, "Error reading Excel file: the first sheet is empty"
+        columns = make_column_names(header)
+        
+        batch = []
+        blank_rows = 0
+        created = False
+        for row in rows:
+            # Blank rows are kept like the other readers do, except trailing ones after the last value
+            if all(value is None for value in row):
+                blank_rows += 1
+                continue
+            batch.extend([(None,) * len(columns)] * blank_rows)
+            blank_rows = 0
+            batch.append(tuple(row[:len(columns)]) + (None,) * (len(columns) - len(row)))
+            if len(batch) >= batch_rows:
+                _append_batch(conn, staging_name, columns, batch, create=not created)
+                created = True
+                batch = []
+        if batch or not created:
+            _append_batch(conn, staging_name, columns, batch, create=not created)
+        _replace_table(conn, table_name, staging_name)
+        return conn.table(table_name), None
+    except Exception as e:
+        conn.execute(f'DROP TABLE IF EXISTS {quote_identifier(staging_name)}')
+        return None, f"Error reading Excel file: {str(e)}"
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+def get_ingest_cache_path(content_digest, options):
+    """Map file content plus parser options to a Parquet file in the ingest cache"""
+    key_source = json.dumps(
+        {'content': content_digest, 'version': INGEST_CACHE_VERSION, **options},
+        sort_keys=True
+    )
+    key = hashlib.sha256(key_source.encode()).hexdigest()
+    return os.path.join(INGEST_CACHE_DIR, f"{key}.parquet")
+
+def read_ingest_cache(path, conn, table_name, into_catalog):
+    """
+    Load a table from the ingest cache, or return None on a miss. With
+    into_catalog it is created as a DuckDB table in conn, else returned as Arrow.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        # Touch the entry so LRU eviction keeps recently used files
+        os.utime(path)
+        if into_catalog:
+            # Streamed in through pyarrow: a session catalog may not read the shared cache directory itself
+            parquet_file = pq.ParquetFile(path)
+            reader = pa.RecordBatchReader.from_batches(parquet_file.schema_arrow, parquet_file.iter_batches())
+            return persist_table(conn, table_name, reader)
+        # pyarrow keeps the inferred Arrow schema, including dictionary encoding
+        return pq.read_table(path)
+    except (OSError, duckdb.Error, pa.ArrowException):
+        return None
+
+def write_ingest_cache(path, conn, table):
+    """Store a freshly parsed table in the ingest cache, then enforce the size cap"""
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.makedirs(INGEST_CACHE_DIR, exist_ok=True)
+        if isinstance(table, pa.Table):
+            pq.write_table(table, tmp_path)
+        else:
+            # Written through pyarrow: a session catalog may not write to the shared cache directory itself
+            relation = table if is_catalog_table(table) else conn.from_df(table)
+            reader = relation.to_arrow_reader(EXPORT_BATCH_ROWS)
+            with pq.ParquetWriter(tmp_path, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+        # Atomic rename so concurrent sessions never read a half-written file
+        os.replace(tmp_path, path)
+    except (OSError, duckdb.Error, pa.ArrowException):
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    evict_ingest_cache(keep=path)
+
+def evict_ingest_cache(max_bytes=INGEST_CACHE_MAX_BYTES, keep=None):
+    """
+    Delete least recently used cache entries until the cache fits in max_bytes.
+    The entry at `keep` (usually the one just written) is never evicted.
+    """
+    evict_lru_files(INGEST_CACHE_DIR, max_bytes, keep)
+
+def evict_lru_files(directory, max_bytes, keep=None):
+    """Delete the least recently modified Parquet files in a directory until it fits in max_bytes"""
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.parquet') and entry.path != keep:
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total_bytes = sum(size for _, size, _ in entries)
+    if keep is not None and os.path.exists(keep):
+        total_bytes += os.path.getsize(keep)
+    for _, size, path in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total_bytes -= size
+        except OSError:
+            pass
+
+def parse_workbook_to_cache(path, cache_path, engine):
+    """
+    Process-pool entry point: parse a spooled workbook with one of EXCEL_ENGINES and
+    store it in the ingest cache. The spooled file is removed afterwards.
+    Returns an error message, or None on success.
+    """
+    conn = duckdb.connect(':memory:')
+    try:
+        if engine == 'streaming':
+            table, error = stream_excel_file_to_duckdb(path, conn, 'ingest')
+        else:
+            table, error = read_excel_table(path, engine)
+        if error:
+            return error
+        write_ingest_cache(cache_path, conn, table)
+        if not os.path.exists(cache_path):
+            return "Error caching parsed table: could not write to the ingest cache"
+        return None
+    finally:
+        conn.close()
+        os.remove(path)
+
+def file_digest(fileobj, chunk_bytes=SPOOL_CHUNK_BYTES):
+    """Return the SHA-256 of a binary file object's contents, read in chunks"""
+    hasher = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(chunk_bytes), b''):
+        hasher.update(chunk)
+    fileobj.seek(0)
+    return hasher.hexdigest()
+
+def load_workbook_file(path, conn, table_name, engine='openpyxl', use_cache=True):
+    """
+    Load the first sheet of an Excel file on disk the way the app does, with one
+    of EXCEL_ENGINES and going through the ingest cache. Streamed tables are
+    created in conn; otherwise a typed Arrow table is returned for the caller
+    to register. Returns (table, error, from_cache).
+    """
+    streaming = engine == 'streaming'
+    options = {'engine': engine, 'sheet': 0}
+    cache_path = None
+    if use_cache:
+        with open(path, 'rb') as f:
+            cache_path = get_ingest_cache_path(file_digest(f), options)
+        table = read_ingest_cache(cache_path, conn, table_name, streaming)
+        if table is not None:
+            return table, None, True
+    
+    if streaming:
+        table, error = stream_excel_file_to_duckdb(path, conn, table_name)
+    else:
+        table, error = read_excel_table(path, engine)
+    if error:
+        return None, error, False
+    if cache_path is not None:
+        write_ingest_cache(cache_path, conn, table)
+    return table, None, False
+
+def is_select_query(query):
+    """
+    Check if the query is a single SELECT statement (including WITH, VALUES,
+    DESCRIBE and SUMMARIZE), using DuckDB's own parser.
+    This function blocks potentially harmful SQL operations.
+    """
+    with _PARSER_LOCK:
+        _, error = parse_select_query(_get_parser_connection(), query)
+    return error is None
+
+def get_table_name_from_filename(filename):
+    """Extract a clean table name from filename (remove extension and special chars)"""
+    # Remove file extension, including compound ones like .csv.gz
+    if filename.lower().endswith('.gz'):
+        filename = filename[:-3]
+    table_name = filename.rsplit('.', 1)[0]
+    # Replace spaces and special characters with underscores
+    table_name = re.sub(r'[^a-zA-Z0-9_]', '_', table_name)
+    # Ensure it starts with a letter or underscore
+    if table_name and not table_name[0].isalpha() and table_name[0] != '_':
+        table_name = 'table_' + table_name
+    return table_name or 'unnamed_table'
+
+def is_valid_table_name(name):
+    """Tell whether a name can be used unquoted as a table name in queries"""
+    return bool(TABLE_NAME_RE.match(name))
+
+def register_table(conn, table_name, table):
+    """Expose an Arrow table or DataFrame as a view in the catalog (zero-copy, visible to all cursors)"""
+    rel = conn.from_arrow(table) if isinstance(table, pa.Table) else conn.from_df(table)
+    rel.create_view(table_name, replace=True)
+
+def unregister_table(conn, table_name, table):
+    """Drop a table's view, or the table itself for streamed tables, from the catalog"""
+    kind = 'TABLE' if is_catalog_table(table) and not is_file_view(table) else 'VIEW'
+    conn.execute(f'DROP {kind} IF EXISTS {quote_identifier(table_name)}')
+
+def validate_query(uploaded_tables, query, conn=None):
+    """Return an error message if the query may not be run, otherwise None"""
+    return analyze_query(uploaded_tables, query, conn)[1]
+
+def sample_table(cursor, table_name, rows, total_rows=None, seed=APPROX_SAMPLE_SEED):
+    """
+    Uniform random sample of about rows rows of a catalog table, as an Arrow table.
+    Small samples are drawn exactly with a reservoir; larger ones keep each row
+    with probability rows / total_rows, which is several times faster than a
+    large reservoir. The same seed always draws the same sample; smaller tables
+    come back whole.
+    """
+    if total_rows is None or rows <= APPROX_RESERVOIR_MAX_ROWS:
+        method = f'reservoir({int(rows)} ROWS) REPEATABLE ({int(seed)})'
+    else:
+        method = f'{min(100.0, rows * 100 / total_rows):.6f} PERCENT (bernoulli, {int(seed)})'
+    return cursor.execute(f'SELECT * FROM {quote_identifier(table_name)} USING SAMPLE {method}').to_arrow_table()
+
+def sampling_margin(sample_rows):
+    """Rough 95% margin of error of a share estimated from a uniform sample of this many rows"""
+    return 1 / math.sqrt(sample_rows)
+
+def build_sorted_copy(cursor, table_name, sort_columns):
+    """
+    Copy a catalog table into a new native table with its rows ordered by
+    sort_columns, so that each row group covers a narrow range of the keys and
+    DuckDB's min/max zone maps can skip most of them. Returns the copy's name.
+    """
+    copy_name = f"sheetiq_sorted_{uuid.uuid4().hex[:12]}"
+    order = ', '.join(quote_identifier(column) for column in sort_columns)
+    cursor.execute(f'CREATE TABLE {copy_name} AS SELECT * FROM {quote_identifier(table_name)} ORDER BY {order}')
+    return copy_name
+
+def swap_in_table(conn, table_name, replacement, kind):
+    """
+    Replace a catalog table or view (kind 'TABLE' or 'VIEW') by another table in
+    one transaction, renaming the replacement to its name. Create indexes only
+    afterwards: DuckDB cannot rename a table that has indexes.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN TRANSACTION')
+        try:
+            cursor.execute(f'DROP {kind} {quote_identifier(table_name)}')
+            cursor.execute(f'ALTER TABLE {replacement} RENAME TO {quote_identifier(table_name)}')
+            cursor.execute('COMMIT')
+        except duckdb.Error:
+            cursor.execute('ROLLBACK')
+            raise
+    finally:
+        cursor.close()
+
+def create_key_index(cursor, table_name, column):
+    """Create an ART index on one column of a native table, for point lookups"""
+    index_name = quote_identifier(f"sheetiq_idx_{table_name}_{column}")
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {quote_identifier(table_name)} ({quote_identifier(column)})')
+
+def time_query(cursor, query, repeat=2):
+    """Best wall-clock time in seconds of running a query repeat times, counting its rows inside DuckDB"""
+    wrapped = f'SELECT count(*) FROM ({query.strip().rstrip(";")})'
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        cursor.execute(wrapped).fetchone()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def find_scalable_aggregates(ast):
+    """
+    Positions of the output columns of a parsed query that are plain COUNT or
+    SUM aggregates (not DISTINCT) of its top-level select list; their values
+    over a uniform sample scale up with the sampling fraction. Returns None
+    when output columns cannot be matched to the select list, as with * or
+    set operations.
+    """
+    node = ast['statements'][0]['node']
+    if node.get('type') != 'SELECT_NODE':
+        return None
+    positions = []
+    for position, expression in enumerate(node['select_list']):
+        if expression.get('class') == 'STAR':
+            return None
+        if (expression.get('class') == 'FUNCTION' and not expression.get('distinct')
+                and expression.get('function_name', '').lower() in APPROX_SCALABLE_AGGREGATES):
+            positions.append(position)
+    return positions
+
+def select_columns(table, columns):
+    """
+    Narrow an Arrow table to the given lowercase column names (zero-copy).
+    Other tables, and tables none of whose columns are named (a table needs
+    at least one column, e.g. for a cross join), are returned as is.
+    """
+    if columns is None or not isinstance(table, pa.Table):
+        return table
+    selected = [name for name in table.column_names if name.lower() in columns]
+    return table.select(selected) if selected else table
+
+def execute_sql_query_multi_table(uploaded_tables, query, conn=None):
+    """
+    Execute SQL query on multiple tables using DuckDB.
+    When a catalog connection is given, the query runs on a cursor of it and the
+    tables are expected to be registered already; otherwise a throwaway
+    connection is created and only the tables and columns the query reads are
+    registered for this query.
+    """
+    try:
+        info, error = analyze_query(uploaded_tables, query, conn)
+        if error:
+            return None, error
+        
+        if conn is not None:
+            cursor = conn.cursor()
+            try:
+                result = cursor.execute(query).fetchdf()
+            finally:
+                cursor.close()
+            return result, None
+        
+        # Create DuckDB connection
+        conn = duckdb.connect(':memory:')
+        restrict_file_access(conn)
+        
+        # Register the referenced tables with their respective names
+        for table_name in info['tables']:
+            conn.register(table_name, select_columns(uploaded_tables[table_name], info['columns']))
+        
+        # Execute the query
+        result = conn.execute(query).fetchdf()
+        conn.close()
+        
+        return result, None
+    except Exception as e:
+        return None, f"SQL execution error: {str(e)}"
+
+def execute_sql_query(df, query):
+    """Execute SQL query on a single DataFrame using DuckDB (legacy function)"""
+    try:
+        if not is_select_query(query):
+            return None, "Only SELECT statements are allowed for security reasons."
+        
+        conn = duckdb.connect(':memory:')
+        restrict_file_access(conn)
+        conn.register('df', df)
+        result = conn.execute(query).fetchdf()
+        conn.close()
+        
+        return result, None
+    except Exception as e:
+        return None, f"SQL execution error: {str(e)}"
+
+def apply_query_limits(conn, memory_limit_mb=None, threads=None):
+    """Set DuckDB's memory and thread limits on the database behind a connection"""
+    if memory_limit_mb:
+        conn.execute(f"SET memory_limit = '{int(memory_limit_mb)}MB'")
+    if threads:
+        conn.execute(f"SET threads = {int(threads)}")
+
+def open_database(path=None, memory_limit_mb=None, temp_directory=None):
+    """
+    Open a DuckDB database in memory, or in the file at path. Past the memory
+    limit, operators that support it spill to temp_directory instead of failing.
+    """
+    config = {}
+    if memory_limit_mb:
+        config['memory_limit'] = f"{int(memory_limit_mb)}MB"
+    if temp_directory:
+        os.makedirs(temp_directory, exist_ok=True)
+        config['temp_directory'] = temp_directory
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return duckdb.connect(path or ':memory:', config=config)
+
+def restrict_file_access(conn, directories=()):
+    """
+    Confine a database's file access to directories (none by default), so no
+    query, replacement scan or COPY on it can reach other files on the server,
+    and stop it from scanning Python variables by name. Files opened before,
+    such as the database file itself, keep working. This cannot be undone.
+    """
+    allowed = ', '.join("'" + os.path.join(directory, '').replace("'", "''") + "'" for directory in directories)
+    conn.execute(f'SET allowed_directories = [{allowed}]')
+    conn.execute('SET enable_external_access = false')
+    conn.execute('SET python_enable_replacements = false')
+
+def get_session_storage(session_id, storage_mode=STORAGE_MODE):
+    """Return (database file or None for memory, spill directory) for a session"""
+    database_path = None
+    if storage_mode == 'disk':
+        database_path = os.path.join(STORAGE_DIR, f"session_{session_id}.duckdb")
+    return database_path, os.path.join(SPILL_DIR, session_id)
+
+def discard_session_storage(database_path, spill_dir):
+    """Delete a session's database file, its write-ahead log and its spill directory"""
+    if database_path:
+        discard_file(database_path)
+        discard_file(f"{database_path}.wal")
+    shutil.rmtree(spill_dir, ignore_errors=True)
+
+def persist_table(conn, table_name, table):
+    """Copy an Arrow table or record batch reader into a DuckDB table in the connection's database, replacing any table of that name"""
+    source_name = f"__sheetiq_persist_{uuid.uuid4().hex}"
+    conn.register(source_name, table)
+    try:
+        conn.execute(f'CREATE OR REPLACE TABLE {quote_identifier(table_name)} AS SELECT * FROM {source_name}')
+    finally:
+        conn.unregister(source_name)
+    return conn.table(table_name)
+
+def spill_table_to_parquet(conn, table_name, directory):
+    """
+    Write a catalog table or view to a new Parquet file in directory with
+    DuckDB's COPY, keeping its row order. Returns the file's path.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{table_name}_{uuid.uuid4().hex[:12]}.parquet")
+    export_query_result(conn, f'SELECT * FROM {quote_identifier(table_name)}', path, 'parquet')
+    return path
+
+def get_storage_stats(conn):
+    """Database size, buffer memory in use and its limit, and bytes spilled to disk, for the connection's database"""
+    database_size, wal_size, memory_usage, memory_limit = conn.execute(
+        "SELECT database_size, wal_size, memory_usage, memory_limit "
+        "FROM pragma_database_size() WHERE database_name = current_database()"
+    ).fetchone()
+    spilled_bytes, temp_directory = conn.execute(
+        "SELECT (SELECT coalesce(sum(size), 0) FROM duckdb_temporary_files()), current_setting('temp_directory')"
+    ).fetchone()
+    return {
+        'database_size': database_size,
+        'wal_size': wal_size,
+        'memory_usage': memory_usage,
+        'memory_limit': memory_limit,
+        'spilled_bytes': int(spilled_bytes),
+        'temp_directory': temp_directory
+    }
+
+def run_interruptible(cursor, work, timeout=None, on_tick=None, tick_seconds=0.25):
+    """
+    Run work(cursor) on a helper thread while the calling thread waits.
+    The cursor is interrupted when the timeout elapses, or when waiting is
+    aborted by an exception (such as one raised by on_tick), so a query never
+    outlives its caller. on_tick(elapsed_seconds, progress) is called while
+    waiting, with progress as from get_query_progress.
+    Returns the result of work; raises QueryTimeoutError on timeout.
+    """
+    outcome = {}
+    
+    def target():
+        try:
+            outcome['result'] = work(cursor)
+        except BaseException as e:
+            outcome['error'] = e
+    
+    thread = threading.Thread(target=target, daemon=True)
+    start = time.monotonic()
+    timed_out = False
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(tick_seconds)
+            elapsed = time.monotonic() - start
+            if timeout and elapsed > timeout and not timed_out:
+                timed_out = True
+                cursor.interrupt()
+            if on_tick is not None and thread.is_alive():
+                on_tick(elapsed, get_query_progress(cursor))
+    except BaseException:
+        cursor.interrupt()
+        thread.join()
+        raise
+    
+    if 'result' in outcome:
+        return outcome['result']
+    if timed_out:
+        raise QueryTimeoutError(timeout)
+    raise outcome['error']
+
+def enable_query_progress(cursor):
+    """Have DuckDB track the progress of a cursor's queries from the start, without printing a bar"""
+    cursor.execute('SET enable_progress_bar = true')
+    cursor.execute('SET enable_progress_bar_print = false')
+    cursor.execute('SET progress_bar_time = 0')
+
+def get_query_progress(cursor):
+    """
+    Share of the cursor's running query that is done, from 0 to 1, or None when
+    DuckDB cannot tell. Scans of registered Arrow tables report no progress and
+    stay at zero, so zero also counts as unknown.
+    """
+    try:
+        percent = cursor.query_progress()
+    except duckdb.Error:
+        return None
+    return min(percent, 100.0) / 100 if percent > 0 else None
+
+class QueryJob:
+    """
+    One query task submitted to a QueryPool. Its status goes from 'queued' to
+    'running' to 'done', or from 'queued' to 'cancelled' if it never started.
+    Once done, result holds what the task returned (or error what it raised).
+    """
+    def __init__(self, task, heavy):
+        self.task = task
+        self.heavy = heavy
+        self.status = 'queued'
+        self.submitted = time.monotonic()
+        self.started = None
+        self.finished = None
+        self.progress = None  # Share done from 0 to 1, None while unknown
+        self.partial_results = []  # Intermediate results the task publishes while running
+        self.result = None
+        self.error = None
+        self.cancel_requested = False
+        self.warning = None  # Message the task leaves for the user while it goes on, e.g. a failed estimate
+    
+    def tick(self, elapsed, progress):
+        """on_tick callback for run_interruptible: record progress and stop the query once cancelled"""
+        self.progress = progress
+        if self.cancel_requested:
+            raise QueryCancelledError()
+    
+    def elapsed(self):
+        """Seconds spent running so far, or in total once finished"""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+class QueryPool:
+    """
+    Process-wide queue of queries run on a bounded set of worker threads.
+    At most max_workers queries run at once across all sessions, and at most
+    max_heavy of them may be heavy. Queued jobs start in submission order,
+    except that light jobs may pass heavy ones held back by the heavy cap.
+    A task is called as task(job) and should pass job.tick as on_tick to
+    run_interruptible, which reports progress and makes it cancellable.
+    """
+    def __init__(self, max_workers=QUERY_WORKERS, max_heavy=QUERY_MAX_HEAVY):
+        self.max_workers = max(1, max_workers)
+        self.max_heavy = max(1, min(max_heavy, self.max_workers))
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sheetiq-query')
+        self._queue = []  # Jobs waiting for a worker, oldest first
+        self._running = set()
+        self._lock = threading.Lock()
+    
+    def submit(self, task, heavy=False):
+        """Queue a task and return its QueryJob"""
+        job = QueryJob(task, heavy)
+        with self._lock:
+            self._queue.append(job)
+            self._dispatch()
+        return job
+    
+    def cancel(self, job):
+        """Cancel a job: a queued one never starts, a running one is interrupted at its next tick"""
+        with self._lock:
+            if job in self._queue:
+                self._queue.remove(job)
+                job.status = 'cancelled'
+                job.finished = time.monotonic()
+                return
+        job.cancel_requested = True
+    
+    def position(self, job):
+        """Number of queued jobs ahead of a job, or None if it is not waiting"""
+        with self._lock:
+            return self._queue.index(job) if job in self._queue else None
+    
+    def stats(self):
+        """Number of running, running heavy and queued jobs"""
+        with self._lock:
+            return {
+                'running': len(self._running),
+                'heavy': sum(job.heavy for job in self._running),
+                'queued': len(self._queue)
+            }
+    
+    def _dispatch(self):
+        """Start queued jobs while workers are free; call with the lock held"""
+        heavy_running = sum(job.heavy for job in self._running)
+        for job in list(self._queue):
+            if len(self._running) >= self.max_workers:
+                break
+            if job.heavy and heavy_running >= self.max_heavy:
+                continue
+            self._queue.remove(job)
+            self._running.add(job)
+            heavy_running += job.heavy
+            job.status = 'running'
+            job.started = time.monotonic()
+            self._executor.submit(self._run, job)
+    
+    def _run(self, job):
+        try:
+            job.result = job.task(job)
+        except BaseException as e:
+            job.error = e
+        finally:
+            with self._lock:
+                self._running.discard(job)
+                job.finished = time.monotonic()
+                job.status = 'done'
+                self._dispatch()
+
+def _get_parser_connection():
+    """Connection used only for parsing when the caller has none; guard with _PARSER_LOCK"""
+    global _PARSER_CONN
+    if _PARSER_CONN is None:
+        _PARSER_CONN = duckdb.connect(':memory:')
+        restrict_file_access(_PARSER_CONN)
+    return _PARSER_CONN
+
+def parse_select_query(conn, query):
+    """
+    Parse a query with DuckDB's own parser into its JSON syntax tree and check
+    it is a single read-only SELECT statement. Returns (ast, error).
+    """
+    try:
+        ast = json.loads(conn.execute('SELECT json_serialize_sql(?)', [query]).fetchall()[0][0])
+    except duckdb.Error as e:
+        return None, f"Could not parse query: {str(e)}"
+    if ast.get('error'):
+        # DuckDB only serializes SELECT statements; anything else is refused here
+        if ast.get('error_type') == 'parser':
+            return None, f"SQL syntax error: {ast.get('error_message')}"
+        return None, "Only SELECT statements are allowed for security reasons."
+    if not ast['statements']:
+        return None, "The query is empty."
+    if len(ast['statements']) > 1:
+        return None, "Please run one statement at a time."
+    return ast, None
+
+def _strip_query_locations(node):
+    """Drop source positions from a syntax tree so formatting does not change it"""
+    if isinstance(node, dict):
+        return {key: _strip_query_locations(value) for key, value in node.items() if key != 'query_location'}
+    if isinstance(node, list):
+        return [_strip_query_locations(value) for value in node]
+    return node
+
+def describe_query(ast):
+    """
+    Walk a parsed query and return (table_names, deterministic, table_functions).
+    A table reference is left out as a CTE only when a WITH clause enclosing it
+    declares that name, compared case-insensitively; calling table functions or
+    volatile functions makes a query non-deterministic. table_functions holds
+    the lowercase names of the table functions it calls.
+    """
+    tables, table_functions = set(), set()
+    deterministic = True
+    # Each entry carries the lowercase CTE names in scope at that node
+    stack = [(ast, frozenset())]
+    while stack:
+        node, cte_names = stack.pop()
+        if isinstance(node, list):
+            stack.extend((item, cte_names) for item in node)
+            continue
+        if not isinstance(node, dict):
+            continue
+        if node.get('cte_map'):
+            # The CTEs of a WITH clause are visible in its query, its subqueries and the CTEs themselves
+            cte_names = cte_names | {entry['key'].lower() for entry in node['cte_map']['map']}
+        if node.get('type') == 'BASE_TABLE':
+            qualifiers = [node.get('catalog_name'), node.get('schema_name'), node['table_name']]
+            qualified = node.get('catalog_name') or node.get('schema_name')
+            if qualified or node['table_name'].lower() not in cte_names:
+                tables.add('.'.join(part for part in qualifiers if part))
+        elif node.get('type') == 'TABLE_FUNCTION':
+            deterministic = False
+            table_functions.add(node['function'].get('function_name', '').lower())
+        elif node.get('class') == 'FUNCTION' and node.get('function_name', '').lower() in VOLATILE_FUNCTIONS:
+            deterministic = False
+        stack.extend((child, cte_names) for child in node.values())
+    return tables, deterministic, table_functions
+
+class PhaseTimer:
+    """Wall-clock time spent in each named phase of a query run, in the order first entered"""
+    def __init__(self):
+        self.phases = {}  # Dict: {phase name: seconds}
+    
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block and add it to the named phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+
+def profile_query(cursor, query):
+    """
+    Run a query under EXPLAIN ANALYZE with JSON profiling and return the parsed
+    profile. The query is executed in full, but its rows are discarded.
+    """
+    cursor.execute("SET enable_profiling = 'json'")
+    try:
+        row = cursor.execute(f'EXPLAIN ANALYZE {query.strip().rstrip(";")}').fetchone()
+    finally:
+        cursor.execute("SET enable_profiling = 'no_output'")
+    return json.loads(row[1])
+
+def _format_extra_info(extra_info):
+    """Render an operator's extra info (a dict in newer DuckDB, text in older) on one line"""
+    if isinstance(extra_info, dict):
+        parts = []
+        for key, value in extra_info.items():
+            if isinstance(value, list):
+                value = ', '.join(str(item) for item in value)
+            parts.append(f"{key}: {value}")
+        return '; '.join(parts)
+    return ' '.join(str(extra_info or '').split())
+
+def flatten_query_profile(profile):
+    """
+    Flatten a JSON query profile into one dict per operator, depth first, with
+    keys depth, operator, seconds, rows and details. The EXPLAIN_ANALYZE
+    wrapper node is skipped.
+    """
+    operators = []
+    stack = [(child, 0) for child in reversed(profile.get('children', []))]
+    while stack:
+        node, depth = stack.pop()
+        name = node.get('operator_name') or node.get('operator_type') or node.get('name', '')
+        children = node.get('children', [])
+        if name.strip() == 'EXPLAIN_ANALYZE':
+            stack.extend((child, depth) for child in reversed(children))
+            continue
+        operators.append({
+            'depth': depth,
+            'operator': name.strip(),
+            'seconds': node.get('operator_timing', node.get('timing', 0.0)),
+            'rows': node.get('operator_cardinality', node.get('cardinality', 0)),
+            'details': _format_extra_info(node.get('extra_info'))
+        })
+        stack.extend((child, depth + 1) for child in reversed(children))
+    return operators
+
+def query_columns(ast):
+    """
+    Return the lowercase column names a parsed query may read, or None when it
+    may read every column: it selects * or COLUMNS(...), references a whole
+    row by its table name, uses a NATURAL or POSITIONAL join (which depend on
+    every column) or references no column at all, as in SELECT count(*).
+    Every part of a qualified reference is included, so the set is a superset
+    of what is read.
+    """
+    columns, table_names, single_names = set(), set(), set()
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+            continue
+        if not isinstance(node, dict):
+            continue
+        if node.get('class') == 'STAR' or node.get('type') == 'SHOW_REF':
+            return None
+        if node.get('class') == 'COLUMN_REF':
+            columns.update(name.lower() for name in node['column_names'])
+            if len(node['column_names']) == 1:
+                single_names.add(node['column_names'][0].lower())
+        if node.get('type') == 'BASE_TABLE':
+            table_names.update(name.lower() for name in (node['table_name'], node.get('alias')) if name)
+        if node.get('type') == 'JOIN':
+            if node.get('ref_type') in ('NATURAL', 'POSITIONAL'):
+                return None
+            columns.update(name.lower() for name in node.get('using_columns', []))
+        stack.extend(node.values())
+    if not columns or single_names & table_names:
+        return None
+    return columns
+
+def _is_constant_expression(node):
+    """Tell whether a parsed expression is a literal, a prepared parameter or a cast of one"""
+    if node.get('class') in ('CONSTANT', 'PARAMETER'):
+        return True
+    return node.get('class') == 'CAST' and _is_constant_expression(node['child'])
+
+def _column_ref(node):
+    """(qualifier, column) of a parsed column reference, with qualifier None when unqualified; None for other expressions"""
+    if node.get('class') != 'COLUMN_REF':
+        return None
+    names = node['column_names']
+    return (names[-2] if len(names) > 1 else None), names[-1]
+
+def _predicate_key_columns(node):
+    """Key column usages in a WHERE clause or join condition; only AND/OR trees of simple comparisons are searched"""
+    if not node:
+        return []
+    node_class, node_type = node.get('class'), node.get('type')
+    if node_class == 'CONJUNCTION':
+        return [usage for child in node['children'] for usage in _predicate_key_columns(child)]
+    if node_class == 'COMPARISON' and node_type in LAYOUT_KEY_COMPARISONS:
+        left, right = _column_ref(node['left']), _column_ref(node['right'])
+        if left and right:
+            return [(*left, 'join'), (*right, 'join')] if node_type == 'COMPARE_EQUAL' else []
+        kind = 'eq' if node_type == 'COMPARE_EQUAL' else 'range'
+        if left and _is_constant_expression(node['right']):
+            return [(*left, kind)]
+        if right and _is_constant_expression(node['left']):
+            return [(*right, kind)]
+        return []
+    if node_class == 'BETWEEN':
+        column = _column_ref(node['input'])
+        if column and _is_constant_expression(node['lower']) and _is_constant_expression(node['upper']):
+            return [(*column, 'range')]
+        return []
+    if node_type == 'COMPARE_IN':
+        column = _column_ref(node['children'][0])
+        if column and all(_is_constant_expression(child) for child in node['children'][1:]):
+            return [(*column, 'eq')]
+    return []
+
+def find_key_columns(ast):
+    """
+    Walk a parsed query for the columns it filters or joins on.
+    Returns (usages, aliases). usages lists (qualifier, column, kind) tuples:
+    kind is 'eq' for equality and IN filters against constants, 'range' for
+    other comparisons and BETWEEN, and 'join' for equi-join keys; qualifier
+    is the table name or alias written before the column, or None. aliases
+    maps each lowercase alias or table name of the FROM clauses to its table.
+    """
+    usages, aliases = [], {}
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, list):
+            stack.extend(node)
+            continue
+        if not isinstance(node, dict):
+            continue
+        if node.get('type') == 'BASE_TABLE':
+            aliases[(node.get('alias') or node['table_name']).lower()] = node['table_name']
+        elif node.get('type') == 'JOIN':
+            usages.extend((None, column, 'join') for column in node.get('using_columns') or [])
+            usages.extend(_predicate_key_columns(node.get('condition')))
+        elif node.get('type') == 'SELECT_NODE':
+            usages.extend(_predicate_key_columns(node.get('where_clause')))
+        stack.extend(node.values())
+    return usages, aliases
+
+def choose_table_layout(column_counts, min_queries=LAYOUT_MIN_QUERIES):
+    """
+    Pick a physical layout for one table from its workload: column_counts maps
+    column names to Counters of how many queries used them per kind ('eq',
+    'range', 'join'). Columns count once they reach min_queries queries.
+    The table is sorted by its most range-filtered column, or failing that its
+    most equality-filtered one, or its most joined one (DuckDB pushes join
+    filters into the scan of the probe side, where zone maps apply too).
+    Other columns with frequent equality filters get an ART index.
+    Returns (sort_columns, index_columns), both empty when nothing is hot.
+    """
+    def hottest(kind):
+        candidates = [column for column, counts in column_counts.items() if counts[kind] >= min_queries]
+        return max(sorted(candidates), key=lambda column: column_counts[column][kind], default=None)
+    
+    sort_column = hottest('range') or hottest('eq') or hottest('join')
+    index_columns = sorted(
+        column for column, counts in column_counts.items()
+        if counts['eq'] >= min_queries and column != sort_column
+    )
+    return ([sort_column] if sort_column else []), index_columns
+
+def analyze_query(uploaded_tables, query, conn=None):
+    """
+    Validate a query with DuckDB's parser and work out what it reads.
+    Returns (info, error). info holds the syntax tree ('ast'), the session
+    tables it references ('tables'), the lowercase column names it may read
+    ('columns', None for all) and whether it is 'deterministic'.
+    """
+    if conn is None:
+        with _PARSER_LOCK:
+            ast, error = parse_select_query(_get_parser_connection(), query)
+    else:
+        ast, error = parse_select_query(conn, query)
+    if error:
+        return None, error
+    
+    if not uploaded_tables:
+        return None, "No tables available. Please upload at least one Excel file."
+    
+    # DuckDB identifiers are case-insensitive
+    known_tables = {name.lower(): name for name in uploaded_tables}
+    table_names, deterministic, table_functions = describe_query(ast)
+    # Table functions such as read_csv or glob would read files on the server
+    refused = sorted(table_functions - ALLOWED_TABLE_FUNCTIONS)
+    if refused:
+        return None, (
+            f"Table function(s) not allowed: {', '.join(refused)}. "
+            f"Queries may only read uploaded tables (and generate rows with {', '.join(sorted(ALLOWED_TABLE_FUNCTIONS))})."
+        )
+    unknown = sorted(name for name in table_names if name.lower() not in known_tables)
+    if unknown:
+        return None, (
+            f"Unknown table(s): {', '.join(unknown)}. "
+            f"Available tables: {', '.join(uploaded_tables)}."
+        )
+    
+    return {
+        'ast': ast,
+        'tables': sorted({known_tables[name.lower()] for name in table_names}),
+        'columns': query_columns(ast),
+        'deterministic': deterministic
+    }, None
+
+def make_result_cache_key(ast, table_versions):
+    """Build a cache key from the normalized syntax tree and the versions of the tables it reads"""
+    key_source = json.dumps(
+        {'query': _strip_query_locations(ast), 'tables': sorted(table_versions.items())},
+        sort_keys=True
+    )
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+class ResultCache:
+    """
+    Process-wide LRU cache of query results held as Arrow tables.
+    Memory use is bounded by max_bytes; when a spill directory is configured,
+    evicted results are written there as Parquet instead of being dropped.
+    Every entry remembers the table versions it was computed from, so that
+    replacing or deleting a table can invalidate it.
+    """
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, spill_dir=RESULT_CACHE_SPILL_DIR,
+                 spill_max_bytes=RESULT_CACHE_SPILL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_bytes // 4
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        self._entries = OrderedDict()  # Dict: {key: {'table', 'path', 'bytes', 'versions'}}
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the cached Arrow table for a key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            if entry['table'] is not None:
+                return entry['table']
+            path = entry['path']
+        try:
+            return pq.read_table(path)
+        except OSError:
+            # The spill file was evicted from disk
+            with self._lock:
+                self._drop(key)
+            return None
+    
+    def put(self, key, table, versions):
+        """Store a result computed from the given table versions"""
+        if table.nbytes > self.max_entry_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = {'table': table, 'path': None, 'bytes': table.nbytes, 'versions': frozenset(versions)}
+            self._memory_bytes += table.nbytes
+            self._evict()
+    
+    def invalidate(self, version):
+        """Drop every entry computed from a given table version"""
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if version in entry['versions']]:
+                self._drop(key)
+    
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        if entry['table'] is not None:
+            self._memory_bytes -= entry['bytes']
+        elif os.path.exists(entry['path']):
+            os.remove(entry['path'])
+    
+    def _evict(self):
+        """Spill or drop least recently used in-memory entries until within budget"""
+        for key in list(self._entries):
+            if self._memory_bytes <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry['table'] is None:
+                continue
+            if self.spill_dir is None:
+                self._drop(key)
+                continue
+            try:
+                os.makedirs(self.spill_dir, exist_ok=True)
+                path = os.path.join(self.spill_dir, f"{key}.parquet")
+                pq.write_table(entry['table'], path)
+            except OSError:
+                self._drop(key)
+                continue
+            self._memory_bytes -= entry['bytes']
+            entry['table'], entry['path'] = None, path
+            evict_lru_files(self.spill_dir, self.spill_max_bytes, keep=path)
+
+class _SessionLease:
+    """Token kept in a session's state; see SharedTableStore.lease"""
+    def __init__(self, session_id):
+        self.session_id = session_id
+
+class SharedTableStore:
+    """
+    Process-wide store of immutable Arrow tables keyed by content version.
+    Sessions that load the same file share one copy instead of holding their own.
+    Each entry counts references per session, and a table is dropped from the
+    store once the last session holding it releases it.
+    """
+    def __init__(self):
+        self._entries = {}  # Dict: {key: {'table', 'bytes', 'holders': Counter of session ids}}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Return the shared table for a key, or None if no session holds it"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['table'] if entry is not None else None
+    
+    def add(self, key, table, session_id):
+        """
+        Take a reference to a table on behalf of a session.
+        If the content is already shared, the existing copy is returned and
+        should be used in place of the one passed in.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {'table': table, 'bytes': table.nbytes, 'holders': Counter()}
+                self._entries[key] = entry
+            entry['holders'][session_id] += 1
+            return entry['table']
+    
+    def release(self, key, session_id):
+        """Drop one of a session's references to a table"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not entry['holders'][session_id]:
+                return
+            entry['holders'][session_id] -= 1
+            if not entry['holders'][session_id]:
+                del entry['holders'][session_id]
+            if not entry['holders']:
+                del self._entries[key]
+    
+    def release_session(self, session_id):
+        """Drop every reference a session holds, e.g. when it expires"""
+        with self._lock:
+            for key in list(self._entries):
+                holders = self._entries[key]['holders']
+                holders.pop(session_id, None)
+                if not holders:
+                    del self._entries[key]
+    
+    def lease(self, session_id):
+        """
+        Return a token to keep in a session's state. When the state is garbage
+        collected because the session expired, its references are released.
+        """
+        token = _SessionLease(session_id)
+        weakref.finalize(token, self.release_session, session_id)
+        return token
+    
+    def session_count(self, key):
+        """Number of sessions currently holding a table"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return len(entry['holders']) if entry is not None else 0
+    
+    def stats(self):
+        """Number of shared tables and the bytes they occupy"""
+        with self._lock:
+            return {
+                'tables': len(self._entries),
+                'bytes': sum(entry['bytes'] for entry in self._entries.values())
+            }
+
+def profile_table(conn, table_name, bins=PROFILE_HISTOGRAM_BINS):
+    """
+    Profile every column of a catalog table.
+    One aggregate scan collects counts, min/max, approximate distinct counts and
+    a sample value for all columns at once; a second scan bins the numeric
+    columns into equal-width histograms.
+    Returns (total_rows, column_profile, histograms) where histograms maps
+    column names to DataFrames of bin upper bounds and row counts.
+    """
+    rel = conn.table(table_name)
+    columns, types = rel.columns, [str(dtype) for dtype in rel.dtypes]
+    
+    aggregates = ['count(*)']
+    for col in columns:
+        quoted_col = quote_identifier(col)
+        aggregates += [
+            f'count({quoted_col})', f'min({quoted_col})', f'max({quoted_col})',
+            f'approx_count_distinct({quoted_col})', f'any_value({quoted_col})'
+        ]
+    row = conn.execute(f'SELECT {", ".join(aggregates)} FROM {quote_identifier(table_name)}').fetchone()
+    total_rows = row[0]
+    stats = [row[1 + i * 5:6 + i * 5] for i in range(len(columns))]
+    
+    def display(value):
+        return 'N/A' if value is None else str(value)
+    
+    column_profile = pd.DataFrame({
+        'Column Name': columns,
+        'Data Type': types,
+        'Non-Null Values': [count for count, _, _, _, _ in stats],
+        'Missing Values': [total_rows - count for count, _, _, _, _ in stats],
+        'Distinct (approx.)': [min(distinct, count) for count, _, _, distinct, _ in stats],
+        'Min': [display(minimum) for _, minimum, _, _, _ in stats],
+        'Max': [display(maximum) for _, _, maximum, _, _ in stats],
+        'Sample Values': [display(sample) for _, _, _, _, sample in stats]
+    })
+    
+    histogram_columns = [
+        (col, float(minimum), float(maximum))
+        for col, col_type, (_, minimum, maximum, _, _) in zip(columns, types, stats)
+        if is_numeric_type(col_type) and minimum is not None and minimum != maximum
+    ]
+    histograms = {}
+    if histogram_columns:
+        aggregates, params = [], []
+        for col, minimum, maximum in histogram_columns:
+            aggregates.append(
+                f'histogram({quote_identifier(col)}::DOUBLE, equi_width_bins(?::DOUBLE, ?::DOUBLE, {int(bins)}, true))'
+            )
+            params += [minimum, maximum]
+        row = conn.execute(f'SELECT {", ".join(aggregates)} FROM {quote_identifier(table_name)}', params).fetchone()
+        for (col, _, _), counts in zip(histogram_columns, row):
+            histograms[col] = pd.DataFrame({'Upper Bound': list(counts.keys()), 'Rows': list(counts.values())})
+    
+    return total_rows, column_profile, histograms
+
+def iter_cursor_rows(cursor, batch_rows=EXPORT_BATCH_ROWS):
+    """Yield the rows of an executed DuckDB query, fetching them in fixed-size batches"""
+    while True:
+        rows = cursor.fetchmany(batch_rows)
+        if not rows:
+            return
+        yield from rows
+
+def export_query_result(cursor, query, path, export_format):
+    """
+    Write the result of a query to a file in one of RESULT_EXPORT_FORMATS.
+    DuckDB's COPY streams rows from the query into the file on the cursor's
+    threads, so the result is never materialized in Python; Arrow IPC files
+    are written batch by batch through pyarrow.
+    """
+    options = RESULT_EXPORT_FORMATS[export_format]['copy']
+    query = query.strip().rstrip(";")
+    if options is None:
+        reader = cursor.execute(query).to_arrow_reader(EXPORT_BATCH_ROWS)
+        with pa.ipc.new_file(path, reader.schema) as writer:
+            for batch in reader:
+                writer.write_batch(batch)
+        return
+    literal = "'" + path.replace("'", "''") + "'"
+    cursor.execute(f'COPY ({query}) TO {literal} ({options})')
+
+def _excel_value(value):
+    """Convert a value to something openpyxl can write into a cell"""
+    if isinstance(value, float):
+        return None if math.isnan(value) else value
+    if value is None or isinstance(value, (numbers.Integral, decimal.Decimal)):
+        return value
+    if isinstance(value, str):
+        return ILLEGAL_CHARACTERS_RE.sub('', value)
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+        return value
+    if pd.isna(value) is True:
+        return None
+    return str(value)
+
+def create_excel_download(df, filename="query_result.xlsx"):
+    """Create Excel file from DataFrame for download"""
+    output = io.BytesIO()
+    write_excel_export(df.itertuples(index=False, name=None), df.columns, output)
+    return output.getvalue()
+
+def write_excel_export(rows, columns, target, sheet_title='Query Result', max_rows=EXCEL_MAX_ROWS):
+    """
+    Write rows into an xlsx file with openpyxl's write-only (streaming) mode.
+    When a sheet reaches Excel's row limit, the remaining rows continue on
+    'Query Result 2', 'Query Result 3', ... each with its own header row.
+    `target` is a path or a binary file object. Returns the number of sheets.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    header = [str(column) for column in columns]
+    sheet, sheet_count, sheet_rows = None, 0, max_rows
+    for row in rows:
+        if sheet_rows >= max_rows:
+            sheet_count += 1
+            sheet = workbook.create_sheet(sheet_title if sheet_count == 1 else f"{sheet_title} {sheet_count}")
+            sheet.append(header)
+            sheet_rows = 1
+        sheet.append([_excel_value(value) for value in row])
+        sheet_rows += 1
+    if sheet is None:
+        workbook.create_sheet(sheet_title).append(header)
+        sheet_count = 1
+    workbook.save(target)
+    return sheet_count
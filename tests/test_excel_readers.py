@@ -0,0 +1,34 @@
+import datetime
+
+import openpyxl
+import pytest
+
+from sheetiq_engine import read_excel_table
+
+
+@pytest.fixture
+def workbook_with_blanks(tmp_path):
+    path = tmp_path / "blanks.xlsx"
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(['id', 'flag', 'price', 'name', 'big', 'when', 'all_blank', 'zero_one', 'whole_float'])
+    sheet.append([1, True, 1.5, 'a', 2 ** 40, datetime.datetime(2024, 1, 1), None, 0, 2.0])
+    sheet.append([None, None, None, None, None, None, None, 1, 3.0])
+    sheet.append([3, False, 2.25, 'c', 5, datetime.datetime(2024, 1, 2), None, 1, None])
+    workbook.save(path)
+    return str(path)
+
+
+def test_readers_agree_on_schema(workbook_with_blanks):
+    pandas_table, pandas_error = read_excel_table(workbook_with_blanks, engine='openpyxl')
+    fast_table, fast_error = read_excel_table(workbook_with_blanks, engine='fast')
+    assert pandas_error is None and fast_error is None
+    assert pandas_table.schema == fast_table.schema
+    assert pandas_table.to_pydict() == fast_table.to_pydict()
+
+
+def test_blank_cells_keep_integer_and_boolean_types(workbook_with_blanks):
+    table, _ = read_excel_table(workbook_with_blanks, engine='openpyxl')
+    assert str(table.schema.field('id').type) == 'int64'
+    assert str(table.schema.field('flag').type) == 'bool'
+    assert table.column('flag').to_pylist() == [True, None, False]
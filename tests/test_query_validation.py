@@ -0,0 +1,66 @@
+import duckdb
+import pyarrow as pa
+import pytest
+
+from sheetiq_engine import analyze_query, execute_sql_query_multi_table, restrict_file_access
+
+
+@pytest.fixture
+def tables():
+    return {'sales': pa.table({'id': [1, 2, 3], 'amount': [10.0, 20.0, 30.0]})}
+
+
+@pytest.fixture
+def server_file(tmp_path):
+    path = tmp_path / "private.csv"
+    duckdb.sql(f"COPY (SELECT 42 AS hidden) TO '{path}'")
+    return str(path)
+
+
+def test_cte_in_subquery_does_not_hide_file_reference(tables, server_file):
+    query = f'''SELECT * FROM (WITH "{server_file}" AS (SELECT 1) SELECT * FROM "{server_file}") s, '{server_file}' f'''
+    info, error = analyze_query(tables, query)
+    assert info is None
+    assert "Unknown table" in error
+    result, error = execute_sql_query_multi_table(tables, query)
+    assert result is None and "Unknown table" in error
+
+
+def test_cte_in_subquery_is_refused_on_session_cursor(tables, server_file):
+    conn = duckdb.connect()
+    conn.register('sales', tables['sales'])
+    query = f'''SELECT * FROM (WITH "{server_file}" AS (SELECT 1) SELECT * FROM "{server_file}") s, '{server_file}' f'''
+    result, error = execute_sql_query_multi_table(tables, query, conn)
+    assert result is None and "Unknown table" in error
+
+
+@pytest.mark.parametrize("query", [
+    "WITH Totals AS (SELECT sum(amount) AS total FROM sales) SELECT * FROM totals",
+    "WITH a AS (SELECT 1 AS x), b AS (SELECT * FROM a) SELECT * FROM b, sales",
+    "WITH RECURSIVE r AS (SELECT 1 AS n UNION ALL SELECT n + 1 FROM r WHERE n < 3) SELECT * FROM r",
+    "SELECT * FROM sales WHERE id IN (WITH q AS (SELECT 1) SELECT * FROM q)",
+])
+def test_ctes_in_scope_are_not_tables(tables, query):
+    info, error = analyze_query(tables, query)
+    assert error is None
+    assert set(info['tables']) <= {'sales'}
+
+
+def test_restricted_connection_cannot_read_files(server_file):
+    conn = duckdb.connect()
+    conn.register('sales', pa.table({'id': [1]}))
+    restrict_file_access(conn)
+    assert conn.execute("SELECT count(*) FROM sales").fetchone()[0] == 1
+    with pytest.raises(duckdb.PermissionException):
+        conn.execute(f"SELECT * FROM '{server_file}'")
+
+
+def test_restricted_connection_keeps_allowed_directory(tmp_path, server_file):
+    allowed = tmp_path / "session"
+    allowed.mkdir()
+    conn = duckdb.connect()
+    restrict_file_access(conn, [str(allowed)])
+    conn.execute(f"COPY (SELECT 1 AS x) TO '{allowed / 'out.parquet'}'")
+    assert conn.execute(f"SELECT x FROM '{allowed / 'out.parquet'}'").fetchone()[0] == 1
+    with pytest.raises(duckdb.PermissionException):
+        conn.execute(f"SELECT * FROM '{server_file}'")